@@ -2,7 +2,10 @@ from setuptools import setup
 
 try:
     from Cython.Build import cythonize
-    modules = cythonize("srctools/_tokenizer.pyx")
+    modules = cythonize([
+        "srctools/_tokenizer.pyx",
+        "srctools/_vmf.pyx",
+    ])
 except ImportError:
     print('Cython not installed, not compiling Cython modules.')
     modules = []
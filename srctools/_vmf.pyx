@@ -0,0 +1,210 @@
+#cython: language_level=3, embedsignature=True
+"""Cython versions of the functions used to parse brushes in VMFs."""
+import sys
+
+cdef extern from "Python.h":
+    ctypedef struct PyObject
+    # This is locale-independent, and matches float().
+    double PyOS_string_to_double(
+        const char *s,
+        char **endptr,
+        PyObject *overflow_exception,
+    ) except? -1.0
+
+
+cdef inline const char *skip_space(const char *pos):
+    """Skip over spaces and tabs."""
+    while pos[0] == b' ' or pos[0] == b'\t':
+        pos += 1
+    return pos
+
+
+cdef inline bint is_space(char c):
+    """Check for a space or tab."""
+    return c == b' ' or c == b'\t'
+
+
+cdef inline const char *read_float(const char *pos, double *result) except NULL:
+    """Parse a number, then return the position after it.
+
+    Like _NUM_SYNTAX in vmf.py, the number is the run of digits, signs,
+    points and exponents here, all of which must be parsed.
+    """
+    cdef const char *end = pos
+    cdef char *parsed_end
+    while (
+        b'0' <= end[0] <= b'9' or end[0] == b'.' or
+        end[0] == b'-' or end[0] == b'+' or
+        end[0] == b'e' or end[0] == b'E'
+    ):
+        end += 1
+    if end == pos:
+        raise ValueError
+    result[0] = PyOS_string_to_double(pos, &parsed_end, NULL)
+    if parsed_end != end:
+        raise ValueError
+    return end
+
+
+def read_block(tree not None):
+    """Return the value of each child of a block, in one pass.
+
+    Like Property.find_key(), the last of any duplicate keys is used.
+    """
+    cdef dict values = {}
+    cdef list children = tree.value
+    for prop in children:
+        values[prop._folded_name] = prop.value
+    return values
+
+
+cdef int read_plane(str value, double *coords) except -1:
+    """Parse the nine coordinates from a side's plane value.
+
+    This accepts the same syntax as _PLANE_SYNTAX in vmf.py.
+    """
+    cdef bytes data = value.encode('utf8')
+    cdef const char *pos = data
+    cdef const char *end = pos + len(data)
+    cdef int i
+    try:
+        for i in range(9):
+            if i % 3 == 0:
+                pos = skip_space(pos)
+                if pos[0] != b'(':
+                    raise ValueError
+                pos = skip_space(pos + 1)
+            elif is_space(pos[0]):
+                pos = skip_space(pos)
+            else:
+                raise ValueError
+            pos = read_float(pos, &coords[i])
+            if i % 3 == 2:
+                pos = skip_space(pos)
+                if pos[0] != b')':
+                    raise ValueError
+                pos += 1
+        if skip_space(pos) != end:
+            raise ValueError
+    except ValueError:
+        raise ValueError('Invalid planes in "' + value + '"!') from None
+    return 0
+
+
+cdef int read_uv_axis(str value, double *values) except -1:
+    """Parse the x, y, z, offset and scale values of a UV axis.
+
+    This accepts the same syntax as _UV_AXIS_SYNTAX in vmf.py.
+    """
+    cdef bytes data = value.encode('utf8')
+    cdef const char *pos = data
+    cdef const char *end = pos + len(data)
+    cdef int i
+    try:
+        pos = skip_space(pos)
+        if pos[0] == b'[':
+            pos = skip_space(pos + 1)
+        for i in range(4):
+            if i != 0:
+                if not is_space(pos[0]):
+                    raise ValueError
+                pos = skip_space(pos)
+            pos = read_float(pos, &values[i])
+        if pos[0] == b']':
+            pos = skip_space(pos + 1)
+        elif is_space(pos[0]):
+            pos = skip_space(pos)
+            if pos[0] == b']':
+                pos = skip_space(pos + 1)
+        else:
+            raise ValueError
+        pos = read_float(pos, &values[4])
+        if skip_space(pos) != end:
+            raise ValueError
+    except ValueError:
+        raise ValueError('Invalid UV axis "' + value + '"!') from None
+    return 0
+
+
+cdef object conv_int(object value, object default):
+    """Like srctools.conv_int()."""
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return default
+
+
+cdef object conv_float(object value, object default):
+    """Like srctools.conv_float()."""
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def parse_plane(str value not None):
+    """Parse the three points from a side's plane value."""
+    cdef double coords[9]
+    read_plane(value, coords)
+    return [
+        (coords[0], coords[1], coords[2]),
+        (coords[3], coords[4], coords[5]),
+        (coords[6], coords[7], coords[8]),
+    ]
+
+
+def parse_uv_axis(str value not None):
+    """Parse the values for a UV axis, in the form "[x y z offset] scale"."""
+    cdef double values[5]
+    read_uv_axis(value, values)
+    return values[0], values[1], values[2], values[3], values[4]
+
+
+# Imported when first required, since srctools.vmf imports this module.
+cdef object Side = None, UVAxis = None, Vec = None
+
+
+def parse_side(vmf_file not None, tree not None):
+    """Parse the property tree into a Side object.
+
+    This builds the side directly, instead of calling Side(). Displacements
+    are rare, so those are handled by Side._parse_disp().
+    """
+    global Side, UVAxis, Vec
+    cdef dict values = read_block(tree)
+    cdef double coords[9]
+    cdef double uaxis[5]
+    cdef double vaxis[5]
+    if Side is None:
+        from srctools.vmf import Side, UVAxis
+        from srctools import Vec
+    if values.get('dispinfo'):
+        return Side._parse_disp(vmf_file, values)
+
+    read_plane(values.get('plane', '(0 0 0) (0 0 0) (0 0 0)'), coords)
+    read_uv_axis(values.get('uaxis', '[0 1 0 0] 0.25'), uaxis)
+    read_uv_axis(values.get('vaxis', '[0 0 -1 0] 0.25'), vaxis)
+    rotation = conv_float(values.get('rotation'), 0)
+    lightmap = conv_int(values.get('lightmapscale'), 16)
+    smooth = conv_int(values.get('smoothing_groups'), 0)
+
+    side = Side.__new__(Side)
+    side.map = vmf_file
+    side.id = vmf_file.face_id.get_id(conv_int(values.get('id'), -1))
+    side._planes = [
+        Vec(coords[0], coords[1], coords[2]),
+        Vec(coords[3], coords[4], coords[5]),
+        Vec(coords[6], coords[7], coords[8]),
+    ]
+    side._mat = sys.intern(values.get('material', ''))
+    side.uaxis = UVAxis(uaxis[0], uaxis[1], uaxis[2], uaxis[3], uaxis[4])
+    side.vaxis = UVAxis(vaxis[0], vaxis[1], vaxis[2], vaxis[3], vaxis[4])
+    side.ham_rot = rotation
+    side.lightmap = lightmap
+    side.smooth = smooth
+    side.is_disp = False
+    side._dirty = True
+    side._solid = None
+    side._normal_cache = None
+    side._bbox_cache = None
+    return side
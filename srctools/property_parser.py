@@ -57,7 +57,10 @@ They end with a quote."
 
     \n, \t, and \\ will be converted in Property values.
 """
+import asyncio
+import functools
 import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 from srctools import BOOL_LOOKUP, Vec as _Vec, EmptyMapping
 from srctools.tokenizer import Token, Tokenizer, TokenSyntaxError
@@ -89,6 +92,18 @@ PROP_FLAGS_DEFAULT = {
 }
 
 
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Return the running event loop, or the current one outside coroutines.
+
+    get_running_loop() is only in 3.7+, but inside a coroutine
+    get_event_loop() returns the same loop.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        return asyncio.get_event_loop()
+
+
 class KeyValError(TokenSyntaxError):
     """An error that occurred when parsing a Valve KeyValues file.
 
@@ -341,6 +356,30 @@ class Property:
             )
         return open_properties[0]
 
+    @staticmethod
+    def parse_async(
+        file_contents: Union[str, Iterator[str]],
+        filename='',
+        flags: Dict[str, bool]=EmptyMapping,
+        executor: Executor=None,
+    ) -> 'asyncio.Future':
+        """Parse text in an executor, so the event loop isn't blocked.
+
+        This takes the same arguments as parse(), and returns a future
+        for the tree. If file_contents is an open file, it is also read
+        in the executor. Open files can't be sent to a ProcessPoolExecutor,
+        so that raises ValueError. executor defaults to the event loop's
+        default executor.
+        """
+        if isinstance(executor, ProcessPoolExecutor) and hasattr(file_contents, 'read'):
+            raise ValueError(
+                'Open files cannot be parsed in a ProcessPoolExecutor!'
+            )
+        return _get_loop().run_in_executor(
+            executor,
+            functools.partial(Property.parse, file_contents, filename, flags),
+        )
+
     def find_all(self, *keys) -> Iterator['Property']:
         """Search through the tree, yielding all properties that match a particular path.
 
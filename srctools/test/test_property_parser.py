@@ -1,3 +1,6 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import pytest
 from srctools.property_parser import Property, KeyValError, NoKeyError
 
@@ -345,3 +348,27 @@ def test_bool():
     assert bool(Property('Name', [
         Property('Key', 'Value')
     ])) is True
+
+
+def test_parse_async():
+    """Test parsing in an executor."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            trees = loop.run_until_complete(asyncio.gather(
+                Property.parse_async(parse_test),
+                Property.parse_async(parse_test, executor=executor),
+            ))
+        for tree in trees:
+            assert_tree(tree, Property.parse(parse_test))
+        with pytest.raises(KeyValError):
+            loop.run_until_complete(
+                Property.parse_async('"key" "value" }')
+            )
+        with ProcessPoolExecutor(1) as executor:
+            with open(__file__) as file, pytest.raises(ValueError):
+                Property.parse_async(file, executor=executor)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,1198 @@
+"""Test the VMF library."""
+from array import array
+import asyncio
+import gc
+import multiprocessing
+import pickle
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from srctools import Vec, Property
+from srctools.filesys import VirtualFileSystem
+from srctools import vmf as vmf_mod
+from srctools.vmf import (
+    VMF, Side, IDMan, NullIDMan, EntityFixup, Output,
+    localise_solids, translate_solids, localise_uv_axes, UVAxis,
+)
+
+if vmf_mod._C_parse_plane is not None:
+    parse_parms = [
+        (vmf_mod._C_read_block, vmf_mod._C_parse_plane, vmf_mod._C_parse_uv_axis, vmf_mod._C_parse_side),
+        (vmf_mod._Py_read_block, vmf_mod._Py_parse_plane, vmf_mod._Py_parse_uv_axis, vmf_mod._Py_parse_side),
+    ]
+    parse_ids = ['Cython', 'Python']
+else:
+    print('No _vmf!')
+    parse_parms = [
+        (vmf_mod._Py_read_block, vmf_mod._Py_parse_plane, vmf_mod._Py_parse_uv_axis, vmf_mod._Py_parse_side),
+    ]
+    parse_ids = ['Python']
+
+
+def test_localise_solids():
+    """Test localising a group of solids at once matches rotating each point."""
+    vmf = VMF()
+    first = vmf.make_prism(Vec(-32, -64, 0), Vec(48, 16, 128)).solid
+    second = vmf.make_prism(Vec(128, 128, 128), Vec(256, 192, 512)).solid
+
+    origin = Vec(64, -320, 16)
+    angles = Vec(30, 90, 0)
+    expected = [
+        [
+            [
+                Vec(point).rotate(*angles) + origin
+                for point in side.planes
+            ] for side in solid
+        ]
+        for solid in [first, second]
+    ]
+    localise_solids([first, second], origin, angles)
+    for solid, exp_solid in zip([first, second], expected):
+        for side, exp_planes in zip(solid, exp_solid):
+            assert side.planes == exp_planes
+
+    # Without angles, this is just a translation.
+    before = [side.planes[0].copy() for side in first]
+    localise_solids([first], Vec(1, 2, 3))
+    for side, point in zip(first, before):
+        assert side.planes[0] == point + (1, 2, 3)
+
+
+def test_translate_solids():
+    """Test translating a group of solids."""
+    vmf = VMF()
+    solid = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    translate_solids([solid], (16, 0, -8))
+    bbox_min, bbox_max = solid.get_bbox()
+    assert bbox_min == (16, 0, -8)
+    assert bbox_max == (80, 64, 56)
+    # Texture offsets are shifted to match, like Side.translate().
+    other = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    for side in other.sides:
+        side.translate(Vec(16, 0, -8))
+    for moved, single in zip(solid.sides, other.sides):
+        assert moved.uaxis.offset == single.uaxis.offset
+        assert moved.vaxis.offset == single.vaxis.offset
+
+
+def test_rotate_no_negative_zero():
+    """Rotating doesn't produce -0 values, which export as "-0"."""
+    vmf = VMF()
+    solid = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    localise_solids([solid], Vec(), Vec(0, 180, 0))
+    for side in solid.sides:
+        for point in side.planes:
+            assert '-0 ' not in point.join(' ') + ' '
+        for axis in (side.uaxis, side.vaxis):
+            assert '-0 ' not in str(axis)
+
+
+def test_id_allocation():
+    """Test IDMan allocates the lowest free IDs."""
+    ids = IDMan()
+    assert [ids.get_id() for _ in range(5)] == [1, 2, 3, 4, 5]
+    assert ids.get_id(12) == 12
+    # Used, so this is ignored.
+    assert ids.get_id(3) == 6
+    ids.remove(2)
+    ids.discard(4)
+    assert ids.get_id() == 2
+    assert ids.reserve(4) == [4, 7, 8, 9]
+    assert ids.get_id() == 10
+    ids -= {1, 5, 9, 100}
+    ids.add(5)
+    assert ids.reserve(3) == [1, 9, 11]
+    ids &= set(range(1, 11))
+    assert ids.get_id() == 11
+    ids.clear()
+    assert ids.get_id() == 1
+
+    # Released IDs are reused without scanning the used IDs again.
+    ids = IDMan(range(1, 200001))
+    ids.reserve(200000)
+    for i in range(1000, 2000):
+        ids.discard(i)
+        assert ids.get_id() == i
+    assert ids._next_free == 400001
+
+    null_ids = NullIDMan()
+    assert null_ids.get_id(5) == 5
+    assert null_ids.get_id(5) == 5
+    assert null_ids.get_id() == 1
+
+
+def test_id_release():
+    """Test IDs are released when removed, or if never added."""
+    vmf = VMF()
+    solid = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    vmf.add_brush(solid)
+    side_ids = {side.id for side in solid}
+    ent = vmf.create_ent('info_target')
+
+    vmf.remove_brush(solid)
+    assert solid.id not in vmf.solid_id
+    assert not side_ids & vmf.face_id
+    # Adding it back reserves them again.
+    brush_ent = vmf.create_ent('func_detail')
+    brush_ent.solids.append(solid)
+    vmf.remove_ent(brush_ent)
+    assert brush_ent.id not in vmf.ent_id
+    vmf.add_ent(brush_ent)
+    assert brush_ent.id in vmf.ent_id
+    assert solid.id in vmf.solid_id
+    assert side_ids <= vmf.face_id
+    vmf.remove_ent(brush_ent)
+    assert solid.id not in vmf.solid_id
+    assert not side_ids & vmf.face_id
+
+    for i in range(20):
+        brush = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+        vmf.add_brush(brush)
+        vmf.remove_brush(brush)
+        brush.copy()
+        vmf.create_ent('info_target').copy()
+    del brush
+    gc.collect()
+    assert len(vmf.solid_id) == 0
+    assert len(vmf.face_id) == 0
+    assert vmf.ent_id == {vmf.spawn.id} | {
+        ent.id for ent in vmf.entities
+    }
+
+    vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64))
+    vmf.clear()
+    assert vmf.entities == []
+    assert vmf.brushes == []
+    assert ent not in vmf.by_class['info_target']
+    assert len(vmf.face_id) == 0
+    assert len(vmf.solid_id) == 0
+    assert vmf.ent_id == {vmf.spawn.id}
+
+
+def test_fixup_substitution():
+    """Test substituting $fixup variables."""
+    fixup = EntityFixup()
+    fixup['var'] = 'value'
+    fixup['$var_long'] = 'long'
+    fixup['Bool'] = True
+    assert fixup.substitute('$var') == 'value'
+    assert fixup.substitute('$var_long $VAR $missing') == 'long value $missing'
+    assert fixup.substitute('$bool') == '1'
+    assert fixup.substitute('no vars') == 'no vars'
+
+    # Indexes are reused when removed.
+    del fixup['var']
+    fixup['other'] = 4
+    assert [fix.id for fix in fixup.copy_values()] == [2, 3, 1]
+    assert fixup.substitute('$var $other') == '$var 4'
+
+    vmf = VMF()
+    ent = vmf.create_ent('logic_relay', targetname='$other_relay')
+    ent.add_out(Output('OnTrigger', '$var_long', 'Trigger', '$bool'))
+    fixup.substitute_ents([ent])
+    assert ent['targetname'] == '4_relay'
+    assert ent in vmf.by_target['4_relay']
+    assert ent.outputs[0].target == 'long'
+    assert ent.outputs[0].params == '1'
+
+
+def test_export_key_order():
+    """Test entity keyvalues are exported sorted, even after changes."""
+    vmf = VMF()
+    ent = vmf.create_ent('info_target', origin='0 0 0', angles='0 90 0')
+    text = ent._export_text()
+    assert text.index('"angles"') < text.index('"classname"') < text.index('"origin"')
+
+    ent['basename'] = 'test'
+    ent.keys['zzz'] = '1'
+    del ent['angles']
+    text = ent._export_text()
+    assert '"angles"' not in text
+    assert text.index('"basename"') < text.index('"classname"') < text.index('"zzz"')
+
+
+def test_export_bytes():
+    """Test exporting to bytes matches exporting to text."""
+    vmf = VMF()
+    vmf.add_brush(vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid)
+    vmf.create_ent('info_target', targetname='ünïcode')
+    text = vmf.export(inc_version=False)
+    assert vmf.export(inc_version=False, as_bytes=True) == text.encode('utf8')
+
+
+def test_export_cache():
+    """Test cached exports reuse text, and detect changes."""
+    vmf = VMF()
+    prism = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64))
+    vmf.add_brush(prism.solid)
+    ent = vmf.create_ent('func_detail', targetname='detail')
+    ent.solids.append(vmf.make_prism(Vec(0, 0, 0), Vec(32, 32, 32)).solid)
+    ent.fixup['var'] = 'value'
+
+    text = vmf.export(inc_version=False, use_cache=True)
+    assert vmf.export(inc_version=False) == text
+    assert vmf.export(inc_version=False, use_cache=True) == text
+
+    prism.solid.translate(Vec(0, 0, 16))
+    ent['targetname'] = 'renamed'
+    ent.fixup['var'] = 'other'
+    ent.add_out(Output('OnUser1', '!self', 'Kill'))
+    ent.solids[0].hidden = True
+    ent.solids[0].sides[0].mat = 'tools/toolsskip'
+    ent.solids[0].sides[0].mark_dirty()
+    text = vmf.export(inc_version=False, use_cache=True)
+    assert vmf.export(inc_version=False) == text
+    assert '"renamed"' in text
+    assert '$var other' in text
+    assert 'tools/toolsskip' in text
+
+    ent.solids[0].group_id = 12
+    ent.groups.append(13)
+    text = vmf.export(inc_version=False, use_cache=True)
+    assert vmf.export(inc_version=False) == text
+    assert '"groupid" "12"' in text
+    assert '"groupid" "13"' in text
+
+    ent.editor_color.x = 5
+    ent.visgroup_ids.add(3)
+    prism.solid.editor_color = Vec(1, 2, 3)
+    ent.solids[0].visgroup_ids = [4]
+    text = vmf.export(inc_version=False, use_cache=True)
+    assert vmf.export(inc_version=False) == text
+    assert '"color" "5 ' in text
+    assert '"color" "1 2 3"' in text
+    assert '"visgroupid" "3"' in text
+    assert '"visgroupid" "4"' in text
+
+    # Only reading the colour keeps the cache.
+    color = ent.editor_color
+    assert color == Vec(5, 255, 255)
+    assert ent._export_cache is not None
+    color.y = 7
+    assert ent._export_cache is None
+    text = vmf.export(inc_version=False, use_cache=True)
+    assert vmf.export(inc_version=False) == text
+    assert '"color" "5 7 255"' in text
+
+
+def test_export_parallel():
+    """Test exporting with worker processes matches the serial export."""
+    vmf = VMF()
+    for x in range(0, 512, 64):
+        vmf.add_brush(vmf.make_prism(Vec(x, 0, 0), Vec(x + 64, 64, 64)).solid)
+        ent = vmf.create_ent('func_detail', targetname='detail_{}'.format(x))
+        ent.solids.append(vmf.make_prism(Vec(x, 0, 0), Vec(x + 32, 32, 32)).solid)
+        ent.fixup['var'] = x
+        ent.add_out(Output('OnUser1', '!self', 'Kill', delay=x / 64))
+
+    text = vmf.export(inc_version=False)
+    assert vmf.export(inc_version=False, workers=2) == text
+    for method in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context(method)
+        assert vmf.export(
+            inc_version=False,
+            workers=2,
+            mp_context=context,
+        ) == text
+
+    with pytest.raises(ValueError):
+        vmf.export(use_cache=True, workers=2)
+
+
+def test_parse_geometry_modes(tmpdir):
+    """Test skipping or lazily parsing brushes."""
+    vmf = VMF()
+    vmf.add_brush(vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid)
+    ent = vmf.create_ent('func_detail', targetname='detail')
+    ent.solids.append(vmf.make_prism(Vec(0, 0, 0), Vec(32, 32, 32)).solid)
+    vmf.create_ent('prop_static', model='a.mdl', solid='6')
+    text = vmf.export(inc_version=False)
+    path = tmpdir.join('test.vmf')
+    path.write(text)
+
+    for source in [str(path), Property.parse(text)]:
+        skipped = VMF.parse(source, geometry='skip')
+        assert skipped.brushes == []
+        assert len(skipped.entities) == 2
+        assert skipped.entities[0]['targetname'] == 'detail'
+        assert skipped.entities[0].solids == []
+        assert skipped.entities[1]['solid'] == '6'
+
+    full_text = VMF.parse(str(path)).export(inc_version=False)
+    lazy = VMF.parse(str(path), geometry='lazy')
+    # Side IDs are still reserved.
+    assert len(lazy.face_id) == 12
+    assert lazy.export(inc_version=False) == full_text
+
+    with pytest.raises(ValueError):
+        VMF.parse(str(path), geometry='some')
+
+
+def test_disp_arrays():
+    """Test displacement rows are decoded into arrays, and encoded again."""
+    vmf = VMF()
+    side = Side(vmf, disp_data={
+        'power': '2',
+        'pos': '[0 0 64]',
+        'distances': ['0 1.5 2 0.25 0'] * 5,
+        'alphas': ['0 0 0 0 0'] * 4 + ['255 255 255 255 255'],
+        'triangle_tags': ['9 9 1 9 9 9 0 9'] * 4,
+    })
+    assert side.disp_size == 5
+    assert side.disp_data['distances'][:5] == array('d', [0, 1.5, 2, 0.25, 0])
+    assert side.disp_data['triangle_tags'][:3] == array('i', [9, 9, 1])
+    assert len(side.disp_data['normals']) == 0
+
+    text = side._export_text()
+    assert '"row4" "0 1.5 2 0.25 0"' in text
+    assert '"row3" "9 9 1 9 9 9 0 9"' in text
+    assert 'normals' not in text
+
+    side.disp_smooth_alpha()
+    alphas = side.disp_data['alphas']
+    assert alphas[:5] == array('d', [0.0] * 5)
+    assert alphas[15:20] == array('d', [85.0] * 5)
+    assert alphas[20:] == array('d', [127.5] * 5)
+
+    side.disp_fill_alpha(64.0)
+    assert side.disp_data['alphas'] == array('d', [64.0] * 25)
+    assert '"row2" "64 64 64 64 64"' in side._export_text()
+
+    copy = side.copy()
+    copy.disp_data['alphas'][0] = 12
+    assert side.disp_data['alphas'][0] == 64.0
+
+
+def test_collapse_instances():
+    """Test collapsing func_instance entities."""
+    inst_map = VMF()
+    inst_map.add_brush(inst_map.make_prism(
+        Vec(0, 0, 0), Vec(64, 32, 16), mat='$wall_mat',
+    ).solid)
+    inst_map.create_ent(
+        'func_instance_parms',
+        parm1='$skin integer 2',
+        parm2='$wall_mat material tools/toolsnodraw',
+    )
+    relay = inst_map.create_ent(
+        'logic_relay',
+        targetname='relay',
+        origin='32 0 0',
+    )
+    relay.add_out(Output('OnTrigger', 'prop', 'Skin', '$skin'))
+    relay.add_out(Output('OnTrigger', '@global', 'Trigger'))
+    inst_map.create_ent(
+        'prop_dynamic',
+        targetname='prop',
+        origin='0 0 0',
+        angles='0 0 0',
+        skin='$skin',
+    )
+    filesys = VirtualFileSystem({
+        'instances/test.vmf': inst_map.export(),
+    })
+
+    vmf = VMF()
+    first = vmf.create_ent(
+        'func_instance',
+        targetname='first',
+        file='instances\\test.vmf',
+        origin='128 0 0',
+        angles='0 90 0',
+    )
+    first.fixup['skin'] = '5'
+    first.add_out(Output('OnTrigger', 'button', 'Press', inst_out='relay'))
+    vmf.create_ent(
+        'func_instance',
+        targetname='second',
+        file='instances/test.vmf',
+        origin='0 0 0',
+        angles='0 0 0',
+        fixup_style='1',
+    )
+    button = vmf.create_ent('func_button', targetname='button')
+    button.add_out(Output('OnPressed', 'second', 'Trigger', inst_in='relay'))
+
+    vmf.collapse_instances(filesys)
+    assert not vmf.by_class['func_instance']
+    assert len(vmf.brushes) == 2
+
+    [first_relay] = vmf.by_target['first-relay']
+    assert first_relay['origin'] == '128 32 0'
+    assert [str(out) for out in first_relay.outputs] == [
+        str(Output('OnTrigger', 'first-prop', 'Skin', '5')),
+        str(Output('OnTrigger', '@global', 'Trigger')),
+        str(Output('OnTrigger', 'button', 'Press')),
+    ]
+    [first_prop] = vmf.by_target['first-prop']
+    assert first_prop['angles'] == '0 90 0'
+    assert first_prop['skin'] == '5'
+
+    [second_prop] = vmf.by_target['prop-second']
+    assert second_prop['skin'] == '2'
+    assert button.outputs[0].target == 'relay-second'
+    assert button.outputs[0].inst_in is None
+
+    mats = {side.mat for side in vmf.brushes[0]}
+    assert mats == {'tools/toolsnodraw'}
+
+
+def test_collapse_instances_indexes():
+    """Test the removed instances are removed from the map's indexes."""
+    inst_map = VMF()
+    inst_map.create_ent('info_target', targetname='target', origin='0 0 0')
+    filesys = VirtualFileSystem({
+        'instances/test.vmf': inst_map.export(),
+    })
+
+    vmf = VMF()
+    inst = vmf.create_ent(
+        'func_instance',
+        targetname='inst',
+        file='instances/test.vmf',
+        origin='0 0 0',
+        angles='0 0 0',
+    )
+    button = vmf.create_ent('func_button', targetname='button')
+    button.add_out(Output('OnPressed', 'inst', 'Kill'))
+    inst.groups.append(7)
+    graph = vmf.io_graph()
+    assert graph.targets(button) == {inst}
+    assert vmf.group_members(7) == {inst}
+    region = vmf.extract_region(Vec(-16, -16, -16), Vec(16, 16, 16))
+    assert set(region.by_class) == {'func_instance'}
+
+    vmf.collapse_instances(filesys)
+    assert graph.targets(button) == set()
+    assert graph.dead_outputs() == [(button, button.outputs[0])]
+    assert vmf.group_members(7) == set()
+    assert inst not in vmf._spatial_boxes
+    region = vmf.extract_region(Vec(-16, -16, -16), Vec(16, 16, 16))
+    assert set(region.by_class) == {'info_target'}
+
+
+def test_stamp():
+    """Test stamping copies matches copying and localising each object."""
+    vmf = VMF()
+    prism = vmf.make_prism(Vec(-16, -16, 0), Vec(16, 48, 64))
+    ent = vmf.create_ent(
+        'func_brush',
+        origin='0 16 32',
+        angles='0 45 0',
+        targetname='brush',
+    )
+    ent.solids.append(vmf.make_prism(Vec(0, 0, 0), Vec(32, 32, 32)).solid)
+    overlay = vmf.create_ent(
+        'info_overlay',
+        origin='0 0 0',
+        basisOrigin='0 0 0',
+        basisNormal='0 0 1',
+        basisU='1 0 0',
+        basisV='0 1 0',
+        sides='{} {}'.format(prism.top.id, prism.north.id),
+    )
+
+    transforms = [
+        (Vec(128, 0, 0), Vec(0, 90, 0)),
+        (Vec(0, 0, 64), None),
+    ]
+    ent_count = len(vmf.entities)
+    results = vmf.stamp([prism.solid, ent, overlay], transforms)
+    assert len(results) == 2
+    assert len(vmf.entities) == ent_count + 4
+    assert len(vmf.brushes) == 2
+
+    for (origin, angles), (solid, ent_copy, overlay_copy) in zip(transforms, results):
+        assert solid in vmf.brushes
+        assert solid.id != prism.solid.id
+        expected = prism.solid.copy()
+        expected.localise(origin, angles)
+        assert [side.planes for side in solid] == [
+            side.planes for side in expected
+        ]
+        assert [str(side.uaxis) for side in solid] == [
+            str(side.uaxis) for side in expected
+        ]
+        assert ent_copy.id != ent.id
+        assert ent_copy in vmf.by_target['brush']
+        assert ent_copy.solids[0].id != ent.solids[0].id
+        assert overlay_copy['sides'] == '{} {}'.format(
+            solid.sides[prism.solid.sides.index(prism.top)].id,
+            solid.sides[prism.solid.sides.index(prism.north)].id,
+        )
+
+    assert results[0][1]['origin'] == '112 0 32'
+    assert results[0][1]['angles'] == '0 135 0'
+    assert results[1][1]['origin'] == '0 16 96'
+    assert results[1][1]['angles'] == '0 45 0'
+
+
+def test_brush_vertices():
+    """Test computing the vertices and face polygons of brushes."""
+    vmf = VMF()
+    prism = vmf.make_prism(Vec(0, 0, 0), Vec(64, 32, 16))
+    corners = {
+        (x, y, z)
+        for x in (0, 64)
+        for y in (0, 32)
+        for z in (0, 16)
+    }
+    verts = prism.solid.vertices()
+    assert len(verts) == 8
+    assert {vert.as_tuple() for vert in verts} == corners
+    assert {vert.as_tuple() for vert in prism.top.polygon()} == {
+        (x, y, 16)
+        for x in (0, 64)
+        for y in (0, 32)
+    }
+
+    # Cut off one edge, to make a wedge.
+    prism.east.planes = [Vec(64, 0, 0), Vec(32, 0, 16), Vec(32, 32, 16)]
+    verts = prism.solid.vertices()
+    assert {vert.as_tuple() for vert in verts} == {
+        (x, y, z)
+        for x, z in [(0, 0), (0, 16), (64, 0), (32, 16)]
+        for y in (0, 32)
+    }
+    assert len(prism.east.polygon()) == 4
+
+    # Transforming recomputes the vertices.
+    prism.solid.translate(Vec(0, 0, 64))
+    assert max(vert.z for vert in prism.solid.vertices()) == 80
+
+    with pytest.raises(ValueError):
+        prism.top.copy().polygon()
+
+
+def test_compact_storage():
+    """Test entities and brushes share default values, but can still be modified."""
+    vmf = VMF()
+    first = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    second = vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid
+    vmf.add_brushes([first, second])
+    ent = vmf.create_ent('info_target', targetname='target')
+    other = vmf.create_ent('info_target', targetname='other')
+    for obj in [first, ent]:
+        assert not hasattr(obj, '__dict__')
+    # Weak references are still allowed.
+    for obj in [first, first.sides[0], ent]:
+        assert weakref.ref(obj)() is obj
+    assert first._visgroup_ids is second._visgroup_ids
+    assert first._editor_color is second._editor_color
+    assert ent._visgroup_ids is other._visgroup_ids
+    text = vmf.export(inc_version=False)
+
+    first.visgroup_ids.add(4)
+    first.editor_color.x = 0
+    ent.visgroup_ids.add(4)
+    ent.editor_color = Vec(0, 128, 255)
+    assert second.visgroup_ids == other.visgroup_ids == set()
+    assert second.editor_color == other.editor_color == Vec(255, 255, 255)
+    assert first.visgroup_ids == ent.visgroup_ids == {4}
+    assert first.editor_color == Vec(0, 255, 255)
+    assert ent.editor_color == Vec(0, 128, 255)
+
+    first.visgroup_ids.clear()
+    first.editor_color = (255, 255, 255)
+    ent.visgroup_ids = ()
+    ent.editor_color = Vec(255, 255, 255)
+    assert vmf.export(inc_version=False) == text
+
+    # Shared values are released once nothing uses them.
+    brush = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    brush.editor_color = Vec(1, 2, 3)
+    brush.visgroup_ids = [1, 2, 3]
+    brush.copy()
+    assert (1.0, 2.0, 3.0) in vmf_mod._SHARED_VALUES
+    assert frozenset({1, 2, 3}) in vmf_mod._SHARED_VALUES
+    del brush
+    gc.collect()
+    assert (1.0, 2.0, 3.0) not in vmf_mod._SHARED_VALUES
+    assert frozenset({1, 2, 3}) not in vmf_mod._SHARED_VALUES
+
+
+def test_material_index():
+    """Test the material index is kept up to date."""
+    vmf = VMF()
+    first = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    second = vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid
+    first.sides[0].mat = 'Tools/ToolsSkip'
+    vmf.add_brush(first)
+    ent = vmf.create_ent('func_detail')
+    ent.solids.append(second)
+
+    # Built here, so it includes the brush entity.
+    assert vmf.material_usage() == {
+        'tools/toolsnodraw': 11,
+        'tools/toolsskip': 1,
+    }
+    assert vmf.sides_with_material('TOOLS/TOOLSSKIP') == {first.sides[0]}
+
+    assert vmf.replace_material('tools/toolsnodraw', 'dev/dev_measuregeneric01') == 11
+    assert all(side.mat == 'dev/dev_measuregeneric01' for side in second)
+    second.sides[1].mat = 'tools/toolsskip'
+    assert vmf.material_usage() == {
+        'dev/dev_measuregeneric01': 10,
+        'tools/toolsskip': 2,
+    }
+
+    # Removed or unadded brushes aren't counted.
+    vmf.remove_ent(ent)
+    first.sides = first.sides[:3]
+    vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64))
+    assert vmf.material_usage() == {
+        'dev/dev_measuregeneric01': 2,
+        'tools/toolsskip': 1,
+    }
+    second.sides[2].mat = 'tools/toolsskip'
+    assert vmf.sides_with_material('tools/toolsskip') == {first.sides[0]}
+    vmf.add_ent(ent)
+    assert vmf.material_usage() == {
+        'dev/dev_measuregeneric01': 6,
+        'tools/toolsskip': 3,
+    }
+
+
+def test_io_graph():
+    """Test following entity outputs."""
+    vmf = VMF()
+    relay = vmf.create_ent('logic_relay', targetname='relay')
+    branch = vmf.create_ent('logic_branch', targetname='Branch_1')
+    counter = vmf.create_ent('math_counter', targetname='counter')
+    lonely = vmf.create_ent('info_target', targetname='lonely')
+    relay.add_out(
+        Output('OnTrigger', 'branch_*', 'Test'),
+        Output('OnTrigger', '!activator', 'Kill'),
+        Output('OnTrigger', 'missing', 'Kill'),
+    )
+    branch.add_out(Output('OnTrue', 'counter', 'Add', '1'))
+    counter.add_out(Output('OnHitMax', 'RELAY', 'Trigger'))
+    lonely.add_out(Output('OnUser1', '!self', 'FireUser1'))
+
+    graph = vmf.io_graph()
+    assert graph.targets(relay) == {branch}
+    assert graph.reachable(branch) == {counter, relay, branch}
+    assert graph.reachable(lonely) == {lonely}
+    assert graph.dead_outputs() == [(relay, relay.outputs[2])]
+    assert sorted(map(set, graph.cycles()), key=len) == [
+        {lonely},
+        {relay, branch, counter},
+    ]
+
+    # Changes are picked up.
+    missing = vmf.create_ent('info_target', targetname='missing')
+    branch['targetname'] = 'other'
+    counter.outputs.clear()
+    counter.mark_dirty()
+    assert vmf.io_graph() is graph
+    assert graph.dead_outputs() == [(relay, relay.outputs[0])]
+    assert graph.reachable(relay) == {missing}
+    assert graph.cycles() == [[lonely]]
+    vmf.remove_ent(missing)
+    assert graph.targets(relay) == set()
+    branch['targetname'] = 'branch_2'
+    assert graph.targets(relay) == {branch}
+    # Classnames are used if no names match.
+    counter.add_out(Output('OnHitMin', 'logic_relay', 'Trigger'))
+    assert graph.targets(counter) == {relay}
+
+
+def test_visgroup_index():
+    """Test visgroup and group members are tracked."""
+    vmf = VMF()
+    vis = vmf.create_visgroup('Group')
+    world = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    detail = vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid
+    world.visgroup_ids.add(vis.id)
+    detail.visgroup_ids.add(vis.id)
+    detail.group_id = 4
+    vmf.add_brush(world)
+    ent = vmf.create_ent('func_detail')
+    ent.solids.append(detail)
+    ent.groups.append(4)
+    target = vmf.create_ent('info_target')
+    target.visgroup_ids = [vis.id, 8]
+
+    assert set(vis.child_solids()) == {world, detail}
+    assert set(vis.child_ents()) == {target}
+    assert vmf.group_members(4) == {ent, detail}
+
+    world.visgroup_ids.discard(vis.id)
+    ent.visgroup_ids |= {vis.id}
+    target.visgroup_ids.clear()
+    detail.group_id = None
+    assert vmf.visgroup_members(vis.id) == {detail, ent}
+    assert vmf.visgroup_members(8) == set()
+    assert vmf.group_members(4) == {ent}
+    ent.groups.clear()
+    assert vmf.group_members(4) == set()
+
+    vis.set_visible(False)
+    assert not detail.vis_shown and not ent.vis_shown and world.vis_shown
+    vmf.remove_ent(ent)
+    assert vmf.visgroup_members(vis.id) == set()
+    vmf.add_ent(ent)
+    assert vmf.visgroup_members(vis.id) == {detail, ent}
+
+    ent.groups.append(4)
+    copy = ent.copy()
+    vmf.add_ent(copy)
+    assert vmf.group_members(4) == {ent, copy}
+
+
+def test_binary_cache(tmpdir):
+    """Test saving and loading cached maps."""
+    vmf = VMF()
+    vis = vmf.create_visgroup('Group')
+    brush = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    brush.visgroup_ids.add(vis.id)
+    brush.sides[0] = Side(vmf, brush.sides[0].planes, disp_data={
+        'power': '2',
+        'pos': '[0 0 64]',
+        'distances': ['0 1.5 2 0.25 0'] * 5,
+    })
+    vmf.add_brush(brush)
+    ent = vmf.create_ent('func_detail', targetname='detail')
+    ent.solids.append(vmf.make_prism(Vec(0, 0, 0), Vec(32, 32, 32)).solid)
+    ent.groups.append(4)
+    ent.fixup['var'] = 'ünïcode'
+    ent.add_out(
+        Output('OnUser1', 'relay', 'Trigger', delay=0.5, only_once=True),
+        Output('OnProxy', 'inst', 'Kill', inst_out='out', inst_in='in'),
+    )
+    path = tmpdir.join('test.vmf')
+    path.write(vmf.export(inc_version=False))
+    text = VMF.parse(str(path)).export(inc_version=False)
+
+    assert VMF.load_cache(str(path)).export(inc_version=False) == text
+    assert tmpdir.join('test.vmf.cache').check()
+    cached = VMF.load_cache(str(path))
+    assert cached.export(inc_version=False) == text
+    assert cached.by_target['detail'] == {cached.entities[0]}
+    # IDs are still reserved.
+    solid_ids = {solid.id for solid in cached.brushes}
+    assert cached.make_prism(Vec(), Vec(8, 8, 8)).solid.id not in solid_ids
+
+    # Changed files are parsed again.
+    path.write(text.replace('"detail"', '"other"'))
+    assert VMF.load_cache(str(path)).entities[0]['targetname'] == 'other'
+    tmpdir.join('test.vmf.cache').write(b'VMFCACH2 broken', mode='wb')
+    assert VMF.load_cache(str(path)).entities[0]['targetname'] == 'other'
+
+
+def test_merge(tmpdir):
+    """Test merging maps together."""
+    section = VMF()
+    vis = section.create_visgroup('Section')
+    brush = section.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    brush.visgroup_ids.add(vis.id)
+    brush.group_id = 2
+    section.add_brush(brush)
+    section.create_ent(
+        'info_overlay',
+        targetname='overlay',
+        sides=' '.join([str(side.id) for side in brush.sides[:2]]),
+    ).groups.append(2)
+    path = tmpdir.join('section.vmf')
+    path.write(section.export(inc_version=False))
+
+    for remap in ['offset', 'compact']:
+        vmf = VMF()
+        vmf.create_ent('info_target', targetname='target')
+        vmf.add_brush(vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid)
+        vmf.merge([VMF.parse(str(path)), str(path)], remap=remap)
+
+        assert len(vmf.brushes) == 3
+        assert len(vmf.by_target['overlay']) == 2
+        assert len(vmf.vis_tree) == 2
+        assert len({solid.id for solid in vmf.brushes}) == 3
+        assert len({side.id for solid in vmf.brushes for side in solid}) == 18
+        assert len({ent.id for ent in vmf.entities}) == 3
+        for vis, brush in zip(vmf.vis_tree, vmf.brushes[1:]):
+            assert brush.visgroup_ids == {vis.id}
+        overlays = sorted(vmf.by_class['info_overlay'], key=lambda ent: ent.id)
+        for overlay, brush in zip(overlays, vmf.brushes[1:]):
+            assert overlay.groups == [brush.group_id]
+            assert overlay['sides'] == '{} {}'.format(
+                brush.sides[0].id,
+                brush.sides[1].id,
+            )
+    assert vmf.brushes[1].id == 2
+
+    vmf = VMF()
+    vmf.merge([str(path)] * 3, workers=2)
+    assert len(vmf.brushes) == 3
+    with pytest.raises(ValueError):
+        vmf.merge([], remap='other')
+
+    # Merge into a copy of itself, so the groups are already in use.
+    for remap in ['offset', 'compact']:
+        vmf = VMF.parse(str(path))
+        vmf.merge([str(path)], remap=remap)
+        first, second = vmf.brushes
+        assert first.group_id == 2
+        assert second.group_id not in (None, 2)
+        overlays = sorted(vmf.by_class['info_overlay'], key=lambda ent: ent.id)
+        assert [ent.groups for ent in overlays] == [[2], [second.group_id]]
+
+
+def test_snapshot():
+    """Test rolling back changes with snapshots."""
+    vmf = VMF()
+    brush = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    other = vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid
+    vmf.add_brushes([brush, other])
+    ent = vmf.create_ent('info_target', targetname='target', origin='0 0 0')
+    text = vmf.export(inc_version=False)
+
+    snap = vmf.snapshot()
+    translate_solids([brush], Vec(0, 0, 16))
+    brush.sides[0].mat = 'tools/toolsskip'
+    brush.visgroup_ids.add(3)
+    vmf.remove_brush(other)
+    ent['targetname'] = 'renamed'
+    ent.add_out(Output('OnUser1', '!self', 'Kill'))
+    snap.save(ent)
+    ent.fixup['var'] = 'value'
+    vmf.create_ent('info_null')
+    # Only modified objects are copied.
+    assert set(snap._saved) == {brush, ent} | set(brush.sides)
+    assert vmf.export(inc_version=False) != text
+    snap.discard()
+
+    assert vmf.export(inc_version=False) == text
+    assert vmf.by_target['target'] == {ent}
+    assert not vmf.by_target['renamed']
+    assert vmf.sides_with_material('tools/toolsskip') == set()
+    assert vmf.make_prism(Vec(), Vec(8, 8, 8)).solid.id == 3
+    with pytest.raises(ValueError):
+        snap.commit()
+
+    with vmf.snapshot():
+        ent['targetname'] = 'kept'
+        with pytest.raises(KeyError):
+            with vmf.snapshot():
+                ent['targetname'] = 'discarded'
+                raise KeyError
+        assert ent['targetname'] == 'kept'
+    assert ent['targetname'] == 'kept'
+    assert vmf._snapshots == []
+
+    # Nothing is copied up front, and reading doesn't save objects.
+    text = vmf.export(inc_version=False)
+    mats = vmf.material_usage()
+    with pytest.raises(KeyError):
+        with vmf.snapshot() as snap:
+            assert snap._undo == []
+            assert brush.visgroup_ids == set()
+            assert ent.editor_color == Vec(255, 255, 255)
+            assert ent.groups == []
+            assert snap._saved == {}
+            vmf.remove_ent(ent)
+            vmf.add_ent(ent)
+            vmf.add_brush(vmf.make_prism(Vec(), Vec(8, 8, 8)).solid)
+            vmf.create_visgroup('group')
+            with vmf.snapshot():
+                vmf.remove_brush(brush)
+                vmf.clear()
+            # The inner snapshot was committed, so this is undone too.
+            assert vmf.brushes == []
+            raise KeyError
+    assert vmf.brushes == [brush, other]
+    assert vmf.entities == [ent]
+    assert vmf.vis_tree == []
+    assert vmf.by_class['info_target'] == {ent}
+    assert vmf.material_usage() == mats
+    assert vmf.export(inc_version=False) == text
+
+
+def test_extract_region():
+    """Test copying part of a map."""
+    vmf = VMF()
+    inside = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid
+    crossing = vmf.make_prism(Vec(96, 0, 0), Vec(256, 64, 64)).solid
+    outside = vmf.make_prism(Vec(1024, 0, 0), Vec(1088, 64, 64)).solid
+    vmf.add_brushes([inside, crossing, outside])
+    door = vmf.create_ent('func_door', targetname='door')
+    door.solids = [
+        vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid,
+        vmf.make_prism(Vec(0, 0, 1024), Vec(64, 64, 1088)).solid,
+    ]
+    vmf.create_ent('info_target', targetname='in', origin='32 32 32')
+    target = vmf.create_ent('info_target', targetname='out', origin='512 0 0')
+    vmf.create_ent(
+        'info_overlay',
+        origin='0 0 64',
+        sides='{} {}'.format(inside.sides[1].id, outside.sides[1].id),
+    )
+
+    region = vmf.extract_region(Vec(0, 0, 0), Vec(128, 128, 128))
+    assert len(region.brushes) == 2
+    assert {ent['targetname'] for ent in region.entities} == {'door', 'in', ''}
+    [region_door] = region.by_target['door']
+    assert len(region_door.solids) == 1
+    [overlay] = region.by_class['info_overlay']
+    assert overlay['sides'] == str(region.brushes[0].sides[1].id)
+    assert region.brushes[0].id == 1
+
+    # Changes are picked up by the index.
+    outside.translate(Vec(-1024, 0, 0))
+    target['origin'] = '64 64 64'
+    region = vmf.extract_region(Vec(0, 0, 0), Vec(128, 128, 128))
+    assert len(region.brushes) == 3
+    assert len(region.by_target['out']) == 1
+
+    region = vmf.extract_region(
+        Vec(0, 0, 0), Vec(128, 128, 128),
+        clip=True,
+        seal=True,
+    )
+    assert len(region.brushes) == 3 + 6
+    assert max(point.x for point in region.brushes[1].vertices()) == 128
+    assert len(region.brushes[1].sides) == 6
+
+
+@pytest.mark.parametrize('funcs', parse_parms, ids=parse_ids)
+def test_parse_side_values(funcs):
+    """Test the Python and Cython functions for parsing sides."""
+    read_block, parse_plane, parse_uv_axis, parse_side = funcs
+    block = Property('side', [
+        Property('id', '1'),
+        Property('Material', 'tools/toolsnodraw'),
+        Property('id', '2'),
+    ])
+    assert read_block(block) == {'id': '2', 'material': 'tools/toolsnodraw'}
+
+    assert parse_plane('(0 -1.5 2) (3e2 4 5) (6 7 8.25)') == [
+        (0.0, -1.5, 2.0),
+        (300.0, 4.0, 5.0),
+        (6.0, 7.0, 8.25),
+    ]
+    with pytest.raises(ValueError):
+        parse_plane('(0 0 0) (1 1 1)')
+    with pytest.raises(ValueError):
+        parse_plane('(0 0 0) (1 1 1) (2 2)')
+    with pytest.raises(ValueError):
+        parse_plane('(0 0 0) (1 1 1) (2 2 two)')
+    # Both versions accept the same spacing.
+    for plane in [
+        '(0  0 0) (1 1 1) (2 2 2)',
+        '(0 0 0)(1 1 1)(2 2 2)',
+        '(0 0 0) (1 1 1) (2 2 2) ',
+        ' ( 0\t0 0 ) (1 1 1) (2 2 2)',
+    ]:
+        assert parse_plane(plane) == [(0, 0, 0), (1, 1, 1), (2, 2, 2)]
+    for plane in [
+        '(0_0 0 0) (1 1 1) (2 2 2)',
+        '(00 0) (1 1 1) (2 2 2)',
+        '(0 0 0) (1 1 1) (2 2 2) (3 3 3)',
+        '(0 0 0) (1 1 1) (2 2 inf)',
+        '(0 0 0) (1 1 1) (2 2 2-)',
+    ]:
+        with pytest.raises(ValueError):
+            parse_plane(plane)
+
+    assert parse_uv_axis('[1 0 0 -16] 0.25') == (1.0, 0.0, 0.0, -16.0, 0.25)
+    for axis in [
+        '[1 0 0 0 ] 0.25',
+        '[1 0 0 0]0.25',
+        ' [ 1\t0 0 0 ]  0.25 ',
+        '1 0 0 0 0.25',
+    ]:
+        assert parse_uv_axis(axis) == (1.0, 0.0, 0.0, 0.0, 0.25)
+    for axis in [
+        '[1 0 zero -16] 0.25',
+        '[1 0 0 0]',
+        '[1 0 0 0] 0.25 1',
+        '[1 0 0 00.25',
+        '[1 0 0_0 0] 0.25',
+    ]:
+        with pytest.raises(ValueError):
+            parse_uv_axis(axis)
+
+    vmf = VMF()
+    side = parse_side(vmf, Property('side', [
+        Property('id', '4'),
+        Property('plane', '(0 0 64) (64 0 64) (64 -64 64)'),
+        Property('material', 'tools/toolsskip'),
+        Property('uaxis', '[1 0 0 16] 0.25'),
+        Property('vaxis', '[0 -1 0 -8] 0.5'),
+        Property('rotation', '90'),
+        Property('lightmapscale', '32'),
+        Property('smoothing_groups', '0'),
+    ]))
+    assert side.id == 4 and side.map is vmf
+    assert side.planes == [Vec(0, 0, 64), Vec(64, 0, 64), Vec(64, -64, 64)]
+    assert side.normal() == Vec(0, 0, -1)
+    assert side.mat == 'tools/toolsskip'
+    assert side.uaxis.vec() == (1, 0, 0) and side.uaxis.offset == 16
+    assert side.vaxis.vec() == (0, -1, 0) and side.vaxis.scale == 0.5
+    assert (side.ham_rot, side.lightmap, side.smooth) == (90.0, 32, 0)
+    assert not side.is_disp
+    # The ID is used, so the next side gets a new one.
+    assert parse_side(vmf, Property('side', [Property('id', '4')])).id != 4
+
+
+def test_cached_geometry():
+    """Test the normal and bounding boxes are updated when brushes change."""
+    vmf = VMF()
+    prism = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64))
+    brush = prism.solid
+    assert brush.get_bbox() == (Vec(0, 0, 0), Vec(64, 64, 64))
+    assert prism.top.normal() == Vec(0, 0, -1)
+
+    # Modifying the results doesn't change the cache.
+    brush.get_bbox()[0].x = 32
+    prism.top.normal().z = 1
+    assert brush.get_bbox() == (Vec(0, 0, 0), Vec(64, 64, 64))
+    assert prism.top.normal() == Vec(0, 0, -1)
+
+    brush.translate(Vec(16, 0, 0))
+    assert brush.get_bbox() == (Vec(16, 0, 0), Vec(80, 64, 64))
+    assert prism.top.get_bbox() == (Vec(16, 0, 64), Vec(80, 64, 64))
+
+    brush.localise(Vec(), Vec(180, 0, 0))
+    assert prism.top.normal() == Vec(0, 0, 1)
+    assert brush.get_bbox() == (Vec(-80, 0, -64), Vec(-16, 64, 0))
+
+    prism.top.planes = [Vec(0, 0, 128), Vec(64, 0, 128), Vec(64, 64, 128)]
+    assert brush.get_bbox()[1].z == 128
+    prism.top.planes[0].z = 256
+    prism.top.mark_dirty()
+    assert brush.get_bbox()[1].z == 256
+
+    brush.sides = brush.sides[1:]
+    assert brush.get_bbox()[0].z == -64
+
+    # Replacing a point is detected.
+    prism = vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64))
+    assert prism.top.normal() == Vec(0, 0, -1)
+    prism.top.planes[1] = prism.top.planes[1] + (0, 0, 64)
+    assert prism.top.normal() != Vec(0, 0, -1)
+    assert prism.solid.get_bbox()[1].z == 128
+
+    # Entity boxes are cached, and updated when the brushes move.
+    ent = vmf.create_ent('func_detail')
+    ent.solids.append(vmf.make_prism(Vec(0, 0, 0), Vec(32, 32, 32)).solid)
+    assert ent.get_bbox() == (Vec(0, 0, 0), Vec(32, 32, 32))
+    assert ent.get_bbox() == ent.get_bbox()
+    ent.get_origin().x = 1000
+    assert ent.get_origin() == Vec(16, 16, 16)
+    ent.solids[0].translate(Vec(0, 0, 32))
+    assert ent.get_bbox() == (Vec(0, 0, 32), Vec(32, 32, 64))
+    ent.solids.append(vmf.make_prism(Vec(-32, 0, 0), Vec(0, 32, 32)).solid)
+    assert ent.get_bbox() == (Vec(-32, 0, 0), Vec(32, 32, 64))
+    ent.solids[1].sides[0].planes[0].x = -64
+    ent.solids[1].sides[0].mark_dirty()
+    assert ent.get_bbox()[0].x == -64
+
+    point = vmf.create_ent('info_target', origin='1 2 3')
+    assert point.get_bbox() == (Vec(1, 2, 3), Vec(1, 2, 3))
+    point['origin'] = '4 5 6'
+    assert point.get_origin() == Vec(4, 5, 6)
+
+
+def test_pickle():
+    """Test pickling maps."""
+    vmf = VMF()
+    vmf.add_brush(vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid)
+    door = vmf.create_ent('func_door', targetname='door')
+    door.solids.append(vmf.make_prism(Vec(0, 0, 64), Vec(64, 64, 128)).solid)
+    door.add_out(Output('OnOpen', 'door', 'Close', delay=2.5))
+    door.fixup['var'] = 'value'
+    # Not exported without any cordons, but still kept.
+    vmf.cordon_enabled = True
+
+    copy = pickle.loads(pickle.dumps(vmf))
+    assert copy.export(inc_version=False) == vmf.export(inc_version=False)
+    assert copy.cordon_enabled
+    [door_copy] = copy.by_target['door']
+    assert door_copy.map is copy
+    assert door_copy.fixup['var'] == 'value'
+    [brush] = door_copy.solids
+    assert brush.map is copy
+    for side in brush.sides:
+        assert side.map is copy
+        assert side._solid is brush
+    assert copy.spawn.solids is copy.brushes
+    assert copy.sides_with_material('tools/toolsnodraw') == {
+        side for solid in copy.brushes + door_copy.solids for side in solid
+    }
+
+    # Objects pickled with their map refer to the copies in it.
+    world = vmf.brushes[0]
+    loose = vmf.create_ent('info_null')
+    vmf.remove_ent(loose)
+    copy, door_copy, world_copy, side_copy, loose_copy = pickle.loads(
+        pickle.dumps((vmf, door, world, world.sides[2], loose))
+    )
+    assert door_copy in copy.entities
+    assert door_copy.solids[0].sides[0].mat == door.solids[0].sides[0].mat
+    assert world_copy is copy.brushes[0]
+    assert side_copy is world_copy.sides[2]
+    # Not in the map, so this is copied.
+    assert loose_copy not in copy.entities
+    assert loose_copy.map is copy
+    assert loose_copy['classname'] == 'info_null'
+    # The positions are rechecked after the map changes.
+    vmf.remove_ent(door)
+    vmf.add_ent(loose)
+    copy, loose_copy = pickle.loads(pickle.dumps((vmf, loose)))
+    assert copy.entities == [loose_copy]
+
+
+def test_parse_async(tmpdir):
+    """Test parsing maps in an executor."""
+    vmf = VMF()
+    vmf.add_brush(vmf.make_prism(Vec(0, 0, 0), Vec(64, 64, 64)).solid)
+    vmf.create_ent('info_target', targetname='target')
+    path = tmpdir.join('map.vmf')
+    path.write(vmf.export(inc_version=False))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        copy, lazy = loop.run_until_complete(asyncio.gather(
+            VMF.parse_async(str(path)),
+            VMF.parse_async(str(path), geometry='lazy'),
+        ))
+        with ProcessPoolExecutor(1) as executor:
+            with pytest.raises(ValueError):
+                VMF.parse_async(str(path), executor, geometry='lazy')
+            with pytest.raises(ValueError):
+                VMF.parse_async(str(path), executor, preserve_ids=True)
+            with open(str(path)) as file, pytest.raises(ValueError):
+                VMF.parse_async(file, executor)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    text = VMF.parse(str(path)).export(inc_version=False)
+    assert copy.export(inc_version=False) == text
+    assert lazy.export(inc_version=False) == text
+
+
+def test_localise_uv_axes():
+    """Test localising many texture axes at once matches rotating each."""
+    axes = [
+        UVAxis(1, 0, 0, 12, 0.25),
+        UVAxis(0, -1, 0, -1000, 0.5),
+        UVAxis(0, 0.707107, 0.707107, 512.5, 1),
+    ]
+    origin = Vec(64, -320, 1016)
+    for angles in [Vec(0, 90, 0), Vec(45, 30, -60), None]:
+        new_axes = localise_uv_axes(axes, origin, angles)
+        for axis, new_axis in zip(axes, new_axes):
+            vec = axis.vec()
+            if angles is not None:
+                vec.rotate(*angles)
+            else:
+                vec = Vec(round(vec.x, 3), round(vec.y, 3), round(vec.z, 3))
+            offset = axis.offset - origin.dot(vec) / axis.scale
+            assert new_axis.vec() == vec
+            assert new_axis.offset == pytest.approx((offset + 1024) % 2048 - 1024)
+            assert -1024 <= new_axis.offset < 1024
+            assert new_axis.scale == axis.scale
+            if angles is not None:
+                assert axis.localise(origin, angles).offset == new_axis.offset
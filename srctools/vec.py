@@ -305,13 +305,14 @@ class Vec:
         self.y = (x * d) + (y * e) + (z * f)
         self.z = (x * g) + (y * h) + (z * i)
 
-    def rotate(self, pitch=0.0, yaw=0.0, roll=0.0, round_vals=True) -> 'Vec':
-        """Rotate a vector by a Source rotational angle.
-        Returns the vector, so you can use it in the form
-        val = Vec(0,1,0).rotate(p, y, r)
+    @staticmethod
+    def rotation_matrix(pitch=0.0, yaw=0.0, roll=0.0) -> Tuple[float, ...]:
+        """Compute the rotation matrix for a Source rotational angle.
 
-        If round is True, all values will be rounded to 3 decimals
-        (since these calculations always have small inprecision.)
+        This combines the roll, pitch and yaw rotations done by Vec.rotate()
+        into a single 9-tuple, suitable for Vec.mat_mul(). Use this when
+        rotating many vectors by the same angles, to avoid recomputing the
+        trigonometry each time.
         """
         # pitch is in the y axis
         # yaw is the z axis
@@ -328,32 +329,47 @@ class Vec:
         sin_y = math.sin(rad_yaw)
         sin_r = math.sin(rad_roll)
 
-        mat_roll = (  # X
-            1, 0, 0,
-            0, cos_r, -sin_r,
-            0, sin_r, cos_r,
-        )
-        mat_yaw = (  # Z
-            cos_y, -sin_y, 0,
-            sin_y, cos_y, 0,
-            0, 0, 1,
+        # This is yaw * pitch * roll, so transformations are applied
+        # in roll, pitch, yaw order.
+        return (
+            cos_y * cos_p,
+            cos_y * sin_p * sin_r - sin_y * cos_r,
+            cos_y * sin_p * cos_r + sin_y * sin_r,
+
+            sin_y * cos_p,
+            sin_y * sin_p * sin_r + cos_y * cos_r,
+            sin_y * sin_p * cos_r - cos_y * sin_r,
+
+            -sin_p,
+            cos_p * sin_r,
+            cos_p * cos_r,
         )
 
-        mat_pitch = (  # Y
-            cos_p, 0, sin_p,
-            0, 1, 0,
-            -sin_p, 0, cos_p,
+    def rotate(self, pitch=0.0, yaw=0.0, roll=0.0, round_vals=True) -> 'Vec':
+        """Rotate a vector by a Source rotational angle.
+        Returns the vector, so you can use it in the form
+        val = Vec(0,1,0).rotate(p, y, r)
+
+        If round is True, all values will be rounded to 3 decimals
+        (since these calculations always have small inprecision.)
+        """
+        return self.rotate_mat(
+            Vec.rotation_matrix(pitch, yaw, roll),
+            round_vals,
         )
 
-        # Need to do transformations in roll, pitch, yaw order
-        self.mat_mul(mat_roll)
-        self.mat_mul(mat_pitch)
-        self.mat_mul(mat_yaw)
+    def rotate_mat(self, matrix, round_vals=True) -> 'Vec':
+        """Rotate a vector by a matrix from Vec.rotation_matrix().
+
+        This is equivalent to Vec.rotate(), but allows reusing the matrix.
+        """
+        self.mat_mul(matrix)
 
         if round_vals:
-            self.x = round(self.x, 3)
-            self.y = round(self.y, 3)
-            self.z = round(self.z, 3)
+            # Add zero, so -0 becomes 0.
+            self.x = round(self.x, 3) + 0.0
+            self.y = round(self.y, 3) + 0.0
+            self.z = round(self.z, 3) + 0.0
 
         return self
 
@@ -2,24 +2,63 @@
 Wraps property_parser tree in a set of classes which smartly handle
 specifics of VMF files.
 """
+import asyncio
+import functools
+import hashlib
+import heapq
 import io
 import itertools
+import math
+import multiprocessing
 import operator
+import os
+import re
+import struct
+import sys
+import weakref
+from array import array
 from collections import defaultdict, namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor
 from contextlib import suppress
 
 from typing import (
     Optional, Union, Any,
-    Dict, List, Tuple, Set, Iterable, Iterator
+    Dict, List, Tuple, Set, FrozenSet, Iterable, Iterator
 )
 
 from srctools import Property, BOOL_LOOKUP, Vec, EmptyMapping
+from srctools.filesys import FileSystem
+from srctools.property_parser import _get_loop
 import srctools
 
 # Used to set the defaults for versioninfo
 CURRENT_HAMMER_VERSION = 400
 CURRENT_HAMMER_BUILD = 5304
 
+# For lazily parsed files, this keyvalue replaces the sides of brushes.
+# It holds the index of their text.
+_LAZY_SIDES_KEY = '__lazy_sides'
+_LAZY_SIDE_ID = re.compile(r'^\s*"id"\s+"(-?[0-9]+)"', re.MULTILINE)
+
+# The syntax of plane and UV axis values, shared with _vmf.pyx. Spaces or
+# tabs are allowed anywhere between the values, but are required between
+# numbers. Numbers are runs of these characters which float() accepts.
+_NUM_SYNTAX = r'([-+.0-9eE]+)'
+_PLANE_SYNTAX = re.compile(3 * (
+    r'[ \t]*\([ \t]*' +
+    _NUM_SYNTAX + r'[ \t]+' +
+    _NUM_SYNTAX + r'[ \t]+' +
+    _NUM_SYNTAX + r'[ \t]*\)'
+) + r'[ \t]*')
+_UV_AXIS_SYNTAX = re.compile(
+    r'[ \t]*\[?[ \t]*' +
+    _NUM_SYNTAX + r'[ \t]+' +
+    _NUM_SYNTAX + r'[ \t]+' +
+    _NUM_SYNTAX + r'[ \t]+' +
+    _NUM_SYNTAX + r'(?:[ \t]*\][ \t]*|[ \t]+)' +
+    _NUM_SYNTAX + r'[ \t]*'
+)
+
 # all the rows that displacements have, in the form
 # "row0" "???"
 # "row1" "???"
@@ -32,6 +71,79 @@ _DISP_ROWS = (
     'alphas',
     'triangle_tags',
 )
+# For each row type, the array typecode, the number of values for each
+# vertex (or quad), and whether there is a row per vertex (or per quad).
+_DISP_ROW_TYPES = {
+    'normals': ('d', 3, True),
+    'distances': ('d', 1, True),
+    'offsets': ('d', 3, True),
+    'offset_normals': ('d', 3, True),
+    'alphas': ('d', 1, True),
+    'triangle_tags': ('i', 2, False),
+}
+
+# Keyvalues containing entity names, which are fixed up in instances.
+_INSTANCE_NAME_KEYS = {
+    'targetname',
+    'parentname',
+    'target',
+    'filtername',
+    'damagefilter',
+}
+# Keyvalues containing lists of brush face IDs.
+_SIDE_LIST_KEYS = ('sides', 'sides2')
+
+
+
+class _SharedSet(frozenset):
+    """A visgroup set shared by several solids or entities."""
+    __slots__ = ()
+
+    def __reduce__(self):
+        return _shared, (frozenset(self),)
+
+
+class _SharedColor:
+    """An editor colour shared by several solids or entities.
+
+    Tuples can't be weakly referenced, so this wraps one.
+    """
+    __slots__ = ['_values', '__weakref__']
+
+    def __init__(self, values: Iterable[float]):
+        self._values = tuple(values)
+
+    def __iter__(self) -> Iterator[float]:
+        return iter(self._values)
+
+    def __reduce__(self):
+        return _shared, (self._values,)
+
+
+# Solids and entities share identical visgroup sets and colours, instead of
+# each having a copy. These are converted to a set or Vec when accessed.
+# Values are only kept while something uses them.
+_NO_VISGROUPS = _SharedSet()
+_SHARED_VALUES = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+_SHARED_VALUES[frozenset()] = _NO_VISGROUPS
+
+
+def _shared(value: Union[frozenset, tuple]) -> Union[_SharedSet, _SharedColor]:
+    """Return the shared copy of an immutable set or tuple."""
+    try:
+        return _SHARED_VALUES[value]
+    except KeyError:
+        pass
+    if isinstance(value, frozenset):
+        key = frozenset(value)
+        shared = _SharedSet(value)
+    else:
+        key = tuple(value)
+        shared = _SharedColor(value)
+    # The key must be a separate object, or the value would be kept alive.
+    _SHARED_VALUES[key] = shared
+    return shared
+
 
 # Return value for VMF.make_prism()
 PrismFace = namedtuple(
@@ -42,33 +154,150 @@ PrismFace = namedtuple(
 # The character used to separate output values.
 OUTPUT_SEP = chr(27)
 
+# Formats for the plane keyvalue in brush sides (filled in with the 9
+# coordinates), UV axes and vectors.
+# :g strips the .0 off of floats if it's an integer.
+_PLANE_FORMAT = '"plane" "(%g %g %g) (%g %g %g) (%g %g %g)"\n'
+_UV_FORMAT = '[%g %g %g %g] %g'
+_VEC_FORMAT = '%g %g %g'
+# The half-size of the initial polygon for each face, when computing brush
+# polygons. This is larger than the maximum map size.
+_WINDING_SIZE = 131072.0
+# Points this close to a plane are treated as on the plane.
+_CLIP_EPSILON = 0.01
+# Displacement values use more precision, so they aren't changed by resaving.
+_DISP_FORMAT = '%.10g'
+
+# Header for the files written by VMF.save_cache(): magic, if the values are
+# big-endian, then the size, modification time and SHA-1 of the VMF.
+# The number is changed when the format of the flat state changes.
+_CACHE_MAGIC = b'VMFCACH2'
+_CACHE_HEADER = struct.Struct('<8s?Qd20s')
+# The size of the cells in the spatial index used by VMF.extract_region().
+_SPATIAL_CELL = 512.0
+
 
 class IDMan(set):
-    """Allocate and manage a set of unique IDs."""
-    __slots__ = ()
+    """Allocate and manage a set of unique IDs.
+
+    IDs below a cursor are known to be used, except for released IDs which
+    are kept in a heap. So allocating new IDs does not need to check every
+    used ID each time.
+    """
+    __slots__ = ['_next_free', '_free']
+
+    def __init__(self, ids: Iterable[int]=()):
+        super().__init__(ids)
+        # All IDs below this are used, unless they're in _free.
+        self._next_free = 1
+        # A heap of released IDs below _next_free. These may have been
+        # added again since, so they're checked when popped.
+        self._free = []  # type: List[int]
+
+    def _released(self, ids: Iterable[int]):
+        """Record IDs which were removed from the set."""
+        for elem in ids:
+            if elem < self._next_free:
+                heapq.heappush(self._free, elem)
+
+    def _pop_free(self) -> int:
+        """Return the lowest released ID which is still free, or 0."""
+        free = self._free
+        while free:
+            elem = heapq.heappop(free)
+            if elem not in self:
+                return elem
+        return 0
 
     def get_id(self, desired=-1):
         """Get a valid ID."""
 
-        if desired == -1:
-            # Start with the lowest ID, and look upwards
-            desired = 1
-
-        if desired not in self:
+        if desired != -1 and desired not in self:
             # The desired ID is avalible!
             self.add(desired)
             return desired
 
-        # Check every ID in order to find a valid one
-        for poss_id in itertools.count(start=1):
+        # Otherwise use the lowest free ID.
+        poss_id = self._pop_free()
+        if not poss_id:
+            poss_id = self._next_free
+            while poss_id in self:
+                poss_id += 1
+            self._next_free = poss_id + 1
+        self.add(poss_id)
+        return poss_id
+
+    def reserve(self, count: int) -> List[int]:
+        """Allocate the given number of new IDs at once.
+
+        These are the lowest free IDs, in increasing order.
+        """
+        ids = []
+        while len(ids) < count:
+            elem = self._pop_free()
+            if not elem:
+                break
+            ids.append(elem)
+        poss_id = self._next_free
+        while len(ids) < count:
             if poss_id not in self:
-                self.add(poss_id)
-                return poss_id
+                ids.append(poss_id)
+            poss_id += 1
+        self.update(ids)
+        self._next_free = max(poss_id, self._next_free)
+        return ids
+
+    def remove(self, elem):
+        super().remove(elem)
+        self._released([elem])
+
+    def discard(self, elem):
+        if elem in self:
+            super().discard(elem)
+            self._released([elem])
+
+    def pop(self):
+        elem = super().pop()
+        self._released([elem])
+        return elem
+
+    def clear(self):
+        super().clear()
+        self._next_free = 1
+        self._free = []
+
+    def difference_update(self, *others):
+        removed = self.intersection(itertools.chain(*others))
+        super().difference_update(removed)
+        self._released(removed)
+
+    def intersection_update(self, *others):
+        removed = self.difference(self.intersection(*others))
+        super().difference_update(removed)
+        self._released(removed)
+
+    def symmetric_difference_update(self, other):
+        other = set(other)
+        removed = self & other
+        super().symmetric_difference_update(other)
+        self._released(removed)
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
 
 
 class NullIDMan(IDMan):
     """An alternate Id manager which allows repeated IDs."""
-    __slots__ = ()
+    __slots__ = []
 
     def get_id(self, desired=-1):
         """Get a valid ID.
@@ -193,6 +422,170 @@ def localise_overlay(over, origin, angles=None):
         over[key] = ang.join(' ')
 
 
+def _localise_ent_keys(
+    ent: 'Entity',
+    origin: Vec,
+    angles: Vec,
+    matrix: Optional[Tuple[float, ...]],
+):
+    """Shift the position keyvalues of an entity, like instances.
+
+    matrix is the rotation matrix for the angles, or None if not rotated.
+    """
+    if ent['classname'].casefold() == 'info_overlay':
+        localise_overlay(ent, origin, angles)
+    elif 'origin' in ent:
+        pos = Vec.from_str(ent['origin'])
+        if matrix is not None:
+            pos.rotate_mat(matrix)
+        ent['origin'] = str(pos + origin)
+    if matrix is not None and 'angles' in ent:
+        ent['angles'] = str(_rotate_angles(Vec.from_str(ent['angles']), matrix))
+
+
+def _rotate_angles(angles: Vec, matrix: Tuple[float, ...]) -> Vec:
+    """Apply a rotation matrix to pitch, yaw, roll angles."""
+    forward = Vec(x=1).rotate(angles.x, angles.y, angles.z, round_vals=False)
+    left = Vec(y=1).rotate(angles.x, angles.y, angles.z, round_vals=False)
+    up = Vec(z=1).rotate(angles.x, angles.y, angles.z, round_vals=False)
+    forward.mat_mul(matrix)
+    left.mat_mul(matrix)
+    up.mat_mul(matrix)
+
+    horiz_dist = math.sqrt(forward.x ** 2 + forward.y ** 2)
+    pitch = math.degrees(math.atan2(-forward.z, horiz_dist))
+    if horiz_dist > 0.001:
+        yaw = math.degrees(math.atan2(forward.y, forward.x))
+        roll = math.degrees(math.atan2(left.z, up.z))
+    else:
+        # Pointing straight up or down, so roll is merged into yaw.
+        yaw = math.degrees(math.atan2(-left.x, left.y))
+        roll = 0.0
+    return Vec(
+        round(pitch, 3) % 360,
+        round(yaw, 3) % 360,
+        round(roll, 3) % 360,
+    )
+
+
+def _fixup_inst_name(name: str, inst_name: str, fixup_style: int) -> str:
+    """Apply the name fixup to an entity name inside an instance.
+
+    fixup_style is 0 for prefix, 1 for postfix and 2 for none.
+    """
+    if not name or fixup_style == 2 or name[0] in '@!':
+        return name
+    elif fixup_style == 1:
+        return name + '-' + inst_name
+    else:
+        return inst_name + '-' + name
+
+
+def translate_solids(solids: Iterable['Solid'], diff: Vec):
+    """Move all the given solids by the specified vector.
+
+    The offset is added to every plane point and texture axis in one pass,
+    without going through Side.translate() for each face.
+    """
+    off_x, off_y, off_z = Vec(diff)
+    for solid in solids:
+        touch = solid.map._touch
+        for side in solid.sides:
+            touch(side)
+            side._dirty = True
+            side._moved()
+            for point in side._planes:
+                point.x += off_x
+                point.y += off_y
+                point.z += off_z
+            # Fix offset - see source-sdk: utils/vbsp/map.cpp line 2237
+            for axis in (side.uaxis, side.vaxis):
+                axis.offset -= (
+                    off_x * axis.x + off_y * axis.y + off_z * axis.z
+                ) / axis.scale
+
+
+def localise_solids(
+    solids: Iterable['Solid'],
+    origin: Vec,
+    angles: Vec=None,
+):
+    """Shift all the given solids by the origin and angles, like instances.
+
+    The rotation matrix is computed once for the whole selection, instead of
+    for every plane point.
+    """
+    origin = Vec(origin)
+    if angles is None:
+        angles = Vec()
+        matrix = None
+    else:
+        angles = Vec(angles)
+        matrix = Vec.rotation_matrix(*angles)
+
+    for solid in solids:
+        for side in solid.sides:
+            side._localise_mat(origin, matrix)
+
+
+def localise_uv_axes(
+    axes: Iterable['UVAxis'],
+    origin: Vec,
+    angles: Vec=None,
+) -> List['UVAxis']:
+    """Shift many texture axes by the same origin and angles, like UVAxis.localise().
+
+    The rotation matrix is computed once for all the axes.
+    A list of the new axes is returned.
+    """
+    if angles is None:
+        matrix = None
+    else:
+        matrix = Vec.rotation_matrix(*angles)
+    return _localise_uv_mat(axes, Vec(origin), matrix)
+
+
+def _localise_uv_mat(
+    axes: Iterable['UVAxis'],
+    origin: Vec,
+    matrix: Optional[Tuple[float, ...]],
+) -> List['UVAxis']:
+    """Shift texture axes, with a precomputed rotation matrix.
+
+    If the matrix is None, the axes are not rotated.
+    """
+    off_x, off_y, off_z = origin
+    if matrix is not None:
+        a, b, c, d, e, f, g, h, i = matrix
+    result = []
+    for axis in axes:
+        # Inlined Vec.rotate_mat(), for speed.
+        if matrix is not None:
+            x, y, z = axis.x, axis.y, axis.z
+            x, y, z = (
+                round((x * a) + (y * b) + (z * c), 3) + 0.0,
+                round((x * d) + (y * e) + (z * f), 3) + 0.0,
+                round((x * g) + (y * h) + (z * i), 3) + 0.0,
+            )
+        else:
+            # Match the rounding done when rotating.
+            x = round(axis.x, 3) + 0.0
+            y = round(axis.y, 3) + 0.0
+            z = round(axis.z, 3) + 0.0
+
+        # Fix offset - see source-sdk: utils/vbsp/map.cpp line 2237
+        offset = axis.offset - (off_x * x + off_y * y + off_z * z) / axis.scale
+
+        # Keep the values low. The highest texture size in P2 is 1024, so
+        # do the next power just to be safe.
+        # Add and subtract 1024 so the value is between -1024, 1024 not 0, 2048
+        # (This just looks nicer)
+        offset = (offset + 1024) % 2048 - 1024
+
+        result.append(UVAxis(x, y, z, offset, axis.scale))
+    return result
+
+
 class CopySet(set):
     """Modified version of a Set which allows modification during iteration.
 
@@ -207,6 +600,240 @@ class CopySet(set):
         yield from (self - cur_items)
 
 
+class _VisIDSet(set):
+    """The visgroup IDs of a brush or entity.
+
+    Modifications are saved in snapshots, and update the export cache and
+    visgroup index of the map.
+    """
+    __slots__ = ['owner']
+
+    def __init__(self, owner: Union['Solid', 'Entity'], ids: Iterable[int]=()):
+        super().__init__(ids)
+        self.owner = owner
+
+    def __reduce__(self):
+        return _VisIDSet, (self.owner, list(self))
+
+    def _touch(self):
+        self.owner.map._touch(self.owner)
+
+    def _changed(self):
+        self.owner._export_cache = None
+        self.owner.map._regroup(self.owner)
+
+    def add(self, elem):
+        self._touch()
+        super().add(elem)
+        self._changed()
+
+    def remove(self, elem):
+        self._touch()
+        super().remove(elem)
+        self._changed()
+
+    def discard(self, elem):
+        self._touch()
+        super().discard(elem)
+        self._changed()
+
+    def pop(self):
+        self._touch()
+        elem = super().pop()
+        self._changed()
+        return elem
+
+    def clear(self):
+        self._touch()
+        super().clear()
+        self._changed()
+
+    def update(self, *others):
+        self._touch()
+        super().update(*others)
+        self._changed()
+
+    def difference_update(self, *others):
+        self._touch()
+        super().difference_update(*others)
+        self._changed()
+
+    def intersection_update(self, *others):
+        self._touch()
+        super().intersection_update(*others)
+        self._changed()
+
+    def symmetric_difference_update(self, other):
+        self._touch()
+        super().symmetric_difference_update(other)
+        self._changed()
+
+    def __ior__(self, other):
+        self._touch()
+        super().__ior__(other)
+        self._changed()
+        return self
+
+    def __isub__(self, other):
+        self._touch()
+        super().__isub__(other)
+        self._changed()
+        return self
+
+    def __iand__(self, other):
+        self._touch()
+        super().__iand__(other)
+        self._changed()
+        return self
+
+    def __ixor__(self, other):
+        self._touch()
+        super().__ixor__(other)
+        self._changed()
+        return self
+
+
+class _GroupList(list):
+    """The groups of an entity.
+
+    Modifications are saved in snapshots, and update the export cache and
+    group index of the map.
+    """
+    __slots__ = ['owner']
+
+    def __init__(
+        self,
+        owner: 'Entity',
+        groups: Iterable[Union['EntityGroup', int]]=(),
+    ):
+        super().__init__(groups)
+        self.owner = owner
+
+    def __reduce__(self):
+        return _GroupList, (self.owner, list(self))
+
+    def _touch(self):
+        self.owner.map._touch(self.owner)
+
+    def _changed(self):
+        self.owner._export_cache = None
+        self.owner.map._regroup(self.owner)
+
+    def append(self, group):
+        self._touch()
+        super().append(group)
+        self._changed()
+
+    def extend(self, groups):
+        self._touch()
+        super().extend(groups)
+        self._changed()
+
+    def insert(self, index, group):
+        self._touch()
+        super().insert(index, group)
+        self._changed()
+
+    def remove(self, group):
+        self._touch()
+        super().remove(group)
+        self._changed()
+
+    def pop(self, index=-1):
+        self._touch()
+        group = super().pop(index)
+        self._changed()
+        return group
+
+    def clear(self):
+        self._touch()
+        super().clear()
+        self._changed()
+
+    def sort(self, *, key=None, reverse=False):
+        self._touch()
+        super().sort(key=key, reverse=reverse)
+        self._changed()
+
+    def reverse(self):
+        self._touch()
+        super().reverse()
+        self._changed()
+
+    def __setitem__(self, index, value):
+        self._touch()
+        super().__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        self._touch()
+        super().__delitem__(index)
+        self._changed()
+
+    def __iadd__(self, other):
+        self._touch()
+        super().__iadd__(other)
+        self._changed()
+        return self
+
+    def __imul__(self, count):
+        self._touch()
+        super().__imul__(count)
+        self._changed()
+        return self
+
+
+class _PlaneList(list):
+    """The three points of a side's plane.
+
+    Replacing points is saved in snapshots, and updates the export cache
+    and cached geometry. The points are Vecs, so after modifying one in
+    place call Side.mark_dirty().
+    """
+    __slots__ = ['owner']
+
+    def __init__(self, owner: 'Side', points: Iterable[Vec]=()):
+        super().__init__(points)
+        self.owner = owner
+
+    def __reduce__(self):
+        return _PlaneList, (self.owner, list(self))
+
+    def __setitem__(self, index, value):
+        owner = self.owner
+        owner.map._touch(owner)
+        super().__setitem__(index, value)
+        owner._dirty = True
+        owner._moved()
+
+
+class _EditorColor(Vec):
+    """The editor colour of a brush or entity.
+
+    Modifications are saved in snapshots, and clear the export cache.
+    """
+    __slots__ = ['owner']
+
+    def __init__(
+        self,
+        owner: Union['Solid', 'Entity'],
+        color: Iterable[float],
+    ):
+        object.__setattr__(self, 'owner', None)
+        super().__init__(color)
+        object.__setattr__(self, 'owner', owner)
+
+    def __reduce__(self):
+        return _EditorColor, (self.owner, (self.x, self.y, self.z))
+
+    def __setattr__(self, name, value):
+        owner = self.owner
+        if owner is not None:
+            owner.map._touch(owner)
+            owner._export_cache = None
+        object.__setattr__(self, name, value)
+
+
 class VMF:
     """Represents a VMF file, and holds counters for various IDs used.
 
@@ -244,6 +871,32 @@ class VMF:
         # the whole map
         self.by_target = defaultdict(CopySet)  # type: Dict[str, Set[Entity]]
         self.by_class = defaultdict(CopySet)  # type: Dict[str, Set[Entity]]
+        # Casefolded material -> sides using it. This is only built when
+        # first required, see build_material_index().
+        self._mat_index = None  # type: Optional[Dict[str, Set[Side]]]
+        # Built by io_graph() when first required.
+        self._io_graph = None  # type: Optional[IOGraph]
+        # Visgroup and group ID -> brushes and entities in them, and the
+        # IDs each object was indexed with. Built when first required.
+        self._vis_index = {}  # type: Dict[int, Set[Union[Solid, Entity]]]
+        self._group_index = {}  # type: Dict[int, Set[Union[Solid, Entity]]]
+        self._group_members = None  # type: Optional[Dict[Union[Solid, Entity], Tuple[FrozenSet[int], FrozenSet[int]]]]
+        # Active snapshots, from oldest to newest.
+        self._snapshots = []  # type: List[MapSnapshot]
+        # Brushes and entities -> the entity they're part of, their bounding
+        # box and the cells containing them, and the reverse. Objects which
+        # were modified are rechecked when next required.
+        # Built by build_spatial_index() when first required.
+        self._spatial_boxes = None  # type: Optional[Dict[Union[Solid, Entity], Tuple[Optional[Entity], Optional[Tuple[float, ...]], List[Tuple[int, int, int]]]]]
+        self._spatial_grid = {}  # type: Dict[Tuple[int, int, int], Set[Union[Solid, Entity]]]
+        self._spatial_stale = set()  # type: Set[Union[Solid, Entity]]
+        # Finalizers releasing the IDs of brushes and entities if they're
+        # collected without being added to the map, by id() of the object.
+        # This is None while parsing, since those are always added.
+        self._loose = {}  # type: Optional[Dict[int, weakref.finalize]]
+        # id() of each entity, brush and face -> its position in the map,
+        # for pickling. Rebuilt when an object isn't found there.
+        self._positions = None  # type: Optional[Dict[int, Tuple[int, ...]]]
 
         self.entities = []  # type: List[Entity]
         self.add_ents(entities or [])  # We need to set the by_ dicts too.
@@ -255,6 +908,7 @@ class VMF:
         # mapspawn entity, which is the entity world brushes are saved
         # to.
         self.spawn = spawn or Entity(self)
+        self._adopt(self.spawn)
         self.spawn.solids = self.brushes
         self.spawn.hidden_brushes = self.brushes
         self.is_prefab = srctools.conv_bool(map_info.get('prefab'), False)
@@ -290,33 +944,242 @@ class VMF:
 
     def add_brush(self, item):
         """Add a world brush to this map."""
-        self.brushes.append(item)
+        self._insert_brush(len(self.brushes), item)
 
     def remove_brush(self, item):
-        """Remove a world brush from this map."""
-        self.brushes.remove(item)
+        """Remove a world brush from this map.
+
+        The IDs of the brush and its faces are released. They're reserved
+        again if it's added back with add_brush() or add_ent().
+        """
+        self._pop_brush(self.brushes.index(item))
+
+    def _insert_brush(self, index: int, item: 'Solid'):
+        """Add a world brush at this position in the list."""
+        self.brushes.insert(index, item)
+        self._adopt(item)
+        item._reserve_ids()
+        if self._mat_index is not None:
+            self._index_solids([item])
+        if self._group_members is not None:
+            self._index_groups([item])
+        if self._spatial_boxes is not None:
+            self._index_bounds([item], None)
+        self._log_undo(self._pop_brush, index)
+
+    def _pop_brush(self, index: int):
+        """Remove the world brush at this position in the list."""
+        item = self.brushes.pop(index)
+        if self._mat_index is not None:
+            self._unindex_solids([item])
+        if self._group_members is not None:
+            self._unindex_groups([item])
+        if self._spatial_boxes is not None:
+            self._unindex_bounds([item])
+        item.free_ids()
+        self._log_undo(self._insert_brush, index, item)
 
     def add_ent(self, item):
         """Add an entity to the map.
 
         The entity should have been created with this VMF as a parent.
         """
-        self.entities.append(item)
-        self.by_class[item['classname', None]].add(item)
-        self.by_target[item['targetname', None]].add(item)
+        self._insert_ent(len(self.entities), item)
 
     def remove_ent(self, item):
         """Remove an entity from the map.
 
         After this is called, the entity will no longer be exported.
-        The object still exists, so it can be reused.
+        The object still exists, so it can be reused. The IDs of it and its
+        brushes are released, and reserved again if it's added back.
         """
-        self.entities.remove(item)
+        self._pop_ent(self.entities.index(item))
+
+    def _insert_ent(self, index: int, item: 'Entity'):
+        """Add an entity at this position in the list."""
+        self.entities.insert(index, item)
+        self.by_class[item['classname', None]].add(item)
+        self.by_target[item['targetname', None]].add(item)
+        self._adopt(item)
+        item.map.ent_id.add(item.id)
+        for solid in item.solids:
+            self._adopt(solid)
+            solid._reserve_ids()
+        self._index_ent(item)
+        self._log_undo(self._pop_ent, index)
+
+    def _pop_ent(self, index: int):
+        """Remove the entity at this position in the list."""
+        item = self.entities.pop(index)
         self.by_class[item['classname', None]].remove(item)
         self.by_target[item['targetname', None]].remove(item)
+        self._unindex_ent(item)
+        item.free_ids()
+        self._log_undo(self._insert_ent, index, item)
+
+    def _remove_ents(self, ents: Iterable['Entity']):
+        """Remove several entities at once.
+
+        This only searches the list once, instead of for each entity.
+        """
+        removed = set(ents)
+        kept = []
+        positions = []
+        for index, ent in enumerate(self.entities):
+            if ent in removed:
+                positions.append((index, ent))
+            else:
+                kept.append(ent)
+        self.entities[:] = kept
+        for ent in removed:
+            self.by_class[ent['classname', None]].discard(ent)
+            self.by_target[ent['targetname', None]].discard(ent)
+            self._unindex_ent(ent)
+            ent.free_ids()
+        # Undoing is done in reverse, so this reinserts them in order.
+        for index, ent in reversed(positions):
+            self._log_undo(self._insert_ent, index, ent)
+
+    def _index_ent(self, item: 'Entity'):
+        """Add an entity to the optional indexes, after it's added."""
+        if self._mat_index is not None and item.solids:
+            self._index_solids(item.solids)
+        if self._io_graph is not None:
+            self._io_graph._mark(item, True)
+        if self._group_members is not None:
+            self._index_groups([item])
+            self._index_groups(item.solids)
+        if self._spatial_boxes is not None:
+            self._index_bounds([item], item)
+            self._index_bounds(item.solids, item)
+
+    def _unindex_ent(self, item: 'Entity'):
+        """Remove an entity from the optional indexes, after it's removed."""
+        if self._mat_index is not None and item.solids:
+            self._unindex_solids(item.solids)
+        if self._io_graph is not None:
+            self._io_graph._mark(item, False)
+        if self._group_members is not None:
+            self._unindex_groups([item])
+            self._unindex_groups(item.solids)
+        if self._spatial_boxes is not None:
+            self._unindex_bounds([item])
+            self._unindex_bounds(item.solids)
+
+    def _list_insert(self, objects: list, index: int, obj: Any):
+        """Add a camera, cordon or visgroup at this position in its list."""
+        objects.insert(index, obj)
+        self._log_undo(self._list_pop, objects, index)
+
+    def _list_pop(self, objects: list, index: int):
+        """Remove the camera, cordon or visgroup at this position."""
+        obj = objects.pop(index)
+        self._log_undo(self._list_insert, objects, index, obj)
+
+    def clear(self):
+        """Remove all entities, brushes and other objects from the map.
+
+        This releases all IDs at once, which is much faster than removing
+        each object individually. The worldspawn keyvalues are kept.
+        """
+        if self._snapshots:
+            self._log_undo(self._unclear, (
+                list(self.entities),
+                list(self.brushes),
+                list(self.cameras),
+                list(self.cordons),
+                list(self.vis_tree),
+                self.active_cam,
+                [set(id_man) for id_man in self._id_mans()],
+            ))
+        self.entities.clear()
+        self.brushes.clear()
+        self.cameras.clear()
+        self.cordons.clear()
+        self.vis_tree.clear()
+        self.by_target.clear()
+        self.by_class.clear()
+        if self._mat_index is not None:
+            self._mat_index.clear()
+        if self._io_graph is not None:
+            self._io_graph._clear()
+        if self._group_members is not None:
+            self._vis_index.clear()
+            self._group_index.clear()
+            self._group_members.clear()
+        if self._spatial_boxes is not None:
+            self._spatial_boxes.clear()
+            self._spatial_grid.clear()
+            self._spatial_stale.clear()
+        self.active_cam = -1
+        if self._loose:
+            for finalizer in self._loose.values():
+                finalizer.detach()
+            self._loose.clear()
+
+        for id_man in self._id_mans():
+            id_man.clear()
+        self.ent_id.add(self.spawn.id)
+
+    def _unclear(self, state: tuple):
+        """Undo clear(), for snapshots."""
+        (
+            entities,
+            brushes,
+            self.cameras[:],
+            self.cordons[:],
+            self.vis_tree[:],
+            self.active_cam,
+            id_sets,
+        ) = state
+        for id_man, ids in zip(self._id_mans(), id_sets):
+            id_man.update(ids)
+        # Rebuild indexes when next required.
+        self._mat_index = None
+        self._group_members = None
+        self._spatial_boxes = None
+        self.brushes[:] = brushes
+        self.entities[:] = entities
+        for ent in entities:
+            self.by_class[ent['classname', None]].add(ent)
+            self.by_target[ent['targetname', None]].add(ent)
+            if self._io_graph is not None:
+                self._io_graph._mark(ent, True)
+        self._log_undo(self.clear)
+
+    def _id_mans(self) -> List[IDMan]:
+        """Return all the ID managers."""
+        return [
+            self.solid_id,
+            self.face_id,
+            self.ent_id,
+            self.group_id,
+            self.vis_id,
+        ]
+
+    def _track_loose(
+        self,
+        obj: Union['Solid', 'Entity'],
+        id_man: IDMan,
+        face_ids: Iterable[int]=(),
+    ):
+        """Release the IDs of a new object if it's collected before being added."""
+        loose = self._loose
+        if loose is not None:
+            key = id(obj)
+            finalizer = loose[key] = weakref.finalize(
+                obj, _release_loose,
+                loose, key, id_man, obj.id, self.face_id, list(face_ids),
+            )
+            # Don't run these when the interpreter exits.
+            finalizer.atexit = False
 
-        if item.id in self.ent_id:
-            self.ent_id.remove(item.id)
+    def _adopt(self, obj: Union['Solid', 'Entity']):
+        """Stop tracking an object, once it's added to the map."""
+        if self._loose:
+            finalizer = self._loose.pop(id(obj), None)
+            if finalizer is not None:
+                finalizer.detach()
 
     def add_brushes(self, item):
         for i in item:
@@ -326,6 +1189,374 @@ class VMF:
         for i in item:
             self.add_ent(i)
 
+    def build_material_index(self):
+        """Index the faces of all brushes in the map by material.
+
+        Afterwards the index is kept up to date when Side.mat is changed, and
+        when brushes and entities are added or removed with the methods
+        here. Solids appended directly to Entity.solids are not tracked, call
+        this again to rebuild the index. This is done automatically by
+        sides_with_material(), replace_material() and material_usage().
+        """
+        self._mat_index = {}
+        self._index_solids(self.brushes)
+        for ent in self.entities:
+            if ent.solids:
+                self._index_solids(ent.solids)
+
+    def _index_solids(self, solids: Iterable['Solid']):
+        """Add the faces of these brushes to the material index."""
+        index = self._mat_index
+        for solid in solids:
+            for side in solid.sides:
+                mat = side._mat.casefold()
+                try:
+                    index[mat].add(side)
+                except KeyError:
+                    index[mat] = {side}
+
+    def _unindex_solids(self, solids: Iterable['Solid']):
+        """Remove the faces of these brushes from the material index."""
+        index = self._mat_index
+        for solid in solids:
+            for side in solid.sides:
+                mat = side._mat.casefold()
+                try:
+                    sides = index[mat]
+                except KeyError:
+                    continue
+                sides.discard(side)
+                if not sides:
+                    del index[mat]
+
+    def sides_with_material(self, mat: str) -> Set['Side']:
+        """Return all faces in the map using this material.
+
+        The material is compared case-insensitively. This covers all brushes,
+        including those in brush entities.
+        """
+        if self._mat_index is None:
+            self.build_material_index()
+        return set(self._mat_index.get(mat.casefold(), ()))
+
+    def replace_material(self, old: str, new: str) -> int:
+        """Change all faces using one material to another.
+
+        The old material is compared case-insensitively.
+        This returns the number of faces changed.
+        """
+        sides = self.sides_with_material(old)
+        for side in sides:
+            side.mat = new
+        return len(sides)
+
+    def material_usage(self) -> Dict[str, int]:
+        """Count the number of faces using each material.
+
+        The materials are casefolded.
+        """
+        if self._mat_index is None:
+            self.build_material_index()
+        return {
+            mat: len(sides)
+            for mat, sides in
+            self._mat_index.items()
+        }
+
+    def visgroup_members(self, vis_id: int) -> Set[Union['Solid', 'Entity']]:
+        """Return the brushes and entities in the given visgroup.
+
+        This includes the brushes of brush entities.
+        """
+        if self._group_members is None:
+            self._build_group_index()
+        return set(self._vis_index.get(vis_id, ()))
+
+    def group_members(self, group_id: int) -> Set[Union['Solid', 'Entity']]:
+        """Return the brushes and entities in the given group.
+
+        This includes the brushes of brush entities.
+        """
+        if self._group_members is None:
+            self._build_group_index()
+        return set(self._group_index.get(group_id, ()))
+
+    def _build_group_index(self):
+        """Index all brushes and entities by their visgroups and groups.
+
+        Afterwards the index is updated when they are added or removed with
+        the methods here, and when visgroup_ids, Solid.group_id or
+        Entity.groups is changed.
+        Solids appended directly to Entity.solids are not tracked.
+        """
+        self._vis_index = {}
+        self._group_index = {}
+        self._group_members = {}
+        self._index_groups(self.brushes)
+        for ent in self.entities:
+            self._index_groups([ent])
+            self._index_groups(ent.solids)
+
+    def _index_groups(self, objects: Iterable[Union['Solid', 'Entity']]):
+        """Add these objects to the visgroup and group indexes."""
+        for obj in objects:
+            vis_ids = frozenset(obj._visgroup_ids)
+            group_ids = obj._group_ids()
+            self._group_members[obj] = (vis_ids, group_ids)
+            for vis_id in vis_ids:
+                self._vis_index.setdefault(vis_id, set()).add(obj)
+            for group_id in group_ids:
+                self._group_index.setdefault(group_id, set()).add(obj)
+
+    def _unindex_groups(self, objects: Iterable[Union['Solid', 'Entity']]):
+        """Remove these objects from the visgroup and group indexes."""
+        for obj in objects:
+            try:
+                vis_ids, group_ids = self._group_members.pop(obj)
+            except KeyError:
+                continue
+            for index, ids in [
+                (self._vis_index, vis_ids),
+                (self._group_index, group_ids),
+            ]:
+                for obj_id in ids:
+                    members = index[obj_id]
+                    members.discard(obj)
+                    if not members:
+                        del index[obj_id]
+
+    def _regroup(self, obj: Union['Solid', 'Entity']):
+        """Update the indexes after an object's visgroups or groups change."""
+        if self._group_members is not None and obj in self._group_members:
+            self._unindex_groups([obj])
+            self._index_groups([obj])
+
+    def build_spatial_index(self):
+        """Index the bounding boxes of all brushes and entities in the map.
+
+        Afterwards the index is kept up to date when they are moved or
+        changed, and when brushes and entities are added or removed with the
+        methods here. Solids appended directly to Entity.solids are not
+        tracked, call this again to rebuild the index. After changing planes
+        directly, call mark_dirty(). This is done automatically by
+        extract_region().
+        """
+        self._spatial_boxes = {}
+        self._spatial_grid = {}
+        self._spatial_stale = set()
+        self._index_bounds(self.brushes, None)
+        for ent in self.entities:
+            self._index_bounds([ent], ent)
+            self._index_bounds(ent.solids, ent)
+
+    def _index_bounds(
+        self,
+        objects: Iterable[Union['Solid', 'Entity']],
+        owner: Optional['Entity'],
+    ):
+        """Add these objects to the spatial index.
+
+        owner is the entity the objects are part of, or None for world brushes.
+        """
+        grid = self._spatial_grid
+        for obj in objects:
+            if isinstance(obj, Solid):
+                bbox_min, bbox_max = obj.get_bbox()
+                bbox = bbox_min.as_tuple() + bbox_max.as_tuple()
+            else:
+                origin = obj['origin', '']
+                if origin:
+                    x, y, z = Vec.from_str(origin)
+                    bbox = (x, y, z, x, y, z)
+                else:
+                    bbox = None
+            cells = []
+            if bbox is not None:
+                x1, y1, z1, x2, y2, z2 = [
+                    math.floor(pos / _SPATIAL_CELL)
+                    for pos in bbox
+                ]
+                for cell in itertools.product(
+                    range(x1, x2 + 1),
+                    range(y1, y2 + 1),
+                    range(z1, z2 + 1),
+                ):
+                    cells.append(cell)
+                    try:
+                        grid[cell].add(obj)
+                    except KeyError:
+                        grid[cell] = {obj}
+            self._spatial_boxes[obj] = (owner, bbox, cells)
+
+    def _unindex_bounds(self, objects: Iterable[Union['Solid', 'Entity']]):
+        """Remove these objects from the spatial index."""
+        grid = self._spatial_grid
+        for obj in objects:
+            try:
+                owner, bbox, cells = self._spatial_boxes.pop(obj)
+            except KeyError:
+                continue
+            self._spatial_stale.discard(obj)
+            for cell in cells:
+                members = grid[cell]
+                members.discard(obj)
+                if not members:
+                    del grid[cell]
+
+    def _query_region(
+        self,
+        mins: Vec,
+        maxs: Vec,
+    ) -> Tuple[Set['Solid'], Dict['Entity', List['Solid']]]:
+        """Find the world brushes and entities intersecting this region.
+
+        Brushes must overlap the region, while point entities only need to be
+        on the boundary. For entities, this also returns their brushes
+        which intersect.
+        """
+        if self._spatial_boxes is None:
+            self.build_spatial_index()
+        if self._spatial_stale:
+            stale = list(self._spatial_stale)
+            for obj in stale:
+                owner = self._spatial_boxes[obj][0]
+                self._unindex_bounds([obj])
+                self._index_bounds([obj], owner)
+
+        boxes = self._spatial_boxes
+        x1, y1, z1 = [math.floor(pos / _SPATIAL_CELL) for pos in mins]
+        x2, y2, z2 = [math.floor(pos / _SPATIAL_CELL) for pos in maxs]
+        cell_count = (x2 - x1 + 1) * (y2 - y1 + 1) * (z2 - z1 + 1)
+        if cell_count > len(self._spatial_grid):
+            # It's quicker to check everything.
+            candidates = boxes.keys()  # type: Iterable[Union[Solid, Entity]]
+        else:
+            candidates = set()
+            for cell in itertools.product(
+                range(x1, x2 + 1),
+                range(y1, y2 + 1),
+                range(z1, z2 + 1),
+            ):
+                try:
+                    candidates.update(self._spatial_grid[cell])
+                except KeyError:
+                    pass
+
+        min_x, min_y, min_z = mins
+        max_x, max_y, max_z = maxs
+        brushes = set()  # type: Set[Solid]
+        ents = {}  # type: Dict[Entity, List[Solid]]
+        for obj in candidates:
+            owner, bbox, cells = boxes[obj]
+            if bbox is None:
+                continue
+            box_min_x, box_min_y, box_min_z, box_max_x, box_max_y, box_max_z = bbox
+            if obj is owner:
+                # Only point entities use their origin.
+                if obj.solids or not (
+                    min_x <= box_min_x <= max_x and
+                    min_y <= box_min_y <= max_y and
+                    min_z <= box_min_z <= max_z
+                ):
+                    continue
+            elif not (
+                box_min_x < max_x and box_max_x > min_x and
+                box_min_y < max_y and box_max_y > min_y and
+                box_min_z < max_z and box_max_z > min_z
+            ):
+                continue
+            if owner is None:
+                brushes.add(obj)
+            elif obj is owner:
+                ents.setdefault(owner, [])
+            else:
+                ents.setdefault(owner, []).append(obj)
+        return brushes, ents
+
+    def snapshot(self) -> 'MapSnapshot':
+        """Save the current state of the map, so changes can be undone.
+
+        Call commit() or discard() on the snapshot when finished. Snapshots
+        can be nested, but must be finished in reverse order.
+        """
+        snap = MapSnapshot(self)
+        self._snapshots.append(snap)
+        return snap
+
+    def _touch(self, obj: Union['Solid', 'Side', 'Entity']):
+        """Record that an object is about to be modified.
+
+        This saves its state for snapshots, and marks its bounding box as
+        needing to be recomputed.
+        """
+        for snap in self._snapshots:
+            snap.save(obj)
+        if self._spatial_boxes is not None:
+            self._mark_moved(obj)
+
+    def _log_undo(self, func, *args):
+        """Record how to undo a change to the lists of objects in the map.
+
+        When snapshots are discarded, func(*args) is called for each change
+        in reverse order.
+        """
+        for snap in self._snapshots:
+            snap._undo.append((func, args))
+
+    def _restore(self, obj: Union['Solid', 'Side', 'Entity'], state: tuple):
+        """Restore an object saved by a snapshot, and update the indexes."""
+        if isinstance(obj, Entity):
+            in_map = obj is not self.spawn and obj in self.by_class.get(
+                obj['classname', None], ()
+            )
+            if in_map:
+                self.by_class[obj['classname', None]].discard(obj)
+                self.by_target[obj['targetname', None]].discard(obj)
+                self._unindex_ent(obj)
+            obj._restore_state(state)
+            if in_map:
+                self.by_class[obj['classname', None]].add(obj)
+                self.by_target[obj['targetname', None]].add(obj)
+                self._index_ent(obj)
+            else:
+                self._regroup(obj)
+        elif isinstance(obj, Side):
+            index = self._mat_index
+            old_key = obj._mat.casefold()
+            obj._restore_state(state)
+            new_key = obj._mat.casefold()
+            if index is not None and old_key != new_key:
+                sides = index.get(old_key, ())
+                if obj in sides:
+                    sides.discard(obj)
+                    if not sides:
+                        del index[old_key]
+                    index.setdefault(new_key, set()).add(obj)
+        else:
+            obj._restore_state(state)
+            # The faces may have changed, rebuild when next required.
+            self._mat_index = None
+            self._regroup(obj)
+        self._mark_moved(obj)
+
+    def _mark_moved(self, obj: Union['Solid', 'Side', 'Entity']):
+        """Recompute the bounding box of this object when next required."""
+        if self._spatial_boxes is not None:
+            if isinstance(obj, Side):
+                obj = obj._solid
+            if obj in self._spatial_boxes:
+                self._spatial_stale.add(obj)
+
+    def io_graph(self) -> 'IOGraph':
+        """Return the graph of entity outputs in this map.
+
+        This is built on the first call, then updated as entities change.
+        """
+        if self._io_graph is None:
+            self._io_graph = IOGraph(self)
+        self._io_graph.refresh()
+        return self._io_graph
+
     def create_ent(self, classname: str, **kargs) -> 'Entity':
         """Convenience method to allow creating point entities.
 
@@ -341,17 +1572,645 @@ class VMF:
     def create_visgroup(self, name, color=(255, 255, 255)) -> 'VisGroup':
         """Convenience method for creating visgroups."""
         vis = VisGroup(self, -1, name, color)
-        self.vis_tree.append(vis)
+        self._list_insert(self.vis_tree, len(self.vis_tree), vis)
         return vis
 
+    def stamp(
+        self,
+        objects: Iterable[Union['Solid', 'Entity']],
+        transforms: Iterable[Tuple[Vec, Optional[Vec]]],
+        keep_vis=True,
+    ) -> List[List[Union['Solid', 'Entity']]]:
+        """Copy brushes and entities once for each origin, angles pair.
+
+        Each copy is shifted like Solid.localise(), and entity origins and
+        angles are transformed to match. Copied Solids are added as world
+        brushes, and copied entities are added to the map. Overlay face lists
+        are updated to refer to the copied faces.
+        The rotation matrix for each transform is computed once, and IDs
+        are reserved all at once.
+        This returns a list of the copies for each transform, in the same
+        order as the objects.
+        """
+        objects = list(objects)
+        transforms = list(transforms)
+
+        solid_count = side_count = ent_count = 0
+        for obj in objects:
+            if isinstance(obj, Entity):
+                ent_count += 1
+                solids = obj.solids
+            else:
+                solids = [obj]
+            solid_count += len(solids)
+            for solid in solids:
+                side_count += len(solid.sides)
+        ent_ids = iter(self.ent_id.reserve(ent_count * len(transforms)))
+        solid_ids = iter(self.solid_id.reserve(solid_count * len(transforms)))
+        face_ids = iter(self.face_id.reserve(side_count * len(transforms)))
+
+        results = []
+        for origin, angles in transforms:
+            origin = Vec(origin)
+            if angles is None:
+                angles = Vec()
+            else:
+                angles = Vec(angles)
+            if angles:
+                matrix = Vec.rotation_matrix(angles.x, angles.y, angles.z)
+            else:
+                matrix = None
+            side_mapping = {}  # type: Dict[int, int]
+            copies = []  # type: List[Union[Solid, Entity]]
+            for obj in objects:
+                if isinstance(obj, Entity):
+                    copies.append(obj._stamp(
+                        self, ent_ids, solid_ids, face_ids, side_mapping,
+                        origin, angles, matrix, keep_vis,
+                    ))
+                else:
+                    copies.append(obj._stamp(
+                        self, solid_ids, face_ids, side_mapping,
+                        origin, matrix, keep_vis,
+                    ))
+
+            for copy in copies:
+                if isinstance(copy, Entity):
+                    for key, value in copy.keys.items():
+                        if key.casefold() in _SIDE_LIST_KEYS:
+                            copy.keys[key] = ' '.join([
+                                str(side_mapping.get(int(side_id), side_id))
+                                for side_id in value.split()
+                            ])
+                    self.add_ent(copy)
+                else:
+                    self.add_brush(copy)
+            results.append(copies)
+        return results
+
+    def merge(
+        self,
+        others: Iterable[Union['VMF', str]],
+        remap='offset',
+        workers=1,
+    ):
+        """Move all the brushes, entities, visgroups and cordons from other maps into this one.
+
+        Filenames can also be passed, which are parsed first. If workers is
+        greater than one, that many worker processes parse them.
+        The objects are moved, so the other maps are left empty.
+        Their worldspawn keyvalues and cameras are discarded.
+
+        IDs are reassigned all at once, depending on remap:
+        - 'offset' adds the largest ID in this map to each ID, so IDs in
+          each map keep the same order and spacing.
+        - 'compact' uses the lowest free IDs.
+        Side IDs in the "sides" keyvalues of overlays are updated to match.
+        """
+        if remap not in ('offset', 'compact'):
+            raise ValueError('Unknown remap mode "{}"!'.format(remap))
+        others = list(others)
+        paths = [
+            (i, other)
+            for i, other in enumerate(others)
+            if not isinstance(other, VMF)
+        ]
+        if workers > 1 and len(paths) > 1:
+            # Send back the flat state, which can be pickled quickly.
+            with ProcessPoolExecutor(workers) as executor:
+                states = list(executor.map(
+                    _parse_flat_state,
+                    [path for i, path in paths],
+                ))
+            for (i, path), state in zip(paths, states):
+                others[i] = VMF._from_flat_state(state)
+        else:
+            for i, path in paths:
+                others[i] = VMF.parse(path)
+
+        for other in others:
+            self._merge_map(other, remap)
+
+    def _merge_map(self, other: 'VMF', remap: str):
+        """Move the contents of one map into this one, for merge()."""
+        ents = other.entities
+        solids = list(other.brushes)
+        for ent in ents:
+            solids.extend(ent.solids)
+        sides = [side for solid in solids for side in solid.sides]
+        visgroups = []  # type: List[VisGroup]
+        todo = list(other.vis_tree)
+        while todo:
+            vis = todo.pop()
+            visgroups.append(vis)
+            todo.extend(vis.child_groups)
+
+        def remap_ids(id_man: IDMan, old_ids: Iterable[int]) -> Dict[int, int]:
+            """Compute the new ID for each ID, and reserve them."""
+            old_ids = sorted(set(old_ids))
+            if remap == 'offset':
+                offset = max(id_man, default=0)
+                new_ids = [old_id + offset for old_id in old_ids]
+                id_man.update(new_ids)
+            else:
+                new_ids = id_man.reserve(len(old_ids))
+            return dict(zip(old_ids, new_ids))
+
+        ent_ids = remap_ids(self.ent_id, [ent.id for ent in ents])
+        solid_ids = remap_ids(self.solid_id, [solid.id for solid in solids])
+        face_ids = remap_ids(self.face_id, [side.id for side in sides])
+        vis_ids = remap_ids(self.vis_id, [vis.id for vis in visgroups])
+        # Only group definitions reserve their IDs, so also reserve the IDs
+        # our brushes and entities are in.
+        for ent in itertools.chain([self.spawn], self.entities):
+            self.group_id.update(ent._group_ids())
+            for solid in ent.solids:
+                if solid._group_id is not None:
+                    self.group_id.add(solid._group_id)
+        # The group definitions are stored in worldspawn.
+        group_defs = [
+            group
+            for group in other.spawn.groups
+            if isinstance(group, EntityGroup)
+        ]
+        group_ids = remap_ids(self.group_id, itertools.chain(
+            [group.id for group in group_defs],
+            [
+                group.id if isinstance(group, EntityGroup) else group
+                for ent in ents
+                for group in ent._groups
+            ],
+            [solid._group_id for solid in solids if solid._group_id is not None],
+        ))
+
+        for vis in visgroups:
+            vis.vmf = self
+            vis.id = vis_ids[vis.id]
+        for side in sides:
+            side.map = self
+            side.id = face_ids[side.id]
+            side._dirty = True
+        for solid in solids:
+            solid.map = self
+            solid.id = solid_ids[solid.id]
+            solid._visgroup_ids = _shared(frozenset([
+                vis_ids.get(vis_id, vis_id)
+                for vis_id in solid._visgroup_ids
+            ]))
+            if solid._group_id is not None:
+                solid._group_id = group_ids[solid._group_id]
+            solid._export_cache = None
+        for group in group_defs:
+            group.map = self
+            group.id = group_ids[group.id]
+        for ent in ents:
+            ent.map = self
+            new_groups = []
+            for group in ent._groups:
+                if isinstance(group, EntityGroup):
+                    group.map = self
+                    group.id = group_ids[group.id]
+                    new_groups.append(group)
+                else:
+                    new_groups.append(group_ids[group])
+            ent._groups = _GroupList(ent, new_groups)
+            ent.id = ent_ids[ent.id]
+            ent._visgroup_ids = _shared(frozenset([
+                vis_ids.get(vis_id, vis_id)
+                for vis_id in ent._visgroup_ids
+            ]))
+            for key, value in ent.keys.items():
+                if key.casefold() in _SIDE_LIST_KEYS:
+                    ent.keys[key] = ' '.join([
+                        str(face_ids.get(int(side_id), side_id))
+                        for side_id in value.split()
+                    ])
+            ent._export_cache = None
+            self.by_class[ent['classname', None]].add(ent)
+            self.by_target[ent['targetname', None]].add(ent)
+            if self._io_graph is not None:
+                self._io_graph._mark(ent, True)
+
+        self.spawn.groups.extend(group_defs)
+        other.spawn.groups = [
+            group
+            for group in other.spawn.groups
+            if not isinstance(group, EntityGroup)
+        ]
+        if self._snapshots:
+            # Undoing is done in reverse, so this removes from the end.
+            for objects, added, pop in [
+                (self.entities, ents, self._pop_ent),
+                (self.brushes, other.brushes, self._pop_brush),
+            ]:
+                for index in range(len(objects), len(objects) + len(added)):
+                    self._log_undo(pop, index)
+            for objects, added in [
+                (self.vis_tree, other.vis_tree),
+                (self.cordons, other.cordons),
+            ]:
+                for index in range(len(objects), len(objects) + len(added)):
+                    self._log_undo(self._list_pop, objects, index)
+        self.entities.extend(ents)
+        self.brushes.extend(other.brushes)
+        self.vis_tree.extend(other.vis_tree)
+        for cordon in other.cordons:
+            cordon.map = self
+        self.cordons.extend(other.cordons)
+
+        if self._mat_index is not None:
+            self._index_solids(solids)
+        if self._group_members is not None:
+            self._index_groups(ents)
+            self._index_groups(solids)
+        if self._spatial_boxes is not None:
+            self._index_bounds(other.brushes, None)
+            for ent in ents:
+                self._index_bounds([ent], ent)
+                self._index_bounds(ent.solids, ent)
+
+        # Empty the other map, so the objects aren't shared.
+        other.clear()
+
+    def extract_region(
+        self,
+        mins: Vec,
+        maxs: Vec,
+        clip=False,
+        seal=False,
+        seal_mat='tools/toolsskybox',
+        seal_thickness=16,
+    ) -> 'VMF':
+        """Copy the brushes and entities in a region into a new map.
+
+        World brushes and brush entity brushes are copied if their bounding
+        box overlaps the region, and point entities if their origin is inside.
+        A spatial index is used to find these, see build_spatial_index().
+        Brush entities only receive the brushes inside the region.
+
+        If clip is True, brushes crossing the edge of the region are cut off
+        by adding nodraw faces, and removed if nothing is left inside.
+        Brushes with displacements are not clipped.
+        If seal is True, the region is surrounded by brushes like a cordon.
+
+        The new map has new IDs, except for visgroups and groups which keep
+        their IDs. Overlay face lists refer to the copied faces.
+        """
+        mins, maxs = Vec.bbox(mins, maxs)
+        found_brushes, found_ents = self._query_region(mins, maxs)
+        # Preserve the order of the original map.
+        brushes = [solid for solid in self.brushes if solid in found_brushes]
+        ents = [
+            (ent, [solid for solid in ent.solids if solid in ent_solids])
+            for ent in self.entities
+            for ent_solids in [found_ents.get(ent)]
+            if ent_solids is not None
+        ]
+
+        vmf = VMF(
+            map_info={
+                'prefab': self.is_prefab,
+                'mapversion': self.map_ver,
+                'formatversion': self.format_ver,
+                'editorversion': self.hammer_ver,
+                'editorbuild': self.hammer_build,
+            },
+        )
+        # Set directly, so worldspawn isn't added to by_class.
+        vmf.spawn.keys.update(self.spawn.keys)
+        vmf.spawn.groups = [
+            group.copy(vmf) if isinstance(group, EntityGroup) else group
+            for group in self.spawn.groups
+        ]
+        todo = [(vis, vmf.vis_tree) for vis in self.vis_tree]
+        while todo:
+            vis, parent = todo.pop(0)
+            copy = VisGroup(vmf, vis.id, vis.name, vis.color)
+            parent.append(copy)
+            todo.extend([(child, copy.child_groups) for child in vis.child_groups])
+
+        solid_count = len(brushes)
+        side_count = sum([len(solid.sides) for solid in brushes])
+        for ent, solids in ents:
+            solid_count += len(solids)
+            for solid in solids:
+                side_count += len(solid.sides)
+        ent_ids = iter(vmf.ent_id.reserve(len(ents)))
+        solid_ids = iter(vmf.solid_id.reserve(solid_count))
+        face_ids = iter(vmf.face_id.reserve(side_count))
+        side_mapping = {}  # type: Dict[int, int]
+        origin = Vec()
+
+        for solid in brushes:
+            vmf.brushes.append(solid._stamp(
+                vmf, solid_ids, face_ids, side_mapping,
+                origin, None, True,
+            ))
+        for ent, solids in ents:
+            vmf.add_ent(ent._stamp(
+                vmf, ent_ids, solid_ids, face_ids, side_mapping,
+                origin, origin, None, True, solids,
+            ))
+
+        if clip:
+            self._clip_region(vmf, mins, maxs)
+
+        # Only keep references to faces which were copied.
+        face_ids = set(vmf.face_id)
+        for ent in vmf.entities:
+            for key, value in ent.keys.items():
+                if key.casefold() in _SIDE_LIST_KEYS:
+                    ent.keys[key] = ' '.join([
+                        str(side_mapping[int(side_id)])
+                        for side_id in value.split()
+                        if side_mapping.get(int(side_id)) in face_ids
+                    ])
+
+        if seal:
+            vmf.add_brushes(vmf.make_hollow(
+                mins, maxs,
+                seal_thickness,
+                seal_mat,
+            ))
+        return vmf
+
+    @staticmethod
+    def _clip_region(vmf: 'VMF', mins: Vec, maxs: Vec):
+        """Cut off the parts of brushes outside a region, for extract_region().
+        """
+        prism = vmf.make_prism(mins, maxs)
+        prism.solid.free_ids()
+        # The face to add if a brush extends past each side.
+        clip_faces = [
+            (0, False, prism.west),
+            (0, True, prism.east),
+            (1, False, prism.south),
+            (1, True, prism.north),
+            (2, False, prism.bottom),
+            (2, True, prism.top),
+        ]
+        region = (mins.as_tuple(), maxs.as_tuple())
+
+        def clip_solid(solid: Solid) -> bool:
+            """Clip a brush, and return if anything is left."""
+            sides = solid.sides
+            if any(side.is_disp for side in sides):
+                return True
+            points = [point for side in sides for point in side.planes]
+            new_sides = []
+            for axis, is_max, face in clip_faces:
+                if is_max:
+                    outside = max(point[axis] for point in points) > region[1][axis]
+                else:
+                    outside = min(point[axis] for point in points) < region[0][axis]
+                if outside:
+                    new_sides.append(face.copy())
+            if not new_sides:
+                return True
+            solid.sides = sides + new_sides
+            polygons, vertices = solid._hull()
+            kept = [
+                side
+                for side, poly in zip(solid.sides, polygons)
+                if poly
+            ]
+            if len(kept) < 4:
+                solid.free_ids()
+                return False
+            for side in solid.sides:
+                if side not in kept:
+                    side.free_ids()
+            solid.sides = kept
+            return True
+
+        vmf.brushes[:] = [solid for solid in vmf.brushes if clip_solid(solid)]
+        for ent in vmf.entities:
+            if ent.solids:
+                ent.solids = [solid for solid in ent.solids if clip_solid(solid)]
+
+    def collapse_instances(self, filesystem: FileSystem, max_depth=16):
+        """Merge the contents of all func_instance entities into this map.
+
+        This performs the same job as VBSP. Instance files are found by
+        looking up the "file" keyvalue in the filesystem, so it should be
+        rooted where those paths are relative to.
+        Each file is only parsed once, and fixup values are applied once for
+        each distinct set of values. Nested instances are also collapsed,
+        up to max_depth levels deep.
+        """
+        # Filename -> parsed map, and default fixup values.
+        files = {}  # type: Dict[str, Tuple[VMF, List[Tuple[str, str]]]]
+        # (filename, fixup values) -> map with fixups applied.
+        templates = {}  # type: Dict[Tuple[str, tuple], VMF]
+        auto_names = itertools.count(1)
+        for depth in range(max_depth):
+            instances = sorted(
+                self.by_class['func_instance'],
+                key=operator.attrgetter('id'),
+            )
+            if not instances:
+                return
+            with filesystem:
+                self._collapse_instance_pass(
+                    filesystem,
+                    instances,
+                    files,
+                    templates,
+                    auto_names,
+                )
+        if self.by_class['func_instance']:
+            raise ValueError(
+                'Instances are nested more than {} levels deep!'.format(
+                    max_depth,
+                )
+            )
+
+    def _collapse_instance_pass(
+        self,
+        filesystem: FileSystem,
+        instances: List['Entity'],
+        files: Dict[str, Tuple['VMF', List[Tuple[str, str]]]],
+        templates: Dict[Tuple[str, tuple], 'VMF'],
+        auto_names: Iterator[int],
+    ):
+        """Collapse one level of instances."""
+        # Instance name -> (name, fixup style), for instance:name;Input
+        # outputs pointing into them.
+        inst_names = {}  # type: Dict[str, Tuple[str, int]]
+        for inst in instances:
+            inst_name = inst['targetname']
+            fixup_style = srctools.conv_int(inst['fixup_style'], 0)
+            if inst_name:
+                inst_names[inst_name.casefold()] = (inst_name, fixup_style)
+            else:
+                inst_name = 'AutoInstance{}'.format(next(auto_names))
+            filename = inst['file'].replace('\\', '/')
+            if not filename:
+                continue
+            template = self._instance_template(
+                filesystem,
+                filename,
+                inst.fixup,
+                files,
+                templates,
+            )
+            self._stamp_instance(inst, template, inst_name, fixup_style)
+
+        self._remove_ents(instances)
+
+        if inst_names:
+            for ent in self.entities:
+                for out in ent.outputs:
+                    if out.inst_in is None:
+                        continue
+                    try:
+                        inst_name, fixup_style = inst_names[
+                            out.target.casefold()
+                        ]
+                    except KeyError:
+                        continue
+                    out.target = _fixup_inst_name(
+                        out.inst_in,
+                        inst_name,
+                        fixup_style,
+                    )
+                    out.inst_in = None
+                    ent.mark_dirty()
+
+    @staticmethod
+    def _instance_template(
+        filesystem: FileSystem,
+        filename: str,
+        inst_fixup: 'EntityFixup',
+        files: Dict[str, Tuple['VMF', List[Tuple[str, str]]]],
+        templates: Dict[Tuple[str, tuple], 'VMF'],
+    ) -> 'VMF':
+        """Get the contents of an instance, with fixup values applied."""
+        key = filename.casefold()
+        try:
+            parsed, defaults = files[key]
+        except KeyError:
+            parsed = VMF.parse(
+                filesystem.read_prop(filename),
+                preserve_ids=True,
+            )
+            # func_instance_parms defines the variables and default values,
+            # in the form "$var type default".
+            defaults = []
+            for parms in list(parsed.by_class['func_instance_parms']):
+                for parm_key, value in parms.keys.items():
+                    if parm_key.casefold().startswith('parm'):
+                        parm = value.split(' ', 2)
+                        if len(parm) == 3:
+                            defaults.append((parm[0], parm[2]))
+                parsed.remove_ent(parms)
+            files[key] = parsed, defaults
+
+        fixup = EntityFixup()
+        for var, value in defaults:
+            fixup[var] = value
+        fixup.update(inst_fixup)
+        signature = tuple(sorted(
+            (var.casefold(), value)
+            for var, value in fixup.items()
+        ))
+        if not signature:
+            return parsed
+        try:
+            return templates[key, signature]
+        except KeyError:
+            pass
+
+        template = VMF(preserve_ids=True)
+        for solid in parsed.brushes:
+            template.add_brush(solid.copy(map=template))
+        for ent in parsed.entities:
+            template.add_ent(ent.copy(map=template))
+        fixup.substitute_ents(template.entities)
+        for solid in itertools.chain(
+            template.brushes,
+            *[ent.solids for ent in template.entities]
+        ):
+            for side in solid:
+                if '$' in side.mat:
+                    side.mat = fixup.substitute(side.mat)
+        templates[key, signature] = template
+        return template
+
+    def _stamp_instance(
+        self,
+        inst: 'Entity',
+        template: 'VMF',
+        inst_name: str,
+        fixup_style: int,
+    ):
+        """Copy the contents of an instance into this map."""
+        [copies] = self.stamp(
+            itertools.chain(template.brushes, template.entities),
+            [(Vec.from_str(inst['origin']), Vec.from_str(inst['angles']))],
+            keep_vis=False,
+        )
+
+        # Local name -> entities, for instance:name;Output outputs.
+        local_names = defaultdict(list)  # type: Dict[str, List[Entity]]
+        for ent in copies:
+            if not isinstance(ent, Entity):
+                continue
+            for key, value in list(ent.keys.items()):
+                if key.casefold() in _INSTANCE_NAME_KEYS:
+                    ent[key] = _fixup_inst_name(value, inst_name, fixup_style)
+            for out in ent.outputs:
+                out.target = _fixup_inst_name(
+                    out.target,
+                    inst_name,
+                    fixup_style,
+                )
+            local_names[ent['targetname'].casefold()].append(ent)
+
+        # Outputs on the instance itself come from an entity inside.
+        for out in inst.outputs:
+            if out.inst_out is None:
+                continue
+            local_name = _fixup_inst_name(out.inst_out, inst_name, fixup_style)
+            for ent in local_names.get(local_name.casefold(), ()):
+                new_out = out.copy()
+                new_out.inst_out = None
+                ent.add_out(new_out)
+
     @staticmethod
-    def parse(tree: Union[Property, str], preserve_ids=False):
+    def parse(
+        tree: Union[Property, str],
+        preserve_ids=False,
+        geometry='full',
+    ):
         """Convert a property_parser tree into VMF classes.
+
+        geometry controls how brushes are loaded:
+        - 'full' (default) parses all brushes.
+        - 'skip' ignores all brushes, for tools which only use entities.
+          If a filename is passed, they're removed before being parsed at all.
+          Brush entities will then have no solids.
+        - 'lazy' only parses the faces of brushes when Solid.sides is
+          first accessed. If a filename is passed, the text for the faces
+          is kept, and not even tokenized until then.
         """
+        if geometry not in ('full', 'skip', 'lazy'):
+            raise ValueError('Unknown geometry mode "{}"!'.format(geometry))
+        # For lazy files, the unparsed text for the sides of each brush.
+        side_text = []  # type: List[str]
+
         if not isinstance(tree, Property):
             # if not a tree, try to read the file
             with open(tree) as file:
-                tree = Property.parse(file)
+                if geometry == 'skip':
+                    tree = Property.parse(_filter_solid_blocks(file), tree)
+                elif geometry == 'lazy':
+                    tree = Property.parse(
+                        _filter_solid_blocks(file, side_text),
+                        tree,
+                    )
+                else:
+                    tree = Property.parse(file)
 
         map_info = {}
         ver_info = tree.find_key('versioninfo', [])
@@ -391,6 +2250,8 @@ class VMF:
         # This ensures the IDman objects have been created, so we can
         # ensure unique IDs in brushes, entities and faces.
         map_obj = VMF(map_info=map_info, preserve_ids=preserve_ids)
+        # Everything parsed is added to the map, so don't track them.
+        map_obj._loose = None
 
         for vis in tree.find_all('visgroups', 'visgroup'):
             map_obj.vis_tree.append(VisGroup.parse(map_obj, vis))
@@ -404,29 +2265,504 @@ class VMF:
 
         for ent in tree.find_all('Entity'):
             map_obj.add_ent(
-                Entity.parse(map_obj, ent, hidden=False)
+                Entity.parse(
+                    map_obj, ent,
+                    hidden=False,
+                    geometry=geometry,
+                    side_text=side_text,
+                )
             )
 
         # find hidden entities
         for hidden_ent in tree.find_all('hidden'):
             for ent in hidden_ent:
                 map_obj.add_ent(
-                    Entity.parse(map_obj, ent, hidden=True)
+                    Entity.parse(
+                        map_obj, ent,
+                        hidden=True,
+                        geometry=geometry,
+                        side_text=side_text,
+                    )
                 )
 
         map_spawn = tree.find_key('world', [])
         if map_spawn is None:
             # Generate a fake default to parse through
             map_spawn = Property("world", [])
-        map_obj.spawn = Entity.parse(map_obj, map_spawn)
+        map_obj.spawn = Entity.parse(
+            map_obj, map_spawn,
+            geometry=geometry,
+            side_text=side_text,
+        )
 
         if map_obj.spawn.solids is not None:
             map_obj.brushes = map_obj.spawn.solids
+        map_obj._loose = {}
 
         return map_obj
 
+    @staticmethod
+    def parse_async(
+        path: str,
+        executor: Executor=None,
+        preserve_ids=False,
+        geometry='full',
+    ) -> 'asyncio.Future':
+        """Read and parse a VMF file in an executor, so the event loop isn't blocked.
+
+        This returns a future for the map. The other arguments are
+        the same as parse(). executor defaults to the event loop's default
+        executor. A ProcessPoolExecutor sends the map back in its compact
+        pickled form, which can't keep lazily parsed geometry or preserved
+        IDs, and open files can't be sent to it, so these raise ValueError.
+        """
+        if isinstance(executor, ProcessPoolExecutor):
+            if geometry == 'lazy':
+                raise ValueError(
+                    'Lazy geometry cannot be parsed in a '
+                    'ProcessPoolExecutor!'
+                )
+            if preserve_ids:
+                raise ValueError(
+                    'IDs cannot be preserved in a ProcessPoolExecutor!'
+                )
+            if hasattr(path, 'read'):
+                raise ValueError(
+                    'Open files cannot be parsed in a ProcessPoolExecutor!'
+                )
+        return _get_loop().run_in_executor(
+            executor,
+            functools.partial(
+                VMF.parse,
+                path,
+                preserve_ids=preserve_ids,
+                geometry=geometry,
+            ),
+        )
+
+    def save_cache(self, path: str, cache_path: str=None):
+        """Save a binary copy of this map, to be reloaded by load_cache().
+
+        path is the VMF file this map matches, which the cache is validated
+        against. By default the cache is saved next to it, as "<path>.cache".
+        """
+        if cache_path is None:
+            cache_path = path + '.cache'
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        state = self._flat_state()
+        with open(cache_path, 'wb') as f:
+            f.write(_CACHE_HEADER.pack(
+                _CACHE_MAGIC,
+                sys.byteorder == 'big',
+                stat.st_size,
+                stat.st_mtime,
+                digest,
+            ))
+            _write_flat_state(f, state)
+
+    @staticmethod
+    def load_cache(path: str, cache_path: str=None) -> 'VMF':
+        """Load a VMF file, using the cache from save_cache() if possible.
+
+        The cache is only used if the VMF file has the same size,
+        modification time and hash as when it was saved. Otherwise the file
+        is parsed, and the cache is saved again.
+        """
+        if cache_path is None:
+            cache_path = path + '.cache'
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+
+        if len(data) >= _CACHE_HEADER.size:
+            magic, big_endian, size, mtime, digest = _CACHE_HEADER.unpack_from(data)
+            stat = os.stat(path)
+            if (
+                magic == _CACHE_MAGIC and
+                big_endian == (sys.byteorder == 'big') and
+                size == stat.st_size and
+                mtime == stat.st_mtime
+            ):
+                with open(path, 'rb') as f:
+                    if hashlib.sha1(f.read()).digest() == digest:
+                        try:
+                            state = _read_flat_state(data, _CACHE_HEADER.size)
+                        except (ValueError, struct.error):
+                            pass  # Corrupt, parse again.
+                        else:
+                            return VMF._from_flat_state(state)
+
+        vmf = VMF.parse(path)
+        with suppress(OSError):
+            vmf.save_cache(path, cache_path)
+        return vmf
+
+    def __reduce__(self):
+        """Pickle the map as a string table and arrays of numbers.
+
+        This is much smaller and quicker than pickling every object.
+        Snapshots and indexes are not kept, they are rebuilt when required.
+        """
+        return _unpickle_vmf, (self._flat_state(),)
+
+    def _reduce_child(
+        self,
+        obj: Union['Solid', 'Side', 'Entity'],
+        protocol: int,
+    ) -> tuple:
+        """Pickle an entity, brush or face as its position in this map.
+
+        This way pickling the map with objects in it keeps their identity.
+        Objects which aren't in the map are pickled normally.
+        """
+        pos = self._position(obj)
+        if pos is None:
+            return object.__reduce_ex__(obj, protocol)
+        return _unpickle_child, (self, pos)
+
+    def _position(
+        self,
+        obj: Union['Solid', 'Side', 'Entity'],
+    ) -> Optional[Tuple[int, ...]]:
+        """Find an object in the map, or return None if it's not present.
+
+        The position is the index of the entity in [spawn] + entities (the
+        order used by _flat_state()), then the brush and face indexes.
+        """
+        if self._positions is not None:
+            pos = self._positions.get(id(obj))
+            try:
+                if pos is not None and self._at_position(pos) is obj:
+                    return pos
+            except IndexError:
+                pass
+        self._positions = positions = {}
+        for ent_ind, ent in enumerate([self.spawn] + self.entities):
+            positions[id(ent)] = (ent_ind, )
+            for solid_ind, solid in enumerate(ent.solids):
+                positions[id(solid)] = (ent_ind, solid_ind)
+                for side_ind, side in enumerate(solid.sides):
+                    positions[id(side)] = (ent_ind, solid_ind, side_ind)
+        return positions.get(id(obj))
+
+    def _at_position(self, pos: Tuple[int, ...]) -> Union['Solid', 'Side', 'Entity']:
+        """Return the object at a position from _position()."""
+        ent_ind = pos[0]
+        obj = self.spawn if ent_ind == 0 else self.entities[ent_ind - 1]
+        if len(pos) > 1:
+            obj = obj.solids[pos[1]]
+        if len(pos) > 2:
+            obj = obj.sides[pos[2]]
+        return obj
+
+    def _flat_state(self) -> Tuple[List[str], Dict[str, array]]:
+        """Convert the map into a string table and arrays of numbers.
+
+        Strings are replaced by their index in the table. The first string
+        is the text of the blocks other than the world and entities, and
+        the second is whether cordons are enabled, since that is only
+        exported if there are any cordons.
+        This is reversed by _from_flat_state().
+        """
+        strings = []  # type: List[str]
+        str_index = {}  # type: Dict[str, int]
 
-    def export(self, dest_file=None, inc_version=True, minimal=False):
+        def add_str(text: Optional[str]) -> int:
+            """Add a string to the table, returning the index."""
+            if text is None:
+                return -1
+            try:
+                return str_index[text]
+            except KeyError:
+                str_index[text] = ind = len(strings)
+                strings.append(text)
+                return ind
+
+        shell = io.StringIO()
+        self._export_header(shell.write, minimal=False)
+        self._export_footer(shell.write, minimal=False)
+        add_str(shell.getvalue())
+        add_str(srctools.bool_as_int(self.cordon_enabled))
+
+        ent_info = array('q')
+        ent_data = array('q')
+        ent_float = array('d')
+        solid_info = array('q')
+        solid_float = array('d')
+        side_info = array('q')
+        side_float = array('d')
+
+        for ent in [self.spawn] + self.entities:
+            fixups = ent.fixup._snapshot()
+            ent_info.extend([
+                ent.id,
+                ent.hidden | ent.vis_shown << 1 | ent.vis_auto_shown << 2,
+                len(ent.keys),
+                len(fixups),
+                len(ent.outputs),
+                len(ent.solids),
+                len(ent._groups),
+                len(ent._visgroup_ids),
+                add_str(ent.logical_pos),
+                add_str(ent.comments),
+            ])
+            ent_float.extend(ent._editor_color)
+            for key, value in ent.keys.items():
+                ent_data.append(add_str(key))
+                ent_data.append(add_str(value))
+            for var, value, index in fixups:
+                ent_data.extend([add_str(var), add_str(value), index])
+            for out in ent.outputs:
+                ent_data.extend([
+                    add_str(out.output),
+                    add_str(out.inst_out),
+                    add_str(out.target),
+                    add_str(out.input),
+                    add_str(out.inst_in),
+                    add_str(out.params),
+                    out.times,
+                    out.comma_sep,
+                ])
+                ent_float.append(out.delay)
+            for group in ent._groups:
+                if isinstance(group, EntityGroup):
+                    ent_data.extend([1, group.id, group.shown, group.auto_shown])
+                else:
+                    ent_data.extend([0, group, 0, 0])
+            ent_data.extend(sorted(ent._visgroup_ids))
+
+            for solid in ent.solids:
+                sides = solid.sides
+                solid_info.extend([
+                    solid.id,
+                    len(sides),
+                    (
+                        solid.hidden |
+                        (solid.cordon_solid is not None) << 1 |
+                        solid.vis_shown << 2 |
+                        solid.vis_auto_shown << 3 |
+                        (solid._group_id is not None) << 4
+                    ),
+                    solid.cordon_solid or 0,
+                    solid._group_id or 0,
+                    len(solid._visgroup_ids),
+                ])
+                solid_info.extend(sorted(solid._visgroup_ids))
+                solid_float.extend(solid._editor_color)
+                for side in sides:
+                    if side.is_disp:
+                        # Rare, so just store the text.
+                        disp = add_str(_side_text('', side._snapshot()))
+                    else:
+                        disp = -1
+                    side_info.extend([
+                        side.id,
+                        add_str(side._mat),
+                        disp,
+                        # Keep ints and floats distinct, they're exported
+                        # differently.
+                        (
+                            isinstance(side.ham_rot, int) |
+                            isinstance(side.lightmap, int) << 1 |
+                            isinstance(side.smooth, int) << 2
+                        ),
+                    ])
+                    for point in side.planes:
+                        side_float.extend(point)
+                    for uv in (side.uaxis, side.vaxis):
+                        side_float.extend([uv.x, uv.y, uv.z, uv.offset, uv.scale])
+                    side_float.extend([side.ham_rot, side.lightmap, side.smooth])
+
+        return strings, {
+            'ent_info': ent_info,
+            'ent_data': ent_data,
+            'ent_float': ent_float,
+            'solid_info': solid_info,
+            'solid_float': solid_float,
+            'side_info': side_info,
+            'side_float': side_float,
+        }
+
+    @staticmethod
+    def _from_flat_state(state: Tuple[List[str], Dict[str, array]]) -> 'VMF':
+        """Rebuild a map from the values produced by _flat_state()."""
+        strings, arrays = state
+        vmf = VMF.parse(Property.parse(strings[0]))
+        vmf.cordon_enabled = strings[1] == '1'
+        # We're replacing this.
+        vmf.ent_id.discard(vmf.spawn.id)
+
+        ent_info = iter(arrays['ent_info'])
+        ent_data = iter(arrays['ent_data'])
+        ent_float = iter(arrays['ent_float'])
+        solid_info = iter(arrays['solid_info'])
+        solid_float = iter(arrays['solid_float'])
+        side_info = iter(arrays['side_info'])
+        side_float = iter(arrays['side_float'])
+
+        def get_str(ind: int) -> Optional[str]:
+            return None if ind == -1 else strings[ind]
+
+        entities = []
+        ent_ids = []
+        solid_ids = []
+        face_ids = []
+        for (
+            ent_id, flags, key_count, fixup_count, out_count,
+            solid_count, group_count, vis_count, logical_pos, comments,
+        ) in zip(*[ent_info] * 10):
+            ent = Entity.__new__(Entity)
+            ent.map = vmf
+            ent.id = ent_id
+            ent_ids.append(ent_id)
+            ent.hidden = bool(flags & 1)
+            ent.vis_shown = bool(flags & 2)
+            ent.vis_auto_shown = bool(flags & 4)
+            ent.logical_pos = get_str(logical_pos)
+            ent.comments = get_str(comments)
+            ent._editor_color = _shared((
+                next(ent_float), next(ent_float), next(ent_float),
+            ))
+            ent.keys = {
+                strings[key]: strings[value]
+                for key, value in
+                itertools.islice(zip(ent_data, ent_data), key_count)
+            }
+            ent.fixup = EntityFixup([
+                FixupTuple(strings[var], strings[value], index)
+                for var, value, index in
+                itertools.islice(zip(*[ent_data] * 3), fixup_count)
+            ])
+            ent.outputs = outputs = []
+            for (
+                out_name, inst_out, target, inp, inst_in,
+                params, times, comma_sep,
+            ) in itertools.islice(zip(*[ent_data] * 8), out_count):
+                outputs.append(Output(
+                    strings[out_name],
+                    strings[target],
+                    strings[inp],
+                    strings[params],
+                    next(ent_float),
+                    times=times,
+                    inst_out=get_str(inst_out),
+                    inst_in=get_str(inst_in),
+                    comma_sep=bool(comma_sep),
+                ))
+            groups = []
+            for kind, group_id, shown, auto_shown in itertools.islice(
+                zip(*[ent_data] * 4),
+                group_count,
+            ):
+                if kind:
+                    group = EntityGroup.__new__(EntityGroup)
+                    group.map = vmf
+                    group.id = group_id
+                    group.shown = bool(shown)
+                    group.auto_shown = bool(auto_shown)
+                    groups.append(group)
+                else:
+                    groups.append(group_id)
+            ent._groups = _GroupList(ent, groups)
+            ent._visgroup_ids = _shared(frozenset(
+                itertools.islice(ent_data, vis_count)
+            ))
+            ent._key_order = ()
+            ent._export_cache = None
+            ent._bbox_cache = None
+
+            ent.solids = solids = []
+            for (
+                solid_id, side_count, flags,
+                cordon, group_id, solid_vis,
+            ) in itertools.islice(
+                zip(*[solid_info] * 6),
+                solid_count,
+            ):
+                solid = Solid.__new__(Solid)
+                solid.map = vmf
+                solid.id = solid_id
+                solid_ids.append(solid_id)
+                solid.hidden = bool(flags & 1)
+                solid.cordon_solid = cordon if flags & 2 else None
+                solid.vis_shown = bool(flags & 4)
+                solid.vis_auto_shown = bool(flags & 8)
+                solid._group_id = group_id if flags & 16 else None
+                solid._visgroup_ids = _shared(frozenset(
+                    itertools.islice(solid_info, solid_vis)
+                ))
+                solid._editor_color = _shared((
+                    next(solid_float), next(solid_float), next(solid_float),
+                ))
+                solid._lazy_sides = None
+                solid._export_cache = None
+                solid._hull_cache = None
+                solid._bbox_cache = None
+                solid._sides = sides = []
+                for side_id, mat, disp, side_flags in itertools.islice(
+                    zip(*[side_info] * 4),
+                    side_count,
+                ):
+                    (
+                        x1, y1, z1, x2, y2, z2, x3, y3, z3,
+                        ux, uy, uz, u_off, u_scale,
+                        vx, vy, vz, v_off, v_scale,
+                        rotation, lightmap, smooth,
+                    ) = itertools.islice(side_float, 22)
+                    if disp != -1:
+                        side = Side.parse(
+                            vmf,
+                            Property.parse(strings[disp]).find_key('side'),
+                        )
+                    else:
+                        side = Side.__new__(Side)
+                        side.map = vmf
+                        side.id = side_id
+                        side._planes = [
+                            Vec(x1, y1, z1),
+                            Vec(x2, y2, z2),
+                            Vec(x3, y3, z3),
+                        ]
+                        side._mat = strings[mat]
+                        side.uaxis = UVAxis(ux, uy, uz, u_off, u_scale)
+                        side.vaxis = UVAxis(vx, vy, vz, v_off, v_scale)
+                        side.ham_rot = int(rotation) if side_flags & 1 else rotation
+                        side.lightmap = int(lightmap) if side_flags & 2 else lightmap
+                        side.smooth = int(smooth) if side_flags & 4 else smooth
+                        side.is_disp = False
+                        side._dirty = True
+                        side._normal_cache = side._bbox_cache = None
+                    face_ids.append(side_id)
+                    side._solid = solid
+                    sides.append(side)
+                solids.append(solid)
+
+            entities.append(ent)
+
+        vmf.ent_id.update(ent_ids)
+        vmf.solid_id.update(solid_ids)
+        vmf.face_id.update(face_ids)
+
+        spawn = entities[0]
+        vmf.spawn = spawn
+        vmf.brushes = spawn.solids
+        vmf.add_ents(entities[1:])
+        return vmf
+
+    def export(
+        self,
+        dest_file=None,
+        inc_version=True,
+        minimal=False,
+        as_bytes=False,
+        use_cache=False,
+        workers=1,
+        mp_context=None,
+    ):
         """Serialises the object's contents into a VMF file.
 
         - If no file is given the map will be returned as a string.
@@ -434,83 +2770,209 @@ class VMF:
           inc_version to False to suppress this.
         - If minimal is True, several blocks will be skipped
           (Viewsettings, cameras, cordons and visgroups)
+        - If as_bytes is True, the text is encoded to UTF-8 bytes, so a file
+          opened in binary mode can be passed (or bytes are returned).
+        - If use_cache is True, the text generated for entities and brushes
+          is kept, and reused by later exports with use_cache if they were
+          not modified. Changes made via methods are detected, but after
+          directly modifying attributes (keys, outputs, side.planes, etc)
+          call mark_dirty() on the object.
+        - If workers is greater than one, entities and brushes are
+          serialised in that many worker processes. The output is identical.
+          This cannot be combined with use_cache.
+        - mp_context is the multiprocessing context used to start the
+          workers, by default the default context. Workers are sent compact
+          snapshots of the objects, unless a context using the "fork" start
+          method is passed - then they read the objects directly.
         """
+        if workers > 1 and use_cache:
+            raise ValueError('Cached exports cannot use worker processes!')
+
         if dest_file is None:
-            dest_file = io.StringIO()
             # acts like a file object but is actually a string. We're
             # using this to prevent having Python duplicate the entire
             # string every time we append
+            dest_file = io.BytesIO() if as_bytes else io.StringIO()
             ret_string = True
         else:
             ret_string = False
 
+        if as_bytes:
+            def write(text: str):
+                dest_file.write(text.encode('utf8'))
+        else:
+            write = dest_file.write
+
         if inc_version:
             # Increment this to indicate the map was modified
             self.map_ver += 1
 
-        dest_file.write('versioninfo\n{\n')
-        dest_file.write('\t"editorversion" "' + str(self.hammer_ver) + '"\n')
-        dest_file.write('\t"editorbuild" "' + str(self.hammer_build) + '"\n')
-        dest_file.write('\t"mapversion" "' + str(self.map_ver) + '"\n')
-        dest_file.write('\t"formatversion" "' + str(self.format_ver) + '"\n')
-        dest_file.write('\t"prefab" "' +
-                        srctools.bool_as_int(self.is_prefab) + '"\n}\n')
-
-        if self.vis_tree:
-            dest_file.write('visgroups\n{\n')
-            for vis in self.vis_tree:
-                vis.export(dest_file, ind='\t')
-            dest_file.write('}\n')
-
-        if not minimal:
-            dest_file.write('viewsettings\n{\n')
-            dest_file.write('\t"bSnapToGrid" "' +
-                            srctools.bool_as_int(self.snap_grid) + '"\n')
-            dest_file.write('\t"bShowGrid" "' +
-                            srctools.bool_as_int(self.show_grid) + '"\n')
-            dest_file.write('\t"bShowLogicalGrid" "' +
-                            srctools.bool_as_int(self.show_logic_grid) + '"\n')
-            dest_file.write('\t"nGridSpacing" "' +
-                            str(self.grid_spacing) + '"\n')
-            dest_file.write('\t"bShow3DGrid" "' +
-                            srctools.bool_as_int(self.show_3d_grid) + '"\n}\n')
+        self._export_header(write, minimal)
 
         self.spawn['mapversion'] = str(self.map_ver)
-        self.spawn.export(dest_file, ent_name='world')
+        if workers > 1:
+            self._export_parallel(write, workers, mp_context)
+        else:
+            write(self.spawn._export_text('world', use_cache=use_cache))
+            for ent in self.entities:
+                write(ent._export_text(use_cache=use_cache))
         del self.spawn['mapversion']
 
-        for ent in self.entities:
-            ent.export(dest_file)
+        self._export_footer(write, minimal)
 
+        if ret_string:
+            string = dest_file.getvalue()
+            dest_file.close()
+            return string
+
+    def _export_header(self, write, minimal: bool):
+        """Write the blocks before the world and entities."""
+        write(
+            'versioninfo\n{\n'
+            '\t"editorversion" "' + str(self.hammer_ver) + '"\n'
+            '\t"editorbuild" "' + str(self.hammer_build) + '"\n'
+            '\t"mapversion" "' + str(self.map_ver) + '"\n'
+            '\t"formatversion" "' + str(self.format_ver) + '"\n'
+            '\t"prefab" "' + srctools.bool_as_int(self.is_prefab) + '"\n'
+            '}\n'
+        )
+
+        if self.vis_tree:
+            write(
+                'visgroups\n{\n' +
+                ''.join([vis._export_text('\t') for vis in self.vis_tree]) +
+                '}\n'
+            )
+
+        if not minimal:
+            write(
+                'viewsettings\n{\n'
+                '\t"bSnapToGrid" "' +
+                srctools.bool_as_int(self.snap_grid) + '"\n'
+                '\t"bShowGrid" "' +
+                srctools.bool_as_int(self.show_grid) + '"\n'
+                '\t"bShowLogicalGrid" "' +
+                srctools.bool_as_int(self.show_logic_grid) + '"\n'
+                '\t"nGridSpacing" "' +
+                str(self.grid_spacing) + '"\n'
+                '\t"bShow3DGrid" "' +
+                srctools.bool_as_int(self.show_3d_grid) + '"\n'
+                '}\n'
+            )
+
+    def _export_footer(self, write, minimal: bool):
+        """Write the blocks after the world and entities."""
         if not minimal:
-            dest_file.write('cameras\n{\n')
             if len(self.cameras) == 0:
                 self.active_cam = -1
-            dest_file.write('\t"activecamera" "' + str(self.active_cam) + '"\n')
-            for cam in self.cameras:
-                cam.export(dest_file, '\t')
-            dest_file.write('}\n')
+            write(
+                'cameras\n{\n'
+                '\t"activecamera" "' + str(self.active_cam) + '"\n' +
+                ''.join([cam._export_text('\t') for cam in self.cameras]) +
+                '}\n'
+            )
 
-            dest_file.write('cordons\n{\n')
             if len(self.cordons) > 0:
-                dest_file.write('\t"active" "' +
-                                srctools.bool_as_int(self.cordon_enabled) +
-                                '"\n')
-                for cord in self.cordons:
-                    cord.export(dest_file, '\t')
+                write(
+                    'cordons\n{\n'
+                    '\t"active" "' +
+                    srctools.bool_as_int(self.cordon_enabled) + '"\n' +
+                    ''.join([
+                        cord._export_text('\t')
+                        for cord in self.cordons
+                    ]) +
+                    '}\n'
+                )
             else:
-                dest_file.write('\t"active" "0"\n')
-            dest_file.write('}\n')
+                write('cordons\n{\n\t"active" "0"\n}\n')
 
         if self.quickhide_count > 0:
-            dest_file.write('quickhide\n{\n')
-            dest_file.write('\t"count" "' + str(self.quickhide_count) + '"\n')
-            dest_file.write('}\n')
+            write(
+                'quickhide\n{\n'
+                '\t"count" "' + str(self.quickhide_count) + '"\n'
+                '}\n'
+            )
 
-        if ret_string:
-            string = dest_file.getvalue()
-            dest_file.close()
-            return string
+    def _export_parallel(self, write, workers: int, mp_context=None):
+        """Export the worldspawn and entities using worker processes.
+
+        The objects are split into chunks, then the text is written in order.
+        The chunks are sent as snapshots, which are cheap to pickle. If a
+        forking context is passed, they read the objects directly instead.
+        """
+        # Use several chunks per worker, so they finish at similar times.
+        chunk_count = workers * 4
+        brushes = self.spawn.solids
+        ents = self.entities
+        brush_size = max(1, -(-len(brushes) // chunk_count))
+        ent_size = max(1, -(-len(ents) // chunk_count))
+        brush_chunks = [
+            (i, i + brush_size)
+            for i in range(0, len(brushes), brush_size)
+        ]
+        ent_chunks = [
+            (i, i + ent_size)
+            for i in range(0, len(ents), ent_size)
+        ]
+
+        head, solid_ind, tail = self.spawn._export_parts('world', '')
+
+        if mp_context is not None and mp_context.get_start_method() == 'fork':
+            # Forked processes are passed the VMF without pickling.
+            executor = mp_context.Pool(
+                workers,
+                _export_init_forked,
+                (self, ),
+            )
+            with executor:
+                brush_text = executor.imap(_export_forked, [
+                    (True, solid_ind, start, end)
+                    for start, end in brush_chunks
+                ])
+                ent_text = executor.imap(_export_forked, [
+                    (False, '', start, end)
+                    for start, end in ent_chunks
+                ])
+                self._export_write_chunks(
+                    write, head, brush_text, tail, ent_text,
+                )
+        else:
+            if mp_context is None:
+                mp_context = multiprocessing.get_context()
+            with mp_context.Pool(workers) as executor:
+                brush_text = executor.imap(_export_snapshots, [
+                    (solid_ind, [
+                        solid._snapshot()
+                        for solid in brushes[start:end]
+                    ], [])
+                    for start, end in brush_chunks
+                ])
+                ent_text = executor.imap(_export_snapshots, [
+                    ('', [], [
+                        ent._snapshot()
+                        for ent in ents[start:end]
+                    ])
+                    for start, end in ent_chunks
+                ])
+                self._export_write_chunks(
+                    write, head, brush_text, tail, ent_text,
+                )
+
+    @staticmethod
+    def _export_write_chunks(
+        write,
+        head: str,
+        brush_text: Iterable[str],
+        tail: str,
+        ent_text: Iterable[str],
+    ):
+        """Write the results from parallel exports in order."""
+        write(head)
+        for text in brush_text:
+            write(text)
+        write(tail)
+        for text in ent_text:
+            write(text)
 
     def iter_wbrushes(self, world=True, detail=True) -> Iterator['Solid']:
         """Iterate through all world and detail solids in the map."""
@@ -738,7 +3200,7 @@ class Camera:
         self.pos = pos
         self.target = targ
         self.map = vmf_file
-        vmf_file.cameras.append(self)
+        vmf_file._list_insert(vmf_file.cameras, len(vmf_file.cameras), self)
 
     def targ_ent(self, ent):
         """Point the camera at an entity."""
@@ -770,16 +3232,22 @@ class Camera:
 
     def remove(self):
         """Delete this camera from the map."""
-        self.map.cameras.remove(self)
+        self.map._list_pop(self.map.cameras, self.map.cameras.index(self))
         if self.is_active():
             self.set_inactive_all()
 
     def export(self, buffer, ind=''):
-        buffer.write(ind + 'camera\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"position" "[' + self.pos.join(' ') + ']"\n')
-        buffer.write(ind + '\t"look" "[' + self.target.join(' ') + ']"\n')
-        buffer.write(ind + '}\n')
+        buffer.write(self._export_text(ind))
+
+    def _export_text(self, ind=''):
+        """Generate the text for this camera."""
+        return (
+            ind + 'camera\n' +
+            ind + '{\n' +
+            ind + '\t"position" "[' + self.pos.join(' ') + ']"\n' +
+            ind + '\t"look" "[' + self.target.join(' ') + ']"\n' +
+            ind + '}\n'
+        )
 
 
 class Cordon:
@@ -797,7 +3265,7 @@ class Cordon:
         self.bounds_min = min_
         self.bounds_max = max_
         self.active = is_active
-        vmf_file.cordons.append(self)
+        vmf_file._list_insert(vmf_file.cordons, len(vmf_file.cordons), self)
 
     @staticmethod
     def parse(vmf_file, tree):
@@ -809,22 +3277,24 @@ class Cordon:
         return Cordon(vmf_file, min_, max_, is_active, name)
 
     def export(self, buffer, ind=''):
-        buffer.write(ind + 'cordon\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"name" "' + self.name + '"\n')
-        buffer.write(ind + '\t"active" "' +
-                     srctools.bool_as_int(self.active) +
-                     '"\n')
-        buffer.write(ind + '\tbox\n')
-        buffer.write(ind + '\t{\n')
-        buffer.write(ind + '\t\t"mins" "(' +
-                     self.bounds_min.join(' ') +
-                     ')"\n')
-        buffer.write(ind + '\t\t"maxs" "(' +
-                     self.bounds_max.join(' ') +
-                     ')"\n')
-        buffer.write(ind + '\t}\n')
-        buffer.write(ind + '}\n')
+        buffer.write(self._export_text(ind))
+
+    def _export_text(self, ind=''):
+        """Generate the text for this cordon."""
+        ind1 = ind + '\t'
+        ind2 = ind + '\t\t'
+        return (
+            ind + 'cordon\n' +
+            ind + '{\n' +
+            ind1 + '"name" "' + self.name + '"\n' +
+            ind1 + '"active" "' + srctools.bool_as_int(self.active) + '"\n' +
+            ind1 + 'box\n' +
+            ind1 + '{\n' +
+            ind2 + '"mins" "(' + self.bounds_min.join(' ') + ')"\n' +
+            ind2 + '"maxs" "(' + self.bounds_max.join(' ') + ')"\n' +
+            ind1 + '}\n' +
+            ind + '}\n'
+        )
 
     def copy(self):
         """Duplicate this cordon."""
@@ -838,7 +3308,7 @@ class Cordon:
 
     def remove(self):
         """Remove this cordon from the map."""
-        self.map.cordons.remove(self)
+        self.map._list_pop(self.map.cordons, self.map.cordons.index(self))
 
 class VisGroup:
     """Defines one visgroup."""
@@ -877,40 +3347,64 @@ class VisGroup:
         )
 
     def export(self, buffer, ind=''):
-        buffer.write(ind + 'visgroup\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"name" "{}"\n'.format(self.name))
-        buffer.write(ind + '\t"visgroupid" "{}"\n'.format(self.id))
-        buffer.write(ind + '\t"color" "{}"\n'.format(self.color))
-        for child in self.child_groups:
-            child.export(buffer, ind + '\t')
-        buffer.write(ind + '}\n')
+        buffer.write(self._export_text(ind))
+
+    def _export_text(self, ind=''):
+        """Generate the text for this visgroup and its children."""
+        ind1 = ind + '\t'
+        return (
+            ind + 'visgroup\n' +
+            ind + '{\n' +
+            ind1 + '"name" "' + self.name + '"\n' +
+            ind1 + '"visgroupid" "' + str(self.id) + '"\n' +
+            ind1 + '"color" "' + str(self.color) + '"\n' +
+            ''.join([child._export_text(ind1) for child in self.child_groups]) +
+            ind + '}\n'
+        )
 
     def set_visible(self, target):
         """Find all objects with this ID, and set them to the given visibility."""
-        for ent in self.child_ents():
-            ent.vis_shown = ent.hidden = target
-            for solid in ent.solids:
-                solid.vis_shown = solid.hidden = target
-
-        for solid in self.child_solids():
-            solid.vis_shown = solid.hidden = target
+        for obj in self.vmf.visgroup_members(self.id):
+            obj.vis_shown = obj.hidden = target
+            obj.mark_dirty()
+            if isinstance(obj, Entity):
+                for solid in obj.solids:
+                    solid.vis_shown = solid.hidden = target
+                    solid.mark_dirty()
 
     def child_ents(self) -> Iterator['Entity']:
         """Yields Entities in this visgroup."""
-        for ent in self.vmf.entities:
-            if self.id in ent.visgroup_ids:
-                yield ent
+        for obj in self.vmf.visgroup_members(self.id):
+            if isinstance(obj, Entity):
+                yield obj
 
     def child_solids(self) -> Iterator['Solid']:
-        """Yields Solids in this visgroup."""
-        for solid in self.vmf.brushes:
-            if self.id in solid.visgroup_ids:
-                yield solid
+        """Yields Solids in this visgroup, including those in brush entities."""
+        for obj in self.vmf.visgroup_members(self.id):
+            if isinstance(obj, Solid):
+                yield obj
 
 
 class Solid:
     """A single brush, serving as both world brushes and brush entities."""
+    __slots__ = [
+        'map',
+        'id',
+        'hidden',
+        'cordon_solid',
+        'vis_shown',
+        'vis_auto_shown',
+        '_group_id',
+        '_sides',
+        '_lazy_sides',
+        '_visgroup_ids',
+        '_editor_color',
+        '_export_cache',
+        '_hull_cache',
+        '_bbox_cache',
+        '__weakref__',
+    ]
+
     def __init__(
             self,
             vmf_file: VMF,
@@ -925,15 +3419,35 @@ class Solid:
             editor_color: Vec=(255, 255, 255),
             ):
         self.map = vmf_file
-        self.sides = sides or []  # type: List[Side]
+        # For lazily parsed brushes, the solid property or side text,
+        # and the reserved side IDs.
+        self._lazy_sides = None  # type: Optional[Tuple[Union[Property, str], List[int]]]
+        self._sides = sides or []  # type: List[Side]
+        for side in self._sides:
+            side._solid = self
         self.id = vmf_file.solid_id.get_id(des_id)
         self.hidden = hidden
         self.cordon_solid = cordon_solid
         self.vis_shown = vis_shown
         self.vis_auto_shown = vis_auto_shown
-        self.editor_color = Vec(editor_color)
-        self.group_id = group_id
-        self.visgroup_ids = set(visgroup_ids)
+        self._editor_color = _shared(tuple(editor_color))
+        self._group_id = group_id
+        self._visgroup_ids = _shared(frozenset(visgroup_ids))
+        # The last text generated by a cached export.
+        self._export_cache = None
+        # The planes, and the face polygons and vertices they produce.
+        self._hull_cache = None
+        # Computed from the sides when first required.
+        self._bbox_cache = None  # type: Optional[Tuple[Vec, Vec]]
+        vmf_file._track_loose(
+            self,
+            vmf_file.solid_id,
+            [side.id for side in self._sides],
+        )
+
+    def __reduce_ex__(self, protocol):
+        """Pickle the brush as a reference into its map, if it's in one."""
+        return self.map._reduce_child(self, protocol)
 
     def copy(self, des_id=-1, map=None, side_mapping=EmptyMapping, keep_vis=True):
         """Duplicate this brush."""
@@ -947,22 +3461,227 @@ class Solid:
             map or self.map,
             des_id,
             sides,
-            self.visgroup_ids if keep_vis else (),
+            self._visgroup_ids if keep_vis else (),
             self.hidden if keep_vis else False,
             self.group_id,
             self.vis_shown if keep_vis else True,
             self.vis_auto_shown if keep_vis else True,
             self.cordon_solid,
-            self.editor_color,
+            self._editor_color,
+        )
+
+    def _stamp(
+        self,
+        vmf: VMF,
+        solid_ids: Iterator[int],
+        face_ids: Iterator[int],
+        side_mapping: Dict[int, int],
+        origin: Vec,
+        matrix: Optional[Tuple[float, ...]],
+        keep_vis: bool,
+    ) -> 'Solid':
+        """Copy this brush with already reserved IDs, then localise it.
+
+        This is used by VMF.stamp().
+        """
+        solid = Solid.__new__(Solid)
+        solid.map = vmf
+        solid.id = next(solid_ids)
+        solid._lazy_sides = None
+        sides = []
+        for side in self.sides:
+            new_side = side._stamp(vmf, next(face_ids), origin, matrix)
+            new_side._solid = solid
+            side_mapping[side.id] = new_side.id
+            sides.append(new_side)
+        solid._sides = sides
+        solid.hidden = self.hidden if keep_vis else False
+        solid.cordon_solid = self.cordon_solid
+        solid.vis_shown = self.vis_shown if keep_vis else True
+        solid.vis_auto_shown = self.vis_auto_shown if keep_vis else True
+        solid._editor_color = _shared(tuple(self._editor_color))
+        solid._group_id = self._group_id
+        if keep_vis:
+            solid._visgroup_ids = _shared(frozenset(self._visgroup_ids))
+        else:
+            solid._visgroup_ids = _NO_VISGROUPS
+        solid._export_cache = None
+        solid._hull_cache = None
+        solid._bbox_cache = None
+        return solid
+
+    def _save_state(self) -> tuple:
+        """Copy our current state, for snapshots."""
+        return (
+            self.id,
+            self.hidden,
+            self.cordon_solid,
+            self.vis_shown,
+            self.vis_auto_shown,
+            self._group_id,
+            _shared(frozenset(self._visgroup_ids)),
+            _shared(tuple(self._editor_color)),
+            list(self.sides),
         )
 
+    def _restore_state(self, state: tuple):
+        """Restore the state from _save_state()."""
+        (
+            self.id,
+            self.hidden,
+            self.cordon_solid,
+            self.vis_shown,
+            self.vis_auto_shown,
+            self._group_id,
+            self._visgroup_ids,
+            self._editor_color,
+            self.sides,
+        ) = state
+        self._export_cache = None
+        self._hull_cache = None
+        self._bbox_cache = None
+
+    @property
+    def visgroup_ids(self) -> Set[int]:
+        """The IDs of the visgroups this brush is in."""
+        ids = self._visgroup_ids
+        if type(ids) is _SharedSet:
+            # Shared, so make our own copy to allow modification.
+            ids = self._visgroup_ids = _VisIDSet(self, ids)
+        return ids
+
+    @visgroup_ids.setter
+    def visgroup_ids(self, ids: Iterable[int]):
+        self.map._touch(self)
+        self._visgroup_ids = _VisIDSet(self, ids)
+        self._export_cache = None
+        self.map._regroup(self)
+
+    @property
+    def group_id(self) -> Optional[int]:
+        """The ID of the group this brush is in, or None."""
+        return self._group_id
+
+    @group_id.setter
+    def group_id(self, group_id: Optional[int]):
+        self.map._touch(self)
+        self._group_id = group_id
+        self._export_cache = None
+        self.map._regroup(self)
+
+    def _group_ids(self) -> FrozenSet[int]:
+        """Return the IDs of the groups this is in."""
+        if self._group_id is None:
+            return frozenset()
+        return frozenset([self._group_id])
+
+    @property
+    def editor_color(self) -> Vec:
+        """The colour used to display this brush in Hammer."""
+        color = self._editor_color
+        if type(color) is _SharedColor:
+            # Shared, so make our own copy to allow modification.
+            color = self._editor_color = _EditorColor(self, color)
+        return color
+
+    @editor_color.setter
+    def editor_color(self, color: Vec):
+        self.map._touch(self)
+        self._editor_color = _EditorColor(self, color)
+        self._export_cache = None
+
+    @property
+    def sides(self) -> List['Side']:
+        """The faces of this brush.
+
+        For lazily parsed brushes, these are parsed when first accessed.
+        """
+        if self._lazy_sides is not None:
+            self._parse_lazy_sides()
+        return self._sides
+
+    @sides.setter
+    def sides(self, sides: List['Side']):
+        self.map._touch(self)
+        if self._lazy_sides is not None:
+            # The unparsed sides are discarded.
+            self.map.face_id.difference_update(self._lazy_sides[1])
+            self._lazy_sides = None
+        index = self.map._mat_index
+        # If our old faces were indexed, we're in the map.
+        if index is not None and any(
+            side in index.get(side._mat.casefold(), ())
+            for side in self._sides
+        ):
+            self.map._unindex_solids([self])
+            self._sides = sides
+            self.map._index_solids([self])
+        else:
+            self._sides = sides
+        for side in sides:
+            side._solid = self
+        self._bbox_cache = None
+
+    def _parse_lazy_sides(self):
+        """Parse the sides of a lazily parsed brush."""
+        source, side_ids = self._lazy_sides
+        self._lazy_sides = None
+        if isinstance(source, str):
+            source = Property.parse(source)
+        face_id = self.map.face_id
+        sides = []
+        for prop, side_id in zip(source.find_all('side'), side_ids):
+            # Release the reserved ID, so the side can use it.
+            face_id.discard(side_id)
+            side = Side.parse(self.map, prop)
+            side._solid = self
+            sides.append(side)
+        self._sides = sides
+
     @staticmethod
-    def parse(vmf_file, tree, hidden=False):
-        """Parse a Property tree into a Solid object."""
-        solid_id = tree.int('id', -1)
+    def parse(vmf_file, tree, hidden=False, lazy=False, side_text=()):
+        """Parse a Property tree into a Solid object.
+
+        If lazy is True, the sides are only parsed when first accessed.
+        side_text is the unparsed text for sides, from VMF.parse().
+        """
+        # Find everything in one pass over the block.
+        solid_id = -1
+        side_props = []
+        editor_block = ()  # type: Iterable[Property]
+        text_ind = ''
+        for prop in tree.value:
+            name = prop._folded_name
+            if name == 'side':
+                side_props.append(prop)
+            elif name == 'id':
+                solid_id = srctools.conv_int(prop.value, -1)
+            elif name == 'editor':
+                editor_block = prop
+            elif name == _LAZY_SIDES_KEY:
+                text_ind = prop.value
+
         sides = []
-        for side in tree.find_all("side"):
-            sides.append(Side.parse(vmf_file, side))
+        lazy_sides = None
+        if lazy:
+            # Reserve the side IDs now, so they don't change.
+            get_id = vmf_file.face_id.get_id
+            if text_ind:
+                source = side_text[int(text_ind)]
+                side_ids = [
+                    get_id(int(side_id))
+                    for side_id in _LAZY_SIDE_ID.findall(source)
+                ]
+            else:
+                source = tree
+                side_ids = [
+                    get_id(side.int('id', -1))
+                    for side in side_props
+                ]
+            lazy_sides = (source, side_ids)
+        else:
+            for side in side_props:
+                sides.append(Side.parse(vmf_file, side))
 
         visgroups = []
         group_id = None
@@ -970,7 +3689,7 @@ class Solid:
         cordon_solid = None
         editor_color = (255, 255, 255)
 
-        for v in tree.find_key("editor", []):
+        for v in editor_block:
             if v.name == "visgroupshown":
                 vis_shown = srctools.conv_bool(v.value, default=True)
             elif v.name == "visgroupautoshown":
@@ -979,14 +3698,14 @@ class Solid:
                 cordon_solid = srctools.conv_int(v.value, default=None)
             elif v.name == 'color':
                 editor_color = Vec.from_str(v.value, 255, 255, 255)
-            elif v.name == 'group':
+            elif v.name in ('group', 'groupid'):
                 group_id = int(v.value)
             elif v.name == 'visgroupid':
                 val = srctools.conv_int(v.value, default=-1)
                 if val:
                     visgroups.append(val)
 
-        return Solid(
+        solid = Solid(
             vmf_file,
             solid_id,
             sides,
@@ -998,46 +3717,49 @@ class Solid:
             cordon_solid,
             editor_color,
         )
+        solid._lazy_sides = lazy_sides
+        return solid
 
     def export(self, buffer, ind=''):
         """Generate the strings needed to define this brush."""
-        if self.hidden:
-            buffer.write(ind + 'hidden\n' + ind + '{\n')
-            ind += '\t'
-        buffer.write(ind + 'solid\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"id" "' + str(self.id) + '"\n')
-        for s in self.sides:
-            s.export(buffer, ind + '\t')
-
-        buffer.write(ind + '\teditor\n')
-        buffer.write(ind + '\t{\n')
-        buffer.write('{}\t\t"color" "{}"\n'.format(ind, self.editor_color))
-        if self.group_id is not None:
-            buffer.write('{}\t\t"groupid" "{}"\n'.format(ind, self.group_id))
-
-        for group in self.visgroup_ids:
-            buffer.write('{}\t\t"visgroupid" "{}"\n'.format(ind, group))
-
-        buffer.write('{}\t\t"visgroupshown" "{}"\n'.format(
-            ind,
-            srctools.bool_as_int(self.vis_shown),
-        ))
-        buffer.write('{}\t\t"visgroupautoshown" "{}"\n'.format(
-            ind,
-            srctools.bool_as_int(self.vis_auto_shown),
-        ))
-        if self.cordon_solid is not None:
-            buffer.write('{}\t\t"cordonsolid" "{}"\n'.format(
-                ind,
-                self.cordon_solid,
-            ))
+        buffer.write(self._export_text(ind))
 
-        buffer.write(ind + '\t}\n')
+    def _cached_text(self, ind='') -> str:
+        """Generate the text for this brush, reusing the last cached text.
 
-        buffer.write(ind + '}\n')
-        if self.hidden:
-            buffer.write(ind[:-1] + '}\n')
+        The cache is used if this brush and its sides were not modified.
+        """
+        key = (ind, self.hidden, tuple(self.sides))
+        cache = self._export_cache
+        if (
+            cache is not None and
+            cache[0] == key and
+            not any([side._dirty for side in self.sides])
+        ):
+            return cache[1]
+        text = self._export_text(ind)
+        for side in self.sides:
+            side._dirty = False
+        self._export_cache = (key, text)
+        return text
+
+    def _export_text(self, ind=''):
+        """Generate the text for this brush."""
+        return _solid_text(ind, self._snapshot())
+
+    def _snapshot(self) -> tuple:
+        """Produce a snapshot of this brush, for exporting."""
+        return (
+            self.id,
+            [side._snapshot() for side in self.sides],
+            sorted(self._visgroup_ids),
+            self.hidden,
+            self._group_id,
+            self.vis_shown,
+            self.vis_auto_shown,
+            self.cordon_solid,
+            tuple(self._editor_color),
+        )
 
     def __str__(self):
         """Return a user-friendly description of our data."""
@@ -1051,23 +3773,93 @@ class Solid:
         for s in self.sides:
             yield s
 
-    def __del__(self):
-        """Forget this solid's ID when the object is destroyed."""
-        if self.id in self.map.solid_id:
-            self.map.solid_id.remove(self.id)
-
     def remove(self):
         """Remove this brush from the map."""
         self.map.remove_brush(self)
 
+    def mark_dirty(self):
+        """Indicate this brush was modified, so cached text is regenerated.
+
+        This is only required after directly changing attributes.
+        """
+        self._export_cache = None
+        self._hull_cache = None
+        self._bbox_cache = None
+        self.map._regroup(self)
+        self.map._mark_moved(self)
+
+    def vertices(self) -> List[Vec]:
+        """Compute the vertices of this brush, from the planes of the faces.
+
+        The result is cached, and recomputed if any planes change.
+        """
+        polygons, vertices = self._hull()
+        return [Vec(point) for point in vertices]
+
+    def _hull(self) -> Tuple[
+        List[List[Tuple[float, float, float]]],
+        List[Tuple[float, float, float]],
+    ]:
+        """Compute the polygon for each face and the vertices, or use the cache.
+        """
+        sides = self.sides
+        key = tuple([
+            (point.x, point.y, point.z)
+            for side in sides
+            for point in side.planes
+        ])
+        cache = self._hull_cache
+        if cache is not None and cache[0] == key:
+            return cache[1], cache[2]
+
+        for side in sides:
+            side._solid = self
+        polygons = _brush_polygons(key)
+        vertices = list(dict.fromkeys([
+            point
+            for poly in polygons
+            for point in poly
+        ]))
+        self._hull_cache = key, polygons, vertices
+        return polygons, vertices
+
+    def free_ids(self):
+        """Release the IDs used by this brush and its faces.
+
+        This is done by VMF.remove_brush() and remove_ent(). Brushes created
+        but never added to the map release them when garbage collected.
+        """
+        self.map._adopt(self)
+        self.map.solid_id.discard(self.id)
+        if self._lazy_sides is not None:
+            self.map.face_id.difference_update(self._lazy_sides[1])
+        else:
+            for side in self._sides:
+                side.free_ids()
+
+    def _reserve_ids(self):
+        """Reserve our IDs again, when added back to the map."""
+        self.map.solid_id.add(self.id)
+        if self._lazy_sides is not None:
+            self.map.face_id.update(self._lazy_sides[1])
+        else:
+            self.map.face_id.update([side.id for side in self._sides])
+
     def get_bbox(self) -> Tuple[Vec, Vec]:
-        """Get two vectors representing the space this brush takes up."""
-        bbox_min, bbox_max = self.sides[0].get_bbox()
-        for s in self.sides[1:]:
-            side_min, side_max = s.get_bbox()
-            bbox_max.max(side_max)
-            bbox_min.min(side_min)
-        return bbox_min, bbox_max
+        """Get two vectors representing the space this brush takes up.
+
+        This is cached until the sides change. After adding or removing
+        sides directly, call mark_dirty().
+        """
+        cache = self._bbox_cache
+        if cache is None:
+            bbox_min, bbox_max = self.sides[0].get_bbox()
+            for s in self.sides[1:]:
+                side_min, side_max = s.get_bbox()
+                bbox_max.max(side_max)
+                bbox_min.min(side_min)
+            cache = self._bbox_cache = bbox_min, bbox_max
+        return cache[0].copy(), cache[1].copy()
 
     def get_origin(self, bbox_min: Vec=None, bbox_max: Vec=None) -> Vec:
         """Calculates a vector representing the exact center of this brush."""
@@ -1077,13 +3869,11 @@ class Solid:
 
     def translate(self, diff: Vec):
         """Move this solid by the specified vector."""
-        for s in self.sides:
-            s.translate(diff)
+        translate_solids([self], diff)
 
     def localise(self, origin: Vec, angles: Vec=None):
         """Shift this brush by the given origin/angles."""
-        for s in self.sides:
-            s.localise(origin, angles)
+        localise_solids([self], origin, angles)
 
 
 class UVAxis:
@@ -1107,14 +3897,7 @@ class UVAxis:
     @staticmethod
     def parse(value: str) -> 'UVAxis':
         """Parse a UV axis from a string."""
-        vals = value.split()
-        return UVAxis(
-            x=float(vals[0].lstrip('[')),
-            y=float(vals[1]),
-            z=float(vals[2]),
-            offset=float(vals[3].rstrip(']')),
-            scale=float(vals[4]),
-        )
+        return UVAxis(*_parse_uv_axis(value))
 
     def copy(self) -> 'UVAxis':
         """Return a duplicate of this axis."""
@@ -1139,33 +3922,28 @@ class UVAxis:
 
     def localise(self, origin: Vec, angles: Vec) -> 'UVAxis':
         """Rotate and translate the texture coordinates."""
-        vec = self.vec().rotate(*angles)
+        return self._localise_mat(origin, Vec.rotation_matrix(*angles))
 
-        # Fix offset - see source-sdk: utils/vbsp/map.cpp line 2237
-        offset = self.offset - origin.dot(vec) / self.scale
-
-        # Keep the values low. The highest texture size in P2 is 1024, so
-        # do the next power just to be safe.
-        # Add and subtract 1024 so the value is between -1024, 1024 not 0, 2048
-        # (This just looks nicer)
-        offset = (offset + 1024) % 2048 - 1024
+    def _localise_mat(
+        self,
+        origin: Vec,
+        matrix: Optional[Tuple[float, ...]],
+    ) -> 'UVAxis':
+        """Implement localise(), with a precomputed rotation matrix.
 
-        return UVAxis(
-            vec.x,
-            vec.y,
-            vec.z,
-            offset,
-            self.scale,
-        )
+        If the matrix is None, the axis is not rotated.
+        """
+        [axis] = _localise_uv_mat([self], origin, matrix)
+        return axis
 
     def __str__(self):
         """Generate the text form for this UV data."""
-        return '[{x:g} {y:g} {z:g} {off:g}] {scale:g}'.format(
-            x=self.x,
-            y=self.y,
-            z=self.z,
-            off=self.offset,
-            scale=self.scale,
+        return _UV_FORMAT % (
+            self.x,
+            self.y,
+            self.z,
+            self.offset,
+            self.scale,
         )
 
     def __repr__(self):
@@ -1186,11 +3964,11 @@ class Side:
     """A brush face."""
     __slots__ = [
         'map',
-        'planes',
+        '_planes',
         'id',
         'lightmap',
         'smooth',
-        'mat',
+        '_mat',
         'ham_rot',
         'uaxis',
         'vaxis',
@@ -1202,6 +3980,11 @@ class Side:
         'disp_allowed_verts',
         'disp_data',
         'is_disp',
+        '_dirty',
+        '_solid',
+        '_normal_cache',
+        '_bbox_cache',
+        '__weakref__',
     ]
 
     def __init__(
@@ -1225,14 +4008,22 @@ class Side:
         :type planes: list of [(int, int, int)]
         """
         self.map = vmf_file
-        self.planes = [Vec(), Vec(), Vec()]
+        self._planes = [Vec(), Vec(), Vec()]
         self.id = vmf_file.face_id.get_id(des_id)
         for i, pln in enumerate(planes):
-            self.planes[i] = Vec(x=pln[0], y=pln[1], z=pln[2])
+            self._planes[i] = Vec(x=pln[0], y=pln[1], z=pln[2])
         self.lightmap = lightmap
         self.smooth = smoothing
-        self.mat = mat
+        # Only a few materials are used, so share the strings.
+        self._mat = sys.intern(mat)
         self.ham_rot = rotation
+        # Set when changed since the solid last cached its text.
+        self._dirty = True
+        # The brush this is part of, set by Solid.
+        self._solid = None  # type: Optional[Solid]
+        # Computed from the planes when first required.
+        self._normal_cache = None  # type: Optional[Vec]
+        self._bbox_cache = None  # type: Optional[Tuple[Vec, Vec]]
         self.uaxis = uaxis or UVAxis(0, 1, 0)
         self.vaxis = vaxis or UVAxis(0, 0, -1)
         if disp_data is not None:
@@ -1249,64 +4040,155 @@ class Side:
             self.disp_allowed_verts = disp_data.get('allowed_verts', {})
             self.disp_data = {}
             for v in _DISP_ROWS:
-                self.disp_data[v] = disp_data.get(v, [])
+                self.disp_data[v] = _decode_disp_rows(v, disp_data.get(v, []))
             self.is_disp = True
         else:
             self.is_disp = False
 
+    @property
+    def planes(self) -> List[Vec]:
+        """The three points defining the plane of this face.
+
+        Replacing points updates the cached geometry, but after modifying
+        the points in place call mark_dirty().
+        """
+        planes = self._planes
+        if type(planes) is not _PlaneList:
+            planes = self._planes = _PlaneList(self, planes)
+        return planes
+
+    @planes.setter
+    def planes(self, planes: List[Vec]):
+        self.map._touch(self)
+        self._planes = planes
+        self._dirty = True
+        self._moved()
+
+    def _moved(self):
+        """Discard the cached geometry, after the planes change."""
+        self._normal_cache = self._bbox_cache = None
+        if self._solid is not None:
+            self._solid._bbox_cache = None
+
+    @property
+    def mat(self) -> str:
+        """The material applied to this face."""
+        return self._mat
+
+    @mat.setter
+    def mat(self, mat: str):
+        self.map._touch(self)
+        old = self._mat
+        # Only a few materials are used, so share the strings.
+        self._mat = mat = sys.intern(mat)
+        self._dirty = True
+        solid = self._solid
+        if solid is None or solid.map._mat_index is None:
+            return
+        index = solid.map._mat_index
+        old_key = old.casefold()
+        new_key = mat.casefold()
+        if old_key == new_key:
+            return
+        try:
+            sides = index[old_key]
+        except KeyError:
+            return
+        if self not in sides:
+            # Not in the map.
+            return
+        sides.discard(self)
+        if not sides:
+            del index[old_key]
+        try:
+            index[new_key].add(self)
+        except KeyError:
+            index[new_key] = {self}
+
     @staticmethod
     def parse(vmf_file, tree):
         """Parse the property tree into a Side object."""
+        return _parse_side(vmf_file, tree)
+
+    @staticmethod
+    def _parse_disp(vmf_file, values: Dict[str, Any]) -> 'Side':
+        """Parse a displacement side, from the values in its block.
+
+        These are rare, so _parse_side() passes them to this.
+        """
         # planes = "(x1 y1 z1) (x2 y2 z2) (x3 y3 z3)"
-        verts = tree["plane", "(0 0 0) (0 0 0) (0 0 0)"][1:-1].split(") (")
-        side_id = tree.int('id', -1)
-        planes = [0, 0, 0]
-        for i, v in enumerate(verts):
-            if i > 3:
-                raise ValueError('Wrong number of solid planes in "' +
-                                 tree['plane', ''] +
-                                 '"')
-            verts = v.split(" ")
-            if len(verts) == 3:
-                planes[i] = [float(v) for v in verts]
-            else:
-                raise ValueError('Invalid planes in "' +
-                                 tree['plane', ''] +
-                                 '"!')
-
-        disp_tree = tree.find_key('dispinfo', [])
-        if len(disp_tree) > 0:
-            disp_data = {
-                'power': disp_tree['power', '4'],
-                'pos': disp_tree['startposition', '4'],
-                'flags': disp_tree['flags', '0'],
-                'elevation': disp_tree['elevation', '0'],
-                'subdiv': disp_tree['subdiv', '0'],
-                'allowed_verts': {},
-            }
-            for prop in disp_tree.find_key('allowed_verts', []):
-                disp_data['allowed_verts'][prop.name] = prop.value
-            for v in _DISP_ROWS:
-                rows = disp_tree[v, []]
-                if len(rows) > 0:
-                    rows.sort(key=lambda x: srctools.conv_int(x.name[3:]))
-                    disp_data[v] = [v.value for v in rows]
-        else:
-            disp_data = None
+        planes = _parse_plane(values.get('plane', '(0 0 0) (0 0 0) (0 0 0)'))
+
+        disp_tree = Property('dispinfo', values['dispinfo'])
+        disp_data = {
+            'power': disp_tree['power', '4'],
+            'pos': disp_tree['startposition', '4'],
+            'flags': disp_tree['flags', '0'],
+            'elevation': disp_tree['elevation', '0'],
+            'subdiv': disp_tree['subdiv', '0'],
+            'allowed_verts': {},
+        }
+        for prop in disp_tree.find_key('allowed_verts', []):
+            disp_data['allowed_verts'][prop.name] = prop.value
+        for v in _DISP_ROWS:
+            rows = disp_tree[v, []]
+            if len(rows) > 0:
+                rows.sort(key=lambda x: srctools.conv_int(x.name[3:]))
+                disp_data[v] = [v.value for v in rows]
 
         return Side(
             vmf_file,
             planes=planes,
-            des_id=side_id,
+            des_id=srctools.conv_int(values.get('id'), -1),
             disp_data=disp_data,
-            mat=tree['material', ''],
-            uaxis=UVAxis.parse(tree['uaxis', '[0 1 0 0] 0.25']),
-            vaxis=UVAxis.parse(tree['vaxis', '[0 0 -1 0] 0.25']),
-            rotation=tree.float('rotation', 0),
-            lightmap=tree.int('lightmapscale', 16),
-            smoothing=tree.int('smoothing_groups', 0),
+            mat=values.get('material', ''),
+            uaxis=UVAxis(*_parse_uv_axis(values.get('uaxis', '[0 1 0 0] 0.25'))),
+            vaxis=UVAxis(*_parse_uv_axis(values.get('vaxis', '[0 0 -1 0] 0.25'))),
+            rotation=srctools.conv_float(values.get('rotation'), 0),
+            lightmap=srctools.conv_int(values.get('lightmapscale'), 16),
+            smoothing=srctools.conv_int(values.get('smoothing_groups'), 0),
         )
 
+    @property
+    def disp_size(self) -> int:
+        """The number of vertices along each edge of a displacement."""
+        return 2 ** self.disp_power + 1
+
+    def disp_fill_alpha(self, alpha: float):
+        """Set the alpha of every vertex in a displacement."""
+        self.map._touch(self)
+        self.disp_data['alphas'] = array('d', [alpha]) * self.disp_size ** 2
+        self._dirty = True
+
+    def disp_smooth_alpha(self, passes=1):
+        """Blur the alpha values of a displacement.
+
+        Each pass averages every vertex with its neighbours.
+        """
+        size = self.disp_size
+        alphas = self.disp_data['alphas']
+        if len(alphas) != size * size:
+            raise ValueError('Displacement has no alpha data!')
+        self.map._touch(self)
+        for _ in range(passes):
+            smoothed = array('d', alphas)
+            for y in range(size):
+                rows = range(max(0, y - 1) * size, min(size, y + 2) * size, size)
+                for x in range(size):
+                    x_min = max(0, x - 1)
+                    x_max = min(size, x + 2)
+                    total = 0.0
+                    for row in rows:
+                        total += sum(alphas[row + x_min: row + x_max])
+                    smoothed[y * size + x] = total / (len(rows) * (x_max - x_min))
+            alphas = smoothed
+        self.disp_data['alphas'] = alphas
+        self._dirty = True
+
+    def __reduce_ex__(self, protocol):
+        """Pickle the face as a reference into its map, if it's in one."""
+        return self.map._reduce_child(self, protocol)
+
     def copy(self, des_id=-1, map=None, side_mapping=EmptyMapping):
         """Duplicate this brush side.
 
@@ -1314,7 +4196,7 @@ class Side:
         map is the VMF to add the new side to (defaults to the same map).
         If passed, side_mapping will be updated with a old -> new ID pair.
         """
-        planes = [p.as_tuple() for p in self.planes]
+        planes = [p.as_tuple() for p in self._planes]
         if self.is_disp:
             disp_data = self.disp_data.copy()
             disp_data['power'] = self.disp_power
@@ -1332,7 +4214,7 @@ class Side:
             map or self.map,
             planes=planes,
             des_id=des_id,
-            mat=self.mat,
+            mat=self._mat,
             rotation=self.ham_rot,
             uaxis=self.uaxis.copy(),
             vaxis=self.vaxis.copy(),
@@ -1343,73 +4225,127 @@ class Side:
         side_mapping[self.id] = copy.id
         return copy
 
+    def _stamp(
+        self,
+        vmf: VMF,
+        side_id: int,
+        origin: Vec,
+        matrix: Optional[Tuple[float, ...]],
+    ) -> 'Side':
+        """Copy this side with an already reserved ID, then localise it.
+
+        This is used by VMF.stamp().
+        """
+        side = Side.__new__(Side)
+        side.map = vmf
+        side.id = side_id
+        off_x, off_y, off_z = origin
+        if matrix is None:
+            side._planes = [
+                Vec(point.x + off_x, point.y + off_y, point.z + off_z)
+                for point in self._planes
+            ]
+        else:
+            # Inlined Vec.rotate_mat(), for speed.
+            a, b, c, d, e, f, g, h, i = matrix
+            side._planes = [
+                Vec(
+                    round(point.x * a + point.y * b + point.z * c, 3) + 0.0 + off_x,
+                    round(point.x * d + point.y * e + point.z * f, 3) + 0.0 + off_y,
+                    round(point.x * g + point.y * h + point.z * i, 3) + 0.0 + off_z,
+                )
+                for point in self._planes
+            ]
+        side.lightmap = self.lightmap
+        side.smooth = self.smooth
+        side._mat = self._mat
+        side.ham_rot = self.ham_rot
+        side._dirty = True
+        side._solid = None
+        side._normal_cache = side._bbox_cache = None
+        side.uaxis = self.uaxis._localise_mat(origin, matrix)
+        side.vaxis = self.vaxis._localise_mat(origin, matrix)
+        side.is_disp = self.is_disp
+        if self.is_disp:
+            side.disp_power = self.disp_power
+            side.disp_pos = self.disp_pos.copy()
+            side.disp_flags = self.disp_flags
+            side.disp_elev = self.disp_elev
+            side.disp_is_subdiv = self.disp_is_subdiv
+            side.disp_allowed_verts = self.disp_allowed_verts.copy()
+            side.disp_data = {
+                key: rows[:]
+                for key, rows in self.disp_data.items()
+            }
+        return side
+
     def export(self, buffer, ind=''):
         """Generate the strings required to define this side in a VMF."""
-        buffer.write(ind + 'side\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"id" "' + str(self.id) + '"\n')
-        pl_str = ('(' + p.join(' ') + ')' for p in self.planes)
-        buffer.write(ind + '\t"plane" "' + ' '.join(pl_str) + '"\n')
-        buffer.write(ind + '\t"material" "' + self.mat + '"\n')
-        buffer.write(ind + '\t"uaxis" "' + str(self.uaxis) + '"\n')
-        buffer.write(ind + '\t"vaxis" "' + str(self.vaxis) + '"\n')
-        buffer.write(ind + '\t"rotation" "' + str(self.ham_rot) + '"\n')
-        buffer.write(ind + '\t"lightmapscale" "' + str(self.lightmap) + '"\n')
-        buffer.write(ind + '\t"smoothing_groups" "' + str(self.smooth) + '"\n')
+        buffer.write(self._export_text(ind))
+
+    def _export_text(self, ind=''):
+        """Generate the text for this side."""
+        return _side_text(ind, self._snapshot())
+
+    def _snapshot(self) -> tuple:
+        """Produce a snapshot of this side, for exporting."""
+        pl_1, pl_2, pl_3 = self._planes
+        uaxis = self.uaxis
+        vaxis = self.vaxis
         if self.is_disp:
-            buffer.write(ind + '\tdispinfo\n')
-            buffer.write(ind + '\t{\n')
-
-            buffer.write(ind + '\t\t"power" "' + str(self.disp_power) + '"\n')
-            buffer.write(ind + '\t\t"startposition" "[' +
-                         self.disp_pos.join(' ') +
-                         ']"\n')
-            buffer.write(ind + '\t\t"flags" "' + str(self.disp_flags) +
-                         '"\n')
-            buffer.write(ind + '\t\t"elevation" "' + str(self.disp_elev) +
-                         '"\n')
-            buffer.write(ind + '\t\t"subdiv" "' +
-                         srctools.bool_as_int(self.disp_is_subdiv) +
-                         '"\n')
-            for v in _DISP_ROWS:
-                if len(self.disp_data[v]) > 0:
-                    buffer.write(ind + '\t\t' + v + '\n')
-                    buffer.write(ind + '\t\t{\n')
-                    for i, data in enumerate(self.disp_data[v]):
-                        buffer.write(ind + '\t\t\t"row' + str(i) +
-                                     '" "' + data +
-                                     '"\n')
-                    buffer.write(ind + '\t\t}\n')
-            if len(self.disp_allowed_verts) > 0:
-                buffer.write(ind + '\t\tallowed_verts\n')
-                buffer.write(ind + '\t\t{\n')
-                for k, v in self.disp_allowed_verts.items():
-                    buffer.write(ind + '\t\t\t"' + k + '" "' + v + '"\n')
-                buffer.write(ind + '\t\t}\n')
-            buffer.write(ind + '\t}\n')
-        buffer.write(ind + '}\n')
+            disp = (
+                self.disp_power,
+                self.disp_pos.as_tuple(),
+                self.disp_flags,
+                self.disp_elev,
+                self.disp_is_subdiv,
+                self.disp_allowed_verts,
+                self.disp_data,
+            )
+        else:
+            disp = None
+        return (
+            self.id,
+            (
+                pl_1.x, pl_1.y, pl_1.z,
+                pl_2.x, pl_2.y, pl_2.z,
+                pl_3.x, pl_3.y, pl_3.z,
+            ),
+            self.mat,
+            (uaxis.x, uaxis.y, uaxis.z, uaxis.offset, uaxis.scale),
+            (vaxis.x, vaxis.y, vaxis.z, vaxis.offset, vaxis.scale),
+            self.ham_rot,
+            self.lightmap,
+            self.smooth,
+            disp,
+        )
 
     def __str__(self):
         """Dump a user-friendly representation of the side."""
         st = "\tmat = " + self.mat
         st += "\n\trotation = " + str(self.ham_rot) + '\n'
-        pl_str = ['(' + p.join(' ') + ')' for p in self.planes]
+        pl_str = ['(' + p.join(' ') + ')' for p in self._planes]
         st += '\tplane: ' + ", ".join(pl_str) + '\n'
         return st
 
-    def __del__(self):
-        """Forget this side's ID when the object is destroyed."""
-        if self.id in self.map.face_id:
-            self.map.face_id.remove(self.id)
+    def free_ids(self):
+        """Release the ID used by this side, so it can be reused."""
+        self.map.face_id.discard(self.id)
 
     def get_bbox(self) -> Tuple[Vec, Vec]:
-        """Generate the highest and lowest points these planes form."""
-        bbox_max = self.planes[0].copy()
-        bbox_min = self.planes[0].copy()
-        for v in self.planes[1:]:
-            bbox_max.max(v)
-            bbox_min.min(v)
-        return bbox_min, bbox_max
+        """Generate the highest and lowest points these planes form.
+
+        This is cached until the planes change.
+        """
+        cache = self._bbox_cache
+        if cache is None:
+            bbox_max = self._planes[0].copy()
+            bbox_min = self._planes[0].copy()
+            for v in self._planes[1:]:
+                bbox_max.max(v)
+                bbox_min.min(v)
+            cache = self._bbox_cache = bbox_min, bbox_max
+        return cache[0].copy(), cache[1].copy()
 
     def get_origin(self) -> Vec:
         """Calculates a vector representing the exact center of this plane."""
@@ -1422,7 +4358,10 @@ class Side:
 
         - A tuple can be passed in instead if desired.
         """
-        for p in self.planes:
+        self.map._touch(self)
+        self._dirty = True
+        self._moved()
+        for p in self._planes:
             p += diff
 
         u_axis = Vec(self.uaxis.x, self.uaxis.y, self.uaxis.z)
@@ -1437,14 +4376,29 @@ class Side:
 
         This preserves texture offsets
         """
-        for p in self.planes:
-            p.localise(origin, angles)
-
         if angles is None:
-            angles = Vec()
+            self._localise_mat(origin, None)
+        else:
+            self._localise_mat(origin, Vec.rotation_matrix(*angles))
+
+    def _localise_mat(self, origin: Vec, matrix: Optional[Tuple[float, ...]]):
+        """Implement localise(), with a precomputed rotation matrix.
 
-        self.uaxis = self.uaxis.localise(origin, angles)
-        self.vaxis = self.vaxis.localise(origin, angles)
+        If the matrix is None, the planes are only translated.
+        """
+        self.map._touch(self)
+        self._dirty = True
+        self._moved()
+        for p in self._planes:
+            if matrix is not None:
+                p.rotate_mat(matrix)
+            p += origin
+
+        self.uaxis, self.vaxis = _localise_uv_mat(
+            [self.uaxis, self.vaxis],
+            origin,
+            matrix,
+        )
 
     def plane_desc(self):
         """Return a string which describes this face.
@@ -1452,31 +4406,120 @@ class Side:
          This is for use in texture randomisation.
          """
         return (
-            self.planes[0].join(' ') +
-            self.planes[1].join(' ') +
-            self.planes[2].join(' ')
+            self._planes[0].join(' ') +
+            self._planes[1].join(' ') +
+            self._planes[2].join(' ')
             )
 
+    def polygon(self) -> List[Vec]:
+        """Compute the vertices of this face, from the planes of its brush.
+
+        The points are clockwise when viewed from outside the brush.
+        The result is cached by the brush - see Solid.vertices().
+        If the plane does not form part of the brush, this is empty.
+        """
+        solid = self._solid
+        if solid is None or self not in solid.sides:
+            raise ValueError('This side is not part of a brush!')
+        polygons, vertices = solid._hull()
+        return [Vec(point) for point in polygons[solid.sides.index(self)]]
+
     def normal(self) -> Vec:
         """Compute the unit vector which extends perpendicular to the face.
 
+        This is cached until the planes change. Setting planes, replacing
+        points in it or methods like translate() clear the cache, but after
+        modifying the points in place call mark_dirty().
         """
-        # The three points are in clockwise order, so we need the first and last
-        # starting from the center point. Then calculate in reverse to get the
-        # normal in the correct direction.
-        point_1 = self.planes[0] - self.planes[1]
-        point_2 = self.planes[2] - self.planes[1]
+        normal = self._normal_cache
+        if normal is None:
+            # The three points are in clockwise order, so we need the first and last
+            # starting from the center point. Then calculate in reverse to get the
+            # normal in the correct direction.
+            point_1 = self._planes[0] - self._planes[1]
+            point_2 = self._planes[2] - self._planes[1]
+            normal = self._normal_cache = point_2.cross(point_1).norm()
+        return normal.copy()
+
+    def _save_state(self) -> tuple:
+        """Copy our current state, for snapshots."""
+        if self.is_disp:
+            disp = (
+                self.disp_power,
+                self.disp_pos.copy(),
+                self.disp_flags,
+                self.disp_elev,
+                self.disp_is_subdiv,
+                self.disp_allowed_verts.copy(),
+                {
+                    key: rows[:]
+                    for key, rows in self.disp_data.items()
+                },
+            )
+        else:
+            disp = None
+        return (
+            self.id,
+            [point.copy() for point in self._planes],
+            self._mat,
+            self.lightmap,
+            self.smooth,
+            self.ham_rot,
+            self.uaxis.copy(),
+            self.vaxis.copy(),
+            self._solid,
+            disp,
+        )
 
-        return point_2.cross(point_1).norm()
+    def _restore_state(self, state: tuple):
+        """Restore the state from _save_state()."""
+        (
+            self.id,
+            self._planes,
+            self._mat,
+            self.lightmap,
+            self.smooth,
+            self.ham_rot,
+            self.uaxis,
+            self.vaxis,
+            self._solid,
+            disp,
+        ) = state
+        self.is_disp = disp is not None
+        if disp is not None:
+            (
+                self.disp_power,
+                self.disp_pos,
+                self.disp_flags,
+                self.disp_elev,
+                self.disp_is_subdiv,
+                self.disp_allowed_verts,
+                self.disp_data,
+            ) = disp
+        self._dirty = True
+        self._moved()
+
+    def mark_dirty(self):
+        """Indicate this side was modified, so cached text is regenerated.
+
+        This is only required after directly changing attributes.
+        """
+        self._dirty = True
+        self._moved()
+        self.map._mark_moved(self)
 
     def scale(self, value):
+        self.map._touch(self)
         self.uaxis.scale = value
         self.vaxis.scale = value
+        self._dirty = True
     scale = property(fset=scale, doc='Set both scale attributes easily.')
 
     def offset(self, value):
+        self.map._touch(self)
         self.uaxis.offset = value
         self.vaxis.offset = value
+        self._dirty = True
     offset = property(fset=offset, doc='Set both offset attributes easily.')
 
 
@@ -1491,6 +4534,29 @@ class Entity:
     Supports [] operations to read and write keyvalues.
     To read instance $replace values operate on entity.fixup[]
     """
+    __slots__ = [
+        'map',
+        'keys',
+        'fixup',
+        'outputs',
+        'solids',
+        'id',
+        'hidden',
+        '_groups',
+        'vis_shown',
+        'vis_auto_shown',
+        'logical_pos',
+        'comments',
+        '_visgroup_ids',
+        '_editor_color',
+        '_key_order',
+        '_export_cache',
+        '_bbox_cache',
+        # Only set on worldspawn, as an alias of VMF.brushes.
+        'hidden_brushes',
+        '__weakref__',
+    ]
+
     def __init__(
         self,
         vmf_file: VMF,
@@ -1521,14 +4587,25 @@ class Entity:
         self.solids = solids or []  # type: List[Solid]
         self.id = vmf_file.ent_id.get_id(ent_id)
         self.hidden = hidden
-        self.groups = list(groups)
+        self._groups = _GroupList(self, groups)
 
-        self.visgroup_ids = set(vis_ids)
+        self._visgroup_ids = _shared(frozenset(vis_ids))
         self.vis_shown = vis_shown
         self.vis_auto_shown = vis_auto_shown
-        self.editor_color = Vec(editor_color)
+        self._editor_color = _shared(tuple(editor_color))
         self.logical_pos = logical_pos or '[0 {}]'.format(self.id)
         self.comments = comments
+        # Cached sorted order of keys, used when exporting.
+        self._key_order = ()  # type: Union[List[str], Tuple[()]]
+        # The last text generated by a cached export.
+        self._export_cache = None
+        # What the bounding box was computed from, the box and the origin.
+        self._bbox_cache = None  # type: Optional[Tuple[Any, Vec, Vec, Vec]]
+        vmf_file._track_loose(self, vmf_file.ent_id)
+
+    def __reduce_ex__(self, protocol):
+        """Pickle the entity as a reference into its map, if it's in one."""
+        return self.map._reduce_child(self, protocol)
 
     def copy(self, des_id=-1, map=None, side_mapping=EmptyMapping, keep_vis=True):
         """Duplicate this entity entirely, including solids and outputs."""
@@ -1544,7 +4621,10 @@ class Entity:
         ]
         outs = [o.copy() for o in self.outputs]
 
-        new_groups = [group.copy() for group in self.groups]
+        new_groups = [
+            group.copy() if isinstance(group, EntityGroup) else group
+            for group in self._groups
+        ]
 
         return Entity(
             vmf_file=map or self.map,
@@ -1556,17 +4636,80 @@ class Entity:
             hidden=self.hidden if keep_vis else False,
             groups=new_groups,
 
-            editor_color=self.editor_color,
+            editor_color=self._editor_color,
             logical_pos=self.logical_pos,
             vis_shown=self.vis_shown if keep_vis else True,
             vis_auto_shown=self.vis_auto_shown if keep_vis else True,
-            vis_ids=self.visgroup_ids if keep_vis else (),
+            vis_ids=self._visgroup_ids if keep_vis else (),
             comments=self.comments,
         )
 
+    def _stamp(
+        self,
+        vmf: VMF,
+        ent_ids: Iterator[int],
+        solid_ids: Iterator[int],
+        face_ids: Iterator[int],
+        side_mapping: Dict[int, int],
+        origin: Vec,
+        angles: Vec,
+        matrix: Optional[Tuple[float, ...]],
+        keep_vis: bool,
+        solids: Optional[List['Solid']]=None,
+    ) -> 'Entity':
+        """Copy this entity with already reserved IDs, then localise it.
+
+        This is used by VMF.stamp(). If solids is passed, only those brushes
+        are copied.
+        """
+        ent = Entity.__new__(Entity)
+        ent.map = vmf
+        ent.keys = self.keys.copy()
+        ent.fixup = EntityFixup(self.fixup.copy_values())
+        ent.outputs = [out.copy() for out in self.outputs]
+        ent.solids = [
+            solid._stamp(
+                vmf, solid_ids, face_ids, side_mapping,
+                origin, matrix, keep_vis,
+            )
+            for solid in (self.solids if solids is None else solids)
+        ]
+        ent.id = next(ent_ids)
+        ent.hidden = self.hidden if keep_vis else False
+        ent._groups = _GroupList(ent, [
+            group.copy() if isinstance(group, EntityGroup) else group
+            for group in self._groups
+        ])
+        if keep_vis:
+            ent._visgroup_ids = _shared(frozenset(self._visgroup_ids))
+        else:
+            ent._visgroup_ids = _NO_VISGROUPS
+        ent.vis_shown = self.vis_shown if keep_vis else True
+        ent.vis_auto_shown = self.vis_auto_shown if keep_vis else True
+        ent._editor_color = _shared(tuple(self._editor_color))
+        ent.logical_pos = self.logical_pos
+        ent.comments = self.comments
+        ent._key_order = self._key_order[:]
+        ent._export_cache = None
+        ent._bbox_cache = None
+        _localise_ent_keys(ent, origin, angles, matrix)
+        return ent
+
     @staticmethod
-    def parse(vmf_file, tree_list: Property, hidden=False):
-        """Parse a property tree into an Entity object."""
+    def parse(
+        vmf_file,
+        tree_list: Property,
+        hidden=False,
+        geometry='full',
+        side_text=(),
+    ):
+        """Parse a property tree into an Entity object.
+
+        geometry is 'full', 'skip' or 'lazy', and side_text the unparsed
+        side text, as for VMF.parse().
+        """
+        skip_solids = geometry == 'skip'
+        lazy = geometry == 'lazy'
         ent_id = -1
         solids = []
         keys = {}
@@ -1595,13 +4738,24 @@ class Entity:
                     value = vals[1]
                     fixup.append(FixupTuple(var, value, int(index)))
             elif name == "solid" and item.has_children():
-                solids.append(Solid.parse(vmf_file, item))
+                if not skip_solids:
+                    solids.append(Solid.parse(
+                        vmf_file, item,
+                        lazy=lazy,
+                        side_text=side_text,
+                    ))
             elif name == "connections" and item.has_children():
                 for out in item:
                     outputs.append(Output.parse(out))
             elif name == "hidden" and item.has_children():
+                if not skip_solids:
                     solids.extend(
-                        Solid.parse(vmf_file, br, hidden=True)
+                        Solid.parse(
+                            vmf_file, br,
+                            hidden=True,
+                            lazy=lazy,
+                            side_text=side_text,
+                        )
                         for br in
                         item
                     )
@@ -1619,7 +4773,7 @@ class Entity:
                         logical_pos = v.value
                     elif v.name == 'comments':
                         comment = v.value
-                    elif v.name == 'group':
+                    elif v.name in ('group', 'groupid'):
                         groups.append(int(v.value))
                     elif v.name == 'visgroupid':
                         val = srctools.conv_int(v.value, default=-1)
@@ -1645,6 +4799,103 @@ class Entity:
             comment,
         )
 
+    def _save_state(self) -> tuple:
+        """Copy our current state, for snapshots."""
+        return (
+            self.id,
+            self.keys.copy(),
+            EntityFixup(self.fixup.copy_values()),
+            [out.copy() for out in self.outputs],
+            # Worldspawn shares this list with VMF.brushes, which is
+            # restored by undoing add_brush() and remove_brush().
+            None if self is self.map.spawn else list(self.solids),
+            self.hidden,
+            list(self._groups),
+            _shared(frozenset(self._visgroup_ids)),
+            self.vis_shown,
+            self.vis_auto_shown,
+            _shared(tuple(self._editor_color)),
+            self.logical_pos,
+            self.comments,
+        )
+
+    def _restore_state(self, state: tuple):
+        """Restore the state from _save_state()."""
+        (
+            self.id,
+            self.keys,
+            self.fixup,
+            self.outputs,
+            solids,
+            self.hidden,
+            groups,
+            self._visgroup_ids,
+            self.vis_shown,
+            self.vis_auto_shown,
+            self._editor_color,
+            self.logical_pos,
+            self.comments,
+        ) = state
+        self._groups = _GroupList(self, groups)
+        if solids is not None:
+            self.solids = solids
+        self._key_order = ()
+        self._export_cache = None
+
+    @property
+    def visgroup_ids(self) -> Set[int]:
+        """The IDs of the visgroups this entity is in."""
+        ids = self._visgroup_ids
+        if type(ids) is _SharedSet:
+            # Shared, so make our own copy to allow modification.
+            ids = self._visgroup_ids = _VisIDSet(self, ids)
+        return ids
+
+    @visgroup_ids.setter
+    def visgroup_ids(self, ids: Iterable[int]):
+        self.map._touch(self)
+        self._visgroup_ids = _VisIDSet(self, ids)
+        self._export_cache = None
+        self.map._regroup(self)
+
+    @property
+    def groups(self) -> List[Union['EntityGroup', int]]:
+        """The groups this entity is in, and the group definitions in worldspawn.
+
+        Modifications update the export cache and group index.
+        """
+        return self._groups
+
+    @groups.setter
+    def groups(self, groups: Iterable[Union['EntityGroup', int]]):
+        self.map._touch(self)
+        self._groups = _GroupList(self, groups)
+        self._export_cache = None
+        self.map._regroup(self)
+
+    def _group_ids(self) -> FrozenSet[int]:
+        """Return the IDs of the groups this is in."""
+        return frozenset([
+            group
+            for group in self._groups
+            if isinstance(group, int)
+        ])
+
+    @property
+    def editor_color(self) -> Vec:
+        """The colour used to display this entity in Hammer."""
+        color = self._editor_color
+        if type(color) is _SharedColor:
+            # Shared, so make our own copy to allow modification.
+            color = self._editor_color = _EditorColor(self, color)
+        return color
+
+    @editor_color.setter
+    def editor_color(self, color: Vec):
+        self.map._touch(self)
+        self._editor_color = _EditorColor(self, color)
+        self._export_cache = None
+
     def is_brush(self):
         """Is this Entity a brush entity?"""
         return len(self.solids) > 0
@@ -1655,57 +4906,75 @@ class Entity:
         ent_name is the key used for the item's block, which is used to allow
         generating the MapSpawn data block from the entity object.
         """
+        buffer.write(self._export_text(ent_name, ind))
 
-        if self.hidden:
-            buffer.write(ind + 'hidden\n' + ind + '{\n')
-            ind += '\t'
-
-        buffer.write(ind + ent_name + '\n')
-        buffer.write(ind + '{\n')
-        buffer.write(ind + '\t"id" "' + str(self.id) + '"\n')
-        for key, value in sorted(self.keys.items(), key=operator.itemgetter(0)):
-            buffer.write(
-                ind +
-                '\t"{}" "{!s}"\n'.format(key, value)
-            )
+    def _export_text(self, ent_name='entity', ind='', use_cache=False):
+        """Generate the text for this entity.
 
-        self.fixup.export(buffer, ind)
+        If use_cache is set, the text from the last cached export is reused
+        if the entity is unchanged. Brushes are cached individually.
+        """
+        if use_cache:
+            key = (ent_name, ind, self.hidden, self.fixup, tuple(self.outputs))
+            cache = self._export_cache
+            if cache is None or cache[0] != key or self.fixup._dirty:
+                cache = self._export_cache = (key, ) + self._export_parts(
+                    ent_name,
+                    ind,
+                )
+                self.fixup._dirty = False
+            _, head, solid_ind, tail = cache
+            return head + ''.join([
+                solid._cached_text(solid_ind)
+                for solid in self.solids
+            ]) + tail
+        else:
+            head, solid_ind, tail = self._export_parts(ent_name, ind)
+            return head + ''.join([
+                solid._export_text(solid_ind)
+                for solid in self.solids
+            ]) + tail
 
-        if self.is_brush():
-            for s in self.solids:
-                s.export(buffer, ind=ind+'\t')
-        if len(self.outputs) > 0:
-            buffer.write(ind + '\tconnections\n')
-            buffer.write(ind + '\t{\n')
-            for o in self.outputs:
-                o.export(buffer, ind=ind+'\t\t')
-            buffer.write(ind + '\t}\n')
+    def _export_parts(self, ent_name: str, ind: str) -> Tuple[str, str, str]:
+        """Generate the text before and after our brushes.
 
-        buffer.write(ind + '\teditor\n')
-        buffer.write(ind + '\t{\n')
-        buffer.write('{}\t\t"color" "{}"\n'.format(ind, self.editor_color))
+        This returns the text, and the indentation for the brushes.
+        """
+        return _ent_parts(ent_name, ind, self._snapshot(solids=False))
 
-        for group in self.groups:
-            buffer.write('{}\t\t"groupid" "{}"\n'.format(ind, group))
+    def _snapshot(self, solids=True) -> tuple:
+        """Produce a snapshot of this entity, for exporting.
 
-        for group in self.visgroup_ids:
-            buffer.write('{}\t\t"visgroupid" "{}"\n'.format(ind, group))
+        If solids is False, brushes are skipped.
+        """
+        keys = self.keys
+        return (
+            self.id,
+            [(key, str(keys[key])) for key in self._sorted_keys()],
+            self.fixup._snapshot(),
+            [out._snapshot() for out in self.outputs],
+            [solid._snapshot() for solid in self.solids] if solids else [],
+            self.hidden,
+            # EntityGroups are only exported as strings.
+            [str(group) for group in self._groups],
+            sorted(self._visgroup_ids),
+            self.vis_shown,
+            self.vis_auto_shown,
+            self.logical_pos,
+            tuple(self._editor_color),
+            self.comments,
+        )
 
-        buffer.write('{}\t\t"visgroupshown" "{}"\n'.format(
-            ind,
-            srctools.bool_as_int(self.vis_shown),
-        ))
-        buffer.write('{}\t\t"visgroupautoshown" "{}"\n'.format(
-            ind,
-            srctools.bool_as_int(self.vis_auto_shown),
-        ))
-        buffer.write('{}\t\t"logicalpos" "{}"\n'.format(ind, self.logical_pos))
-        buffer.write('{}\t\t"comments" "{}"\n'.format(ind, self.comments))
-        buffer.write(ind + '\t}\n')
+    def _sorted_keys(self) -> List[str]:
+        """Return the keyvalue names in sorted order.
 
-        buffer.write(ind + '}\n')
-        if self.hidden:
-            buffer.write(ind[:-1] + '}\n')
+        The order is cached, and only recomputed if keys were added or removed.
+        """
+        keys = self.keys
+        cache = self._key_order
+        if len(cache) != len(keys) or not all(key in keys for key in cache):
+            cache = self._key_order = sorted(keys)
+        return cache
 
     def sides(self):
         """Iterate through all our brush sides."""
@@ -1716,7 +4985,23 @@ class Entity:
 
     def add_out(self, *outputs):
         """Add the outputs to our list."""
+        self.map._touch(self)
         self.outputs.extend(outputs)
+        if self.map._io_graph is not None:
+            self.map._io_graph._mark(self)
+
+    def mark_dirty(self):
+        """Indicate this entity was modified, so cached text is regenerated.
+
+        This is only required after directly changing attributes, keys
+        or outputs.
+        """
+        self._export_cache = None
+        self._bbox_cache = None
+        if self.map._io_graph is not None:
+            self.map._io_graph._mark(self)
+        self.map._regroup(self)
+        self.map._mark_moved(self)
 
     def output_targets(self) -> Set[str]:
         """Return a set of the targetnames this entity triggers."""
@@ -1777,6 +5062,8 @@ class Entity:
         """
         if isinstance(val, bool):
             val = '1' if val else '0'
+        self.map._touch(self)
+        self._export_cache = None
         key_fold = key.casefold()
         for k in self.keys:
             if k.casefold() == key_fold:
@@ -1798,7 +5085,12 @@ class Entity:
                 self.map.by_target[orig_val].remove(self)
             self.map.by_target[val].add(self)
 
+        if key_fold in ('targetname', 'classname') and self.map._io_graph is not None:
+            self.map._io_graph._mark(self)
+
     def __delitem__(self, key):
+        self.map._touch(self)
+        self._export_cache = None
         key = key.casefold()
         if key == 'targetname':
             with suppress(KeyError):
@@ -1814,6 +5106,9 @@ class Entity:
                 ].remove(self)
             self.map.by_class[None].add(self)
 
+        if key in ('targetname', 'classname') and self.map._io_graph is not None:
+            self.map._io_graph._mark(self)
+
         for k in self.keys:
             if k.casefold() == key:
                 del self.keys[k]
@@ -1827,6 +5122,7 @@ class Entity:
         del self['targetname']
         del self['classname']
         self.keys.clear()
+        self._export_cache = None
         # Clear $fixup as well.
         self.fixup.clear()
 
@@ -1841,32 +5137,63 @@ class Entity:
 
     get_key = __contains__
 
-    def __del__(self):
-        """Forget this entity's ID when the object is destroyed."""
-        if self.id in self.map.ent_id:
-            self.map.ent_id.remove(self.id)
+    def free_ids(self):
+        """Release the IDs used by this entity and its brushes.
 
-    def get_bbox(self) -> Tuple[Vec, Vec]:
-        """Get two vectors representing the space this entity takes up."""
-        if self.is_brush():
-            bbox_min, bbox_max = self.solids[0].get_bbox()
-            for s in self.solids[1:]:
-                side_min, side_max = s.get_bbox()
-                bbox_max.max(side_max)
-                bbox_min.min(side_min)
-            return bbox_min, bbox_max
+        This is done by remove(). Entities created but never added to the
+        map release them when garbage collected.
+        """
+        self.map._adopt(self)
+        self.map.ent_id.discard(self.id)
+        for solid in self.solids:
+            solid.free_ids()
+
+    def _bbox(self) -> Tuple[Any, Vec, Vec, Vec]:
+        """Return the cached bounding box and origin, computing if required.
+
+        For brush entities, this is computed from the cached bounding boxes
+        of the brushes, so it's recomputed when Side._moved() or
+        Solid.mark_dirty() clears one of those. For point entities it's
+        recomputed when the origin keyvalue changes.
+        """
+        cache = self._bbox_cache
+        solids = self.solids
+        if solids:
+            key = [solid._bbox_cache for solid in solids]
+            if cache is None or cache[0] != key or None in key:
+                bbox_min, bbox_max = solids[0].get_bbox()
+                for solid in solids[1:]:
+                    side_min, side_max = solid.get_bbox()
+                    bbox_max.max(side_max)
+                    bbox_min.min(side_min)
+                cache = self._bbox_cache = (
+                    [solid._bbox_cache for solid in solids],
+                    bbox_min,
+                    bbox_max,
+                    (bbox_min + bbox_max) / 2,
+                )
         else:
-            origin = self.get_origin()
-            # the bounding box is 0x0 large for a point ent basically
-            return origin, origin.copy()
+            key = self['origin']
+            if cache is None or cache[0] != key:
+                origin = Vec.from_str(key)
+                # the bounding box is 0x0 large for a point ent basically
+                cache = self._bbox_cache = (key, origin, origin, origin)
+        return cache
+
+    def get_bbox(self) -> Tuple[Vec, Vec]:
+        """Get two vectors representing the space this entity takes up.
+
+        This is cached until the brushes or origin change.
+        """
+        key, bbox_min, bbox_max, origin = self._bbox()
+        return bbox_min.copy(), bbox_max.copy()
 
     def get_origin(self) -> Vec:
-        """Return a vector representing the center of this entity's brushes."""
-        if self.is_brush():
-            bbox_min, bbox_max = self.get_bbox()
-            return (bbox_min + bbox_max) / 2
-        else:
-            return Vec.from_str(self['origin'])
+        """Return a vector representing the center of this entity's brushes.
+
+        This is cached until the brushes or origin change.
+        """
+        return self._bbox()[3].copy()
 
 # One $fixup variable with replacement.
 FixupTuple = namedtuple('FixupTuple', 'var value id')
@@ -1881,7 +5208,7 @@ class EntityFixup:
     Additionally, lookups never fail - returning '' instead. Pass in a non-string
     default or use `in` to distinguish,.
     """
-    __slots__ = ['_fixup']
+    __slots__ = ['_fixup', '_used_ids', '_matcher', '_dirty']
 
     def __init__(self, fixup: Iterable[FixupTuple]=()):
         self._fixup = {}
@@ -1889,6 +5216,11 @@ class EntityFixup:
         # value, index) with keys equal to the casefolded var name.
         # var_name is kept to allow restoring the original case when exporting.
 
+        # The regex used by substitute(), built when first needed.
+        self._matcher = None
+        # Set when changed since the entity last cached its text.
+        self._dirty = True
+
         # Do a check to ensure all fixup values have valid indexes:
         used_indexes = set()
         extra_vals = []
@@ -1898,6 +5230,7 @@ class EntityFixup:
                 self._fixup[fix.var.casefold()] = fix
             else:
                 extra_vals.append(fix)
+        self._used_ids = IDMan(fix.id for fix in self._fixup.values())
         for fix in extra_vals:
             # Add these values wherever they'll fit.
             self[fix.var] = fix.value
@@ -1922,6 +5255,9 @@ class EntityFixup:
     def clear(self):
         """Wipe all the $fixup values."""
         self._fixup.clear()
+        self._used_ids.clear()
+        self._matcher = None
+        self._dirty = True
 
     def update(self, other):
         """Copy the keys of the other item to this one.
@@ -1955,24 +5291,22 @@ class EntityFixup:
         if var[0] == '$':
             var = var[1:]
 
-            val = (
-                ('1' if val else '0')
-                if isinstance(val, bool)
-                else str(val)
-            )
+        val = (
+            ('1' if val else '0')
+            if isinstance(val, bool)
+            else str(val)
+        )
 
+        self._dirty = True
         folded_var = var.casefold()
         if folded_var not in self._fixup:
             # Insert a new value. Use the lowest unused index.
-            indexes = {
-                fixup.id
-                for fixup in
-                self._fixup.values()
-            }
-            for ind in itertools.count(start=1):
-                if ind not in indexes:
-                    self._fixup[folded_var] = FixupTuple(var, val, ind)
-                    break
+            self._fixup[folded_var] = FixupTuple(
+                var,
+                val,
+                self._used_ids.get_id(),
+            )
+            self._matcher = None
         else:
             self._fixup[folded_var] = FixupTuple(
                 var,
@@ -1986,7 +5320,9 @@ class EntityFixup:
             var = var[1:]
         var = var.casefold()
         if var in self._fixup:
-            del self._fixup[var]
+            self._used_ids.discard(self._fixup.pop(var).id)
+            self._matcher = None
+            self._dirty = True
 
     def keys(self):
         """Iterate over all set variable names."""
@@ -2004,14 +5340,76 @@ class EntityFixup:
         for value in self._fixup.values():
             yield value.value
 
+    def substitute(self, text: str) -> str:
+        """Replace all $variables in the text with their values.
+
+        All variables are replaced in a single pass. Longer names are matched
+        first, so $var_long is not treated as $var followed by '_long'.
+        Unknown variables are left unchanged.
+        """
+        if '$' not in text or not self._fixup:
+            return text
+        if self._matcher is None:
+            self._matcher = re.compile(
+                r'\$(' + '|'.join(
+                    re.escape(fix.var)
+                    for fix in
+                    sorted(
+                        self._fixup.values(),
+                        key=lambda fix: len(fix.var),
+                        reverse=True,
+                    )
+                ) + ')',
+                re.IGNORECASE,
+            )
+        fixups = self._fixup
+        return self._matcher.sub(
+            lambda match: fixups[match.group(1).casefold()].value,
+            text,
+        )
+
+    def substitute_ents(self, ents: Iterable['Entity']):
+        """Apply all the variables to keyvalues and outputs of entities.
+
+        This is used to collapse instances - pass the instance's entities,
+        including the worldspawn.
+        """
+        sub = self.substitute
+        for ent in ents:
+            for key, value in list(ent.keys.items()):
+                new_value = sub(value)
+                if new_value != value:
+                    ent[key] = new_value
+            for var, value in list(ent.fixup.items()):
+                new_value = sub(value)
+                if new_value != value:
+                    ent.fixup[var] = new_value
+            ent.mark_dirty()
+            for out in ent.outputs:
+                out.output = sub(out.output)
+                out.target = sub(out.target)
+                out.input = sub(out.input)
+                out.params = sub(out.params)
+                if out.inst_out is not None:
+                    out.inst_out = sub(out.inst_out)
+                if out.inst_in is not None:
+                    out.inst_in = sub(out.inst_in)
+
     def export(self, buffer, ind):
         """Export all the replace values into the VMF."""
-        if len(self._fixup):
-            for (key, value, index) in sorted(
-                    self._fixup.values(), key=operator.attrgetter('id')):
-                # When exporting, pad with zeros if needed
-                buffer.write(ind + '\t"replace{:02}" "${} {}"\n'.format(
-                    index, key, value))
+        buffer.write(self._export_text(ind))
+
+    def _export_text(self, ind) -> str:
+        """Generate the text for the replace values."""
+        return _fixup_text(ind, self._snapshot())
+
+    def _snapshot(self) -> List[Tuple[str, str, int]]:
+        """Produce a snapshot of the values in order, for exporting."""
+        return [
+            tuple(fixup)
+            for fixup in
+            sorted(self._fixup.values(), key=operator.attrgetter('id'))
+        ]
 
     def __str__(self):
         items = '\n'.join(
@@ -2303,21 +5701,22 @@ class Output:
     def export(self, buffer, ind=''):
         """Generate the text required to define this output in the VMF."""
         buffer.write(ind + self._get_text())
-        
+
     def _get_text(self):
+        return _output_text(self._snapshot())
+
+    def _snapshot(self) -> tuple:
+        """Produce a snapshot of this output, for exporting."""
         return (
-            '"{output}" "{targ}{sep}{input}{sep}{params}'
-            '{sep}{delay:g}{sep}{times}"\n'.format(
-                output=self.exp_out(),
-                targ=self.target,
-                input=self.exp_in(),
-                params=self.params,
-                delay=self.delay,
-                times=self.times,
-                sep=',' if self.comma_sep else OUTPUT_SEP,
-            )
+            self.exp_out(),
+            str(self.target),
+            self.exp_in(),
+            str(self.params),
+            self.delay,
+            self.times,
+            self.comma_sep,
         )
-        
+
 
     def copy(self):
         """Duplicate this output object."""
@@ -2356,3 +5755,903 @@ class Output:
             rep=self.times,
         )
 
+
+class IOGraph:
+    """The connections between entities in a map, made by their outputs.
+
+    Use VMF.io_graph() to get this. Targets are matched case-insensitively
+    against targetnames, then classnames if no entity has that name.
+    Targets starting or ending with a * match multiple names. !self
+    is the entity itself, other ! names are picked in-game and are ignored.
+
+    Entities are indexed once, then only those changed via Entity methods
+    are rechecked. After modifying Entity.outputs directly, call
+    Entity.mark_dirty().
+    """
+    def __init__(self, vmf: VMF):
+        self.map = vmf
+        # Casefolded name -> entities with that name.
+        self._names = {}  # type: Dict[str, Set[Entity]]
+        self._classes = {}  # type: Dict[str, Set[Entity]]
+        # The casefolded (targetname, classname) we indexed each entity with.
+        self._indexed = {}  # type: Dict[Entity, Tuple[str, str]]
+        # Casefolded target -> matching entities, computed when required.
+        self._resolved = {}  # type: Dict[str, FrozenSet[Entity]]
+        # Entities which need to be reindexed, and if they're in the map.
+        self._pending = {}  # type: Dict[Entity, bool]
+        for ent in vmf.entities:
+            self._pending[ent] = True
+
+    def _mark(self, ent: 'Entity', present: Optional[bool]=None):
+        """Record that this entity was changed.
+
+        If present is None, this is only done if the entity is in the map.
+        """
+        if present is None:
+            if ent in self._indexed:
+                self._pending.setdefault(ent, True)
+        else:
+            self._pending[ent] = present
+
+    def _clear(self):
+        """Remove all entities, for VMF.clear()."""
+        self._names.clear()
+        self._classes.clear()
+        self._indexed.clear()
+        self._resolved.clear()
+        self._pending.clear()
+
+    def refresh(self):
+        """Reindex entities changed since the last call.
+
+        This is done automatically by the other methods.
+        """
+        if not self._pending:
+            return
+        changed = set()  # type: Set[str]
+        for ent, present in self._pending.items():
+            try:
+                old_name, old_cls = self._indexed.pop(ent)
+            except KeyError:
+                pass
+            else:
+                self._names.get(old_name, set()).discard(ent)
+                self._classes.get(old_cls, set()).discard(ent)
+                changed.add(old_name)
+                changed.add(old_cls)
+            if present:
+                name = ent['targetname'].casefold()
+                cls = ent['classname'].casefold()
+                self._indexed[ent] = (name, cls)
+                # Blank names can't be targeted.
+                if name:
+                    self._names.setdefault(name, set()).add(ent)
+                    changed.add(name)
+                if cls:
+                    self._classes.setdefault(cls, set()).add(ent)
+                    changed.add(cls)
+        self._pending.clear()
+
+        # Discard resolved targets which could match the changed names.
+        for target in list(self._resolved):
+            if target in changed or (
+                '*' in target and
+                any(_target_matches(target, name) for name in changed)
+            ):
+                del self._resolved[target]
+
+    def _resolve(self, target: str) -> FrozenSet['Entity']:
+        """Find the entities a casefolded target refers to."""
+        try:
+            return self._resolved[target]
+        except KeyError:
+            pass
+        if '*' in target:
+            found = frozenset().union(*[
+                ents
+                for name, ents in self._names.items()
+                if _target_matches(target, name)
+            ])
+            if not found:
+                found = frozenset().union(*[
+                    ents
+                    for name, ents in self._classes.items()
+                    if _target_matches(target, name)
+                ])
+        else:
+            found = frozenset(
+                self._names.get(target, ()) or
+                self._classes.get(target, ())
+            )
+        self._resolved[target] = found
+        return found
+
+    def _out_targets(self, ent: 'Entity', out: Output) -> Optional[FrozenSet['Entity']]:
+        """Find the entities an output fires, or None if only known in-game."""
+        target = out.target.casefold()
+        if target == '!self':
+            return frozenset([ent])
+        elif target[:1] == '!':
+            return None
+        return self._resolve(target)
+
+    def targets(self, ent: 'Entity') -> Set['Entity']:
+        """Return the entities directly triggered by this entity's outputs."""
+        self.refresh()
+        found = set()  # type: Set[Entity]
+        for out in ent.outputs:
+            ents = self._out_targets(ent, out)
+            if ents:
+                found |= ents
+        return found
+
+    def reachable(self, ent: 'Entity') -> Set['Entity']:
+        """Return every entity which can be triggered by this entity.
+
+        This follows outputs transitively. The entity itself is only included
+        if it is part of a loop.
+        """
+        self.refresh()
+        found = set()  # type: Set[Entity]
+        todo = [ent]
+        while todo:
+            for target in self.targets(todo.pop()):
+                if target not in found:
+                    found.add(target)
+                    todo.append(target)
+        return found
+
+    def dead_outputs(self) -> List[Tuple['Entity', Output]]:
+        """Return all outputs which don't target any entity in the map."""
+        self.refresh()
+        return [
+            (ent, out)
+            for ent in self.map.entities
+            for out in ent.outputs
+            if self._out_targets(ent, out) == frozenset()
+        ]
+
+    def cycles(self) -> List[List['Entity']]:
+        """Return the groups of entities which trigger each other in a loop.
+
+        Each entity in a group can reach all the others.
+        """
+        self.refresh()
+        # Tarjan's algorithm, done iteratively.
+        index = {}  # type: Dict[Entity, int]
+        lowlink = {}  # type: Dict[Entity, int]
+        stack = []  # type: List[Entity]
+        on_stack = set()  # type: Set[Entity]
+        cycles = []  # type: List[List[Entity]]
+        succ = {}  # type: Dict[Entity, List[Entity]]
+
+        for root in self.map.entities:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                ent, pos = work.pop()
+                if pos == 0:
+                    index[ent] = lowlink[ent] = len(index)
+                    stack.append(ent)
+                    on_stack.add(ent)
+                    succ[ent] = list(self.targets(ent))
+                targets = succ[ent]
+                for pos in range(pos, len(targets)):
+                    target = targets[pos]
+                    if target not in index:
+                        work.append((ent, pos + 1))
+                        work.append((target, 0))
+                        break
+                    elif target in on_stack:
+                        lowlink[ent] = min(lowlink[ent], index[target])
+                else:
+                    if lowlink[ent] == index[ent]:
+                        group = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            group.append(member)
+                            if member is ent:
+                                break
+                        if len(group) > 1 or ent in targets:
+                            cycles.append(group)
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[ent])
+        return cycles
+
+
+class MapSnapshot:
+    """A saved state of a map, which it can be rolled back to.
+
+    Use VMF.snapshot() to create these. Nothing is copied up front - adding
+    and removing objects with the methods of VMF is recorded, and brushes,
+    faces and entities are only copied when they are first modified. Methods
+    and properties which modify them do this automatically. Before directly
+    modifying attributes (Side.planes, Entity.outputs, Entity.keys or
+    Entity.fixup), call save() with the object. Changes made directly to the
+    lists of objects in the map are not undone.
+
+    This can be used as a context manager, which discards the changes if an
+    exception occurs and commits them otherwise.
+    """
+    def __init__(self, vmf: VMF):
+        self.map = vmf
+        self.active = True
+        # The original state of each modified object.
+        self._saved = {}  # type: Dict[Union[Solid, Side, Entity], tuple]
+        # (func, args) pairs which undo each change to the lists of objects.
+        self._undo = []  # type: List[tuple]
+
+    def __enter__(self) -> 'MapSnapshot':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.active:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def save(self, *objects: Union['Solid', 'Side', 'Entity']):
+        """Record the state of these objects, before they are modified."""
+        saved = self._saved
+        for obj in objects:
+            if obj not in saved:
+                saved[obj] = obj._save_state()
+
+    def _finish(self):
+        """Stop recording changes."""
+        if not self.active:
+            raise ValueError('Snapshot was already committed or discarded!')
+        if self.map._snapshots[-1] is not self:
+            raise ValueError('Snapshots must be finished in reverse order!')
+        self.map._snapshots.pop()
+        self.active = False
+
+    def commit(self):
+        """Keep all the changes made since the snapshot."""
+        self._finish()
+        self._saved.clear()
+        self._undo.clear()
+
+    def discard(self):
+        """Undo all the changes made since the snapshot."""
+        self._finish()
+        vmf = self.map
+        # Any outer snapshots record these changes too, so they can
+        # also be undone.
+        for func, args in reversed(self._undo):
+            func(*args)
+        self._undo.clear()
+        for obj, state in self._saved.items():
+            vmf._restore(obj, state)
+        self._saved.clear()
+
+
+def _target_matches(target: str, name: str) -> bool:
+    """Check if a target with wildcards matches this name."""
+    if target[:1] == '*':
+        if target[-1:] == '*':
+            return target[1:-1] in name
+        return name.endswith(target[1:])
+    elif target[-1:] == '*':
+        return name.startswith(target[:-1])
+    return target == name
+
+
+def _brush_polygons(
+    points: Tuple[Tuple[float, float, float], ...],
+) -> List[List[Tuple[float, float, float]]]:
+    """Compute the polygon for each face of a convex brush.
+
+    points contains the three plane points for each face. Each face starts
+    as a huge square on its plane, which is then clipped by all the
+    other planes.
+    """
+    planes = []
+    for i in range(0, len(points), 3):
+        (x1, y1, z1), (x2, y2, z2), (x3, y3, z3) = points[i:i + 3]
+        # This is the reverse of Side.normal(), so it points outward.
+        ax, ay, az = x1 - x2, y1 - y2, z1 - z2
+        bx, by, bz = x3 - x2, y3 - y2, z3 - z2
+        norm_x = ay * bz - az * by
+        norm_y = az * bx - ax * bz
+        norm_z = ax * by - ay * bx
+        length = math.sqrt(norm_x ** 2 + norm_y ** 2 + norm_z ** 2)
+        if length < 1e-6:
+            # Degenerate plane.
+            planes.append(None)
+            continue
+        norm_x /= length
+        norm_y /= length
+        norm_z /= length
+        planes.append((
+            norm_x, norm_y, norm_z,
+            norm_x * x2 + norm_y * y2 + norm_z * z2,
+        ))
+
+    polygons = []
+    for plane in planes:
+        if plane is None:
+            polygons.append([])
+            continue
+        poly = _base_winding(*plane)
+        for clip_plane in planes:
+            if clip_plane is plane or clip_plane is None:
+                continue
+            poly = _clip_winding(poly, *clip_plane)
+            if not poly:
+                break
+        polygons.append([
+            # Adding zero converts -0.0 to 0.0.
+            (round(x, 3) + 0.0, round(y, 3) + 0.0, round(z, 3) + 0.0)
+            for x, y, z in poly
+        ])
+    return polygons
+
+
+def _base_winding(
+    norm_x: float,
+    norm_y: float,
+    norm_z: float,
+    dist: float,
+) -> List[Tuple[float, float, float]]:
+    """Produce a huge square lying on a plane.
+
+    See source-sdk: utils/common/polylib.cpp, BaseWindingForPlane().
+    """
+    # Pick an up vector which isn't parallel to the normal.
+    if abs(norm_z) > abs(norm_x) and abs(norm_z) > abs(norm_y):
+        up_x, up_y, up_z = 1.0, 0.0, 0.0
+    else:
+        up_x, up_y, up_z = 0.0, 0.0, 1.0
+    # Project it onto the plane.
+    dot = up_x * norm_x + up_y * norm_y + up_z * norm_z
+    up_x -= norm_x * dot
+    up_y -= norm_y * dot
+    up_z -= norm_z * dot
+    length = math.sqrt(up_x ** 2 + up_y ** 2 + up_z ** 2)
+    up_x *= _WINDING_SIZE / length
+    up_y *= _WINDING_SIZE / length
+    up_z *= _WINDING_SIZE / length
+    right_x = up_y * norm_z - up_z * norm_y
+    right_y = up_z * norm_x - up_x * norm_z
+    right_z = up_x * norm_y - up_y * norm_x
+
+    org_x, org_y, org_z = norm_x * dist, norm_y * dist, norm_z * dist
+    return [
+        (org_x - right_x + up_x, org_y - right_y + up_y, org_z - right_z + up_z),
+        (org_x + right_x + up_x, org_y + right_y + up_y, org_z + right_z + up_z),
+        (org_x + right_x - up_x, org_y + right_y - up_y, org_z + right_z - up_z),
+        (org_x - right_x - up_x, org_y - right_y - up_y, org_z - right_z - up_z),
+    ]
+
+
+def _clip_winding(
+    poly: List[Tuple[float, float, float]],
+    norm_x: float,
+    norm_y: float,
+    norm_z: float,
+    dist: float,
+) -> List[Tuple[float, float, float]]:
+    """Remove the part of a polygon in front of a plane."""
+    dists = [
+        norm_x * x + norm_y * y + norm_z * z - dist
+        for x, y, z in poly
+    ]
+    if max(dists) <= _CLIP_EPSILON:
+        return poly
+    if min(dists) >= -_CLIP_EPSILON:
+        return []
+
+    result = []
+    count = len(poly)
+    for i in range(count):
+        point = poly[i]
+        point_dist = dists[i]
+        if point_dist <= _CLIP_EPSILON:
+            result.append(point)
+        next_point = poly[(i + 1) % count]
+        next_dist = dists[(i + 1) % count]
+        if (
+            (point_dist < -_CLIP_EPSILON and next_dist > _CLIP_EPSILON) or
+            (point_dist > _CLIP_EPSILON and next_dist < -_CLIP_EPSILON)
+        ):
+            frac = point_dist / (point_dist - next_dist)
+            result.append((
+                point[0] + frac * (next_point[0] - point[0]),
+                point[1] + frac * (next_point[1] - point[1]),
+                point[2] + frac * (next_point[2] - point[2]),
+            ))
+    return result
+
+
+def _decode_disp_rows(name: str, rows: Union[array, List[str]]) -> array:
+    """Convert displacement rows into a single array.
+
+    The rows can be the text from the file, or an array to copy.
+    """
+    typecode = _DISP_ROW_TYPES[name][0]
+    if isinstance(rows, array):
+        return array(typecode, rows)
+    conv = int if typecode == 'i' else float
+    return array(typecode, map(conv, ' '.join(rows).split()))
+
+
+def _encode_disp_rows(
+    name: str,
+    power: int,
+    values: Union[array, List[str]],
+) -> List[str]:
+    """Convert displacement arrays back into the text for each row."""
+    if not isinstance(values, array):
+        # Already text.
+        return values
+    typecode, per_item, is_vert = _DISP_ROW_TYPES[name]
+    row_len = (2 ** power + 1 if is_vert else 2 ** power) * per_item
+    item_fmt = '%d' if typecode == 'i' else _DISP_FORMAT
+    rows = []
+    for i in range(0, len(values), row_len):
+        row = values[i:i + row_len]
+        rows.append(' '.join([item_fmt] * len(row)) % tuple(row))
+    return rows
+
+
+# Serialisation is done using snapshots, tuples containing the data for each
+# object (produced by the _snapshot() methods). These can be cheaply pickled,
+# to export in other processes.
+
+def _side_text(ind: str, snapshot: tuple) -> str:
+    """Generate the text for a brush side."""
+    (
+        side_id, planes, mat, uaxis, vaxis,
+        rotation, lightmap, smoothing, disp,
+    ) = snapshot
+    ind1 = ind + '\t'
+    parts = [
+        ind, 'side\n',
+        ind, '{\n',
+        ind1, '"id" "', str(side_id), '"\n',
+        ind1, _PLANE_FORMAT % planes,
+        ind1, '"material" "', mat, '"\n',
+        ind1, '"uaxis" "', _UV_FORMAT % uaxis, '"\n',
+        ind1, '"vaxis" "', _UV_FORMAT % vaxis, '"\n',
+        ind1, '"rotation" "', str(rotation), '"\n',
+        ind1, '"lightmapscale" "', str(lightmap), '"\n',
+        ind1, '"smoothing_groups" "', str(smoothing), '"\n',
+    ]
+    if disp is not None:
+        power, pos, flags, elev, subdiv, allowed_verts, disp_data = disp
+        ind2 = ind + '\t\t'
+        ind3 = ind + '\t\t\t'
+        parts += [
+            ind1, 'dispinfo\n',
+            ind1, '{\n',
+            ind2, '"power" "', str(power), '"\n',
+            ind2, '"startposition" "[', _VEC_FORMAT % pos, ']"\n',
+            ind2, '"flags" "', str(flags), '"\n',
+            ind2, '"elevation" "', str(elev), '"\n',
+            ind2, '"subdiv" "',
+            srctools.bool_as_int(subdiv), '"\n',
+        ]
+        for v in _DISP_ROWS:
+            rows = disp_data[v]
+            if len(rows) > 0:
+                parts += [ind2, v, '\n', ind2, '{\n']
+                for i, data in enumerate(_encode_disp_rows(v, power, rows)):
+                    parts += [ind3, '"row', str(i), '" "', data, '"\n']
+                parts += [ind2, '}\n']
+        if len(allowed_verts) > 0:
+            parts += [ind2, 'allowed_verts\n', ind2, '{\n']
+            for k, v in allowed_verts.items():
+                parts += [ind3, '"', k, '" "', v, '"\n']
+            parts += [ind2, '}\n']
+        parts += [ind1, '}\n']
+    parts += [ind, '}\n']
+    return ''.join(parts)
+
+
+def _solid_text(ind: str, snapshot: tuple) -> str:
+    """Generate the text for a brush."""
+    (
+        solid_id, sides, visgroup_ids, hidden, group_id,
+        vis_shown, vis_auto_shown, cordon_solid, editor_color,
+    ) = snapshot
+    if hidden:
+        parts = [ind, 'hidden\n', ind, '{\n']
+        ind += '\t'
+    else:
+        parts = []
+    ind1 = ind + '\t'
+    ind2 = ind + '\t\t'
+
+    parts += [
+        ind, 'solid\n',
+        ind, '{\n',
+        ind1, '"id" "', str(solid_id), '"\n',
+    ]
+    parts += [_side_text(ind1, side) for side in sides]
+    parts += [
+        ind1, 'editor\n',
+        ind1, '{\n',
+        ind2, '"color" "', _VEC_FORMAT % editor_color, '"\n',
+    ]
+    if group_id is not None:
+        parts += [ind2, '"groupid" "', str(group_id), '"\n']
+
+    for group in visgroup_ids:
+        parts += [ind2, '"visgroupid" "', str(group), '"\n']
+
+    parts += [
+        ind2, '"visgroupshown" "',
+        srctools.bool_as_int(vis_shown), '"\n',
+        ind2, '"visgroupautoshown" "',
+        srctools.bool_as_int(vis_auto_shown), '"\n',
+    ]
+    if cordon_solid is not None:
+        parts += [ind2, '"cordonsolid" "', str(cordon_solid), '"\n']
+
+    parts += [ind1, '}\n', ind, '}\n']
+    if hidden:
+        parts += [ind[:-1], '}\n']
+    return ''.join(parts)
+
+
+def _ent_parts(ent_name: str, ind: str, snapshot: tuple) -> Tuple[str, str, str]:
+    """Generate the text for an entity, before and after the brushes.
+
+    This returns the text, and the indentation for the brushes.
+    """
+    (
+        ent_id, keys, fixup, outputs, solids, hidden, groups, visgroup_ids,
+        vis_shown, vis_auto_shown, logical_pos, editor_color, comments,
+    ) = snapshot
+    if hidden:
+        parts = [ind, 'hidden\n', ind, '{\n']
+        ind += '\t'
+    else:
+        parts = []
+    ind1 = ind + '\t'
+    ind2 = ind + '\t\t'
+
+    parts += [
+        ind, ent_name, '\n',
+        ind, '{\n',
+        ind1, '"id" "', str(ent_id), '"\n',
+    ]
+    for key, value in keys:
+        parts += [ind1, '"', key, '" "', value, '"\n']
+
+    parts.append(_fixup_text(ind, fixup))
+    head = ''.join(parts)
+
+    # Brushes go here.
+
+    parts = []
+    if len(outputs) > 0:
+        parts += [ind1, 'connections\n', ind1, '{\n']
+        for out in outputs:
+            parts += [ind2, _output_text(out)]
+        parts += [ind1, '}\n']
+
+    parts += [
+        ind1, 'editor\n',
+        ind1, '{\n',
+        ind2, '"color" "', _VEC_FORMAT % editor_color, '"\n',
+    ]
+
+    for group in groups:
+        parts += [ind2, '"groupid" "', str(group), '"\n']
+
+    for group in visgroup_ids:
+        parts += [ind2, '"visgroupid" "', str(group), '"\n']
+
+    parts += [
+        ind2, '"visgroupshown" "',
+        srctools.bool_as_int(vis_shown), '"\n',
+        ind2, '"visgroupautoshown" "',
+        srctools.bool_as_int(vis_auto_shown), '"\n',
+        ind2, '"logicalpos" "', logical_pos, '"\n',
+        ind2, '"comments" "', comments, '"\n',
+        ind1, '}\n',
+        ind, '}\n',
+    ]
+    if hidden:
+        parts += [ind[:-1], '}\n']
+    return head, ind1, ''.join(parts)
+
+
+def _fixup_text(ind: str, fixups: List[Tuple[str, str, int]]) -> str:
+    """Generate the text for the replace values of an entity."""
+    # When exporting, pad with zeros if needed
+    return ''.join([
+        '{}\t"replace{:02}" "${} {}"\n'.format(ind, index, key, value)
+        for (key, value, index) in fixups
+    ])
+
+
+def _output_text(snapshot: tuple) -> str:
+    """Generate the text for an output."""
+    output, target, inp, params, delay, times, comma_sep = snapshot
+    sep = ',' if comma_sep else OUTPUT_SEP
+    return (
+        '"' + output + '" "' +
+        target + sep +
+        inp + sep +
+        params + sep +
+        format(delay, 'g') + sep +
+        str(times) + '"\n'
+    )
+
+
+def _write_flat_state(file, state: Tuple[List[str], Dict[str, array]]):
+    """Write the values produced by VMF._flat_state() to a binary file."""
+    strings, arrays = state
+    encoded = [text.encode('utf8') for text in strings]
+    file.write(struct.pack('<QQ', len(encoded), len(arrays)))
+    file.write(array('q', map(len, encoded)).tobytes())
+    file.write(b''.join(encoded))
+    for name, values in arrays.items():
+        file.write(struct.pack(
+            '<16scQ',
+            name.encode('ascii'),
+            values.typecode.encode('ascii'),
+            len(values),
+        ))
+        file.write(values.tobytes())
+
+
+def _read_flat_state(data: bytes, pos=0) -> Tuple[List[str], Dict[str, array]]:
+    """Read the values written by _write_flat_state(), starting at pos."""
+    view = memoryview(data)
+    str_count, array_count = struct.unpack_from('<QQ', data, pos)
+    pos += 16
+    lengths = array('q')
+    lengths.frombytes(view[pos:pos + 8 * str_count])
+    pos += 8 * str_count
+    strings = []
+    for length in lengths:
+        strings.append(str(view[pos:pos + length], 'utf8'))
+        pos += length
+
+    arrays = {}
+    for i in range(array_count):
+        name, typecode, count = struct.unpack_from('<16scQ', data, pos)
+        pos += struct.calcsize('<16scQ')
+        values = array(typecode.decode('ascii'))
+        size = values.itemsize * count
+        values.frombytes(view[pos:pos + size])
+        if len(values) != count:
+            raise ValueError('Truncated cache file!')
+        pos += size
+        arrays[name.rstrip(b'\0').decode('ascii')] = values
+    return strings, arrays
+
+
+def _filter_solid_blocks(
+    lines: Iterable[str],
+    side_text: List[str]=None,
+) -> Iterator[str]:
+    """Remove brush data from the lines of a VMF file, before it's tokenized.
+
+    If side_text is None, brushes are removed entirely. Otherwise the side
+    blocks of each brush are appended to side_text as a single string,
+    and replaced by a keyvalue holding the index.
+    Brush blocks only contain planes, materials and numbers, so braces
+    can be counted directly.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.strip().strip('"').casefold() != 'solid':
+            yield line
+            continue
+        brace_line = next(lines, '')
+        if brace_line.strip() != '{':
+            # Not actually a brush.
+            yield line
+            yield brace_line
+            continue
+
+        depth = 1
+        if side_text is None:
+            for block_line in lines:
+                depth += block_line.count('{') - block_line.count('}')
+                if depth <= 0:
+                    break
+            continue
+
+        yield line
+        yield brace_line
+        sides = []
+        in_side = False
+        for block_line in lines:
+            stripped = block_line.strip()
+            if depth == 1 and stripped.strip('"').casefold() == 'side':
+                in_side = True
+            depth += block_line.count('{') - block_line.count('}')
+            if depth <= 0:
+                yield '"{}" "{}"\n'.format(_LAZY_SIDES_KEY, len(side_text))
+                side_text.append(''.join(sides))
+                yield block_line
+                break
+            if in_side:
+                sides.append(block_line)
+                if depth == 1 and stripped == '}':
+                    in_side = False
+            else:
+                yield block_line
+
+
+
+def _read_block(tree: Property) -> Dict[str, Any]:
+    """Return the value of each child of a block, in one pass.
+
+    Like Property.find_key(), the last of any duplicate keys is used.
+    """
+    return {prop._folded_name: prop.value for prop in tree.value}
+
+
+def _parse_plane(value: str) -> List[Tuple[float, float, float]]:
+    """Parse the three points from a side's plane value."""
+    match = _PLANE_SYNTAX.fullmatch(value)
+    if match is None:
+        raise ValueError('Invalid planes in "' + value + '"!')
+    x1, y1, z1, x2, y2, z2, x3, y3, z3 = match.groups()
+    try:
+        return [
+            (float(x1), float(y1), float(z1)),
+            (float(x2), float(y2), float(z2)),
+            (float(x3), float(y3), float(z3)),
+        ]
+    except ValueError:
+        raise ValueError('Invalid planes in "' + value + '"!') from None
+
+
+def _parse_uv_axis(value: str) -> Tuple[float, float, float, float, float]:
+    """Parse the values for a UV axis, in the form "[x y z offset] scale"."""
+    match = _UV_AXIS_SYNTAX.fullmatch(value)
+    if match is None:
+        raise ValueError('Invalid UV axis "' + value + '"!')
+    x, y, z, offset, scale = match.groups()
+    try:
+        return float(x), float(y), float(z), float(offset), float(scale)
+    except ValueError:
+        raise ValueError('Invalid UV axis "' + value + '"!') from None
+
+
+def _parse_side(vmf_file: VMF, tree: Property) -> Side:
+    """Parse the property tree into a Side object.
+
+    This builds the side directly, instead of calling Side(). Displacements
+    are rare, so those are handled by Side._parse_disp().
+    """
+    values = _read_block(tree)
+    if values.get('dispinfo'):
+        return Side._parse_disp(vmf_file, values)
+
+    (x1, y1, z1), (x2, y2, z2), (x3, y3, z3) = _parse_plane(
+        values.get('plane', '(0 0 0) (0 0 0) (0 0 0)')
+    )
+    uaxis = UVAxis(*_parse_uv_axis(values.get('uaxis', '[0 1 0 0] 0.25')))
+    vaxis = UVAxis(*_parse_uv_axis(values.get('vaxis', '[0 0 -1 0] 0.25')))
+    rotation = srctools.conv_float(values.get('rotation'), 0)
+    lightmap = srctools.conv_int(values.get('lightmapscale'), 16)
+    smooth = srctools.conv_int(values.get('smoothing_groups'), 0)
+
+    side = Side.__new__(Side)
+    side.map = vmf_file
+    side.id = vmf_file.face_id.get_id(srctools.conv_int(values.get('id'), -1))
+    side._planes = [Vec(x1, y1, z1), Vec(x2, y2, z2), Vec(x3, y3, z3)]
+    side._mat = sys.intern(values.get('material', ''))
+    side.uaxis = uaxis
+    side.vaxis = vaxis
+    side.ham_rot = rotation
+    side.lightmap = lightmap
+    side.smooth = smooth
+    side.is_disp = False
+    side._dirty = True
+    side._solid = None
+    side._normal_cache = side._bbox_cache = None
+    return side
+
+# These are available as both C and Python versions, plus the unprefixed
+# best version.
+_Py_read_block = _read_block
+_Py_parse_plane = _parse_plane
+_Py_parse_uv_axis = _parse_uv_axis
+_Py_parse_side = _parse_side
+try:
+    # noinspection all
+    from srctools._vmf import (
+        read_block as _read_block,
+        parse_plane as _parse_plane,
+        parse_uv_axis as _parse_uv_axis,
+        parse_side as _parse_side,
+    )
+except ImportError:
+    _C_read_block = _C_parse_plane = _C_parse_uv_axis = _C_parse_side = None
+else:
+    _C_read_block = _read_block
+    _C_parse_plane = _parse_plane
+    _C_parse_uv_axis = _parse_uv_axis
+    _C_parse_side = _parse_side
+
+# In forked worker processes, the VMF being exported.
+_FORKED_VMF = None  # type: Optional[VMF]
+
+
+def _export_init_forked(vmf: VMF):
+    """Store the VMF, when starting a forked worker process."""
+    global _FORKED_VMF
+    _FORKED_VMF = vmf
+
+
+def _export_forked(args: Tuple[bool, str, int, int]) -> str:
+    """Generate the text for a range of brushes or entities.
+
+    This is run in forked worker processes by VMF.export().
+    """
+    is_brushes, ind, start, end = args
+    if is_brushes:
+        return ''.join([
+            solid._export_text(ind)
+            for solid in _FORKED_VMF.spawn.solids[start:end]
+        ])
+    else:
+        return ''.join([
+            ent._export_text(ind=ind)
+            for ent in _FORKED_VMF.entities[start:end]
+        ])
+
+
+def _unpickle_vmf(state: Tuple[List[str], Dict[str, array]]) -> VMF:
+    """Rebuild a pickled VMF."""
+    return VMF._from_flat_state(state)
+
+
+def _unpickle_child(
+    vmf: VMF,
+    pos: Tuple[int, ...],
+) -> Union['Solid', 'Side', 'Entity']:
+    """Find a pickled entity, brush or face in its unpickled map."""
+    return vmf._at_position(pos)
+
+
+def _parse_flat_state(path: str) -> Tuple[List[str], Dict[str, array]]:
+    """Parse a VMF, then flatten it.
+
+    This is run in worker processes by VMF.merge().
+    """
+    return VMF.parse(path)._flat_state()
+
+
+def _release_loose(
+    loose: Dict[int, weakref.finalize],
+    key: int,
+    id_man: IDMan,
+    obj_id: int,
+    face_id: IDMan,
+    face_ids: List[int],
+):
+    """Release the IDs of an object collected without being added to a map."""
+    del loose[key]
+    id_man.discard(obj_id)
+    face_id.difference_update(face_ids)
+
+
+def _export_snapshots(args: Tuple[str, List[tuple], List[tuple]]) -> str:
+    """Generate the text for a list of brush and entity snapshots.
+
+    This is run in worker processes by VMF.export().
+    """
+    ind, solids, ents = args
+    parts = [_solid_text(ind, solid) for solid in solids]
+    for ent in ents:
+        head, solid_ind, tail = _ent_parts('entity', '', ent)
+        parts.append(head)
+        parts += [_solid_text(solid_ind, solid) for solid in ent[4]]
+        parts.append(tail)
+    return ''.join(parts)